@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Measure goodput under overload, with and without a concurrency limit.
+
+Offers more deliveries than the handler can take, for a while, once
+without ``HOOKS_CONCURRENCY_LIMIT`` and once with it set to the number
+of handler slots. Goodput is the deliveries per second that got a 200
+within the deadline. The defaults are scaled down from GitHub's 10
+second deadline. Run it from the repository root::
+
+    python benchmarks/goodput.py
+
+Exits with status 1 if the limit doesn't at least get 1.5 times the
+goodput, and half the capacity.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import flask  # noqa: E402
+from flask_hookserver import Hooks  # noqa: E402
+
+
+def post(app):
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+    }
+    return app.test_client().post('/hooks', content_type='application/json',
+                                  data='{}', headers=headers)
+
+
+def goodput(limit, args):
+    """Offer more deliveries than the handler can take, for a while.
+
+    The handler shares ``args.slots`` slots, like a small pool of uWSGI
+    workers in front of a database. Deliveries arrive at ``args.rate``
+    per second, which is more than the slots can serve. Returns the
+    number of deliveries per second that got a 200 within the deadline.
+    """
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_CONCURRENCY_LIMIT'] = limit
+    app.config['HOOKS_LATENCY_TARGET'] = args.deadline / 5
+    hooks = Hooks(app)
+    slots = threading.Semaphore(args.slots)
+
+    @hooks.hook('push')
+    def push(data, guid):
+        with slots:
+            time.sleep(args.service_time)
+        return 'Pushed'
+
+    results = []
+
+    def deliver():
+        start = time.time()
+        rv = post(app)
+        results.append((rv.status_code, time.time() - start))
+
+    threads = []
+    start = time.time()
+    for i in range(int(args.rate * args.duration)):
+        # Open loop: arrivals don't wait for earlier deliveries
+        delay = start + i / float(args.rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        thread = threading.Thread(target=deliver)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    good = [latency for status, latency in results
+            if status == 200 and latency <= args.deadline]
+    return len(good) / args.duration
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--deadline', type=float, default=0.5,
+                        help='seconds a delivery may take to count')
+    parser.add_argument('--service-time', type=float, default=0.02,
+                        help='seconds the handler holds a slot for')
+    parser.add_argument('--slots', type=int, default=4,
+                        help='deliveries the handler serves at once')
+    parser.add_argument('--rate', type=float, default=500,
+                        help='deliveries offered per second')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='seconds to offer deliveries for')
+    args = parser.parse_args(argv)
+
+    capacity = args.slots / args.service_time
+    unlimited = goodput(None, args)
+    limited = goodput(args.slots, args)
+    print('%-10s %10s' % ('', 'per second'))
+    print('%-10s %10d' % ('offered', args.rate))
+    print('%-10s %10d' % ('capacity', capacity))
+    print('%-10s %10d' % ('unlimited', unlimited))
+    print('%-10s %10d' % ('limited', limited))
+    if limited > 1.5 * unlimited and limited > 0.5 * capacity:
+        return 0
+    print('The limit didn\'t improve goodput enough')
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
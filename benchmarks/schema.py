@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Measure what a payload schema adds to each delivery.
+
+Times the compiled validator on its own, and whole deliveries through
+the Flask test client with and without a schema on the handler. Run it
+from the repository root::
+
+    python benchmarks/schema.py
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import flask  # noqa: E402
+from flask_hookserver import Hooks, compile_schema  # noqa: E402
+
+COMMIT = {
+    'type': 'object',
+    'required': ['id', 'message', 'timestamp', 'author'],
+    'properties': {
+        'id': {'type': 'string', 'minLength': 40, 'maxLength': 40},
+        'message': {'type': 'string'},
+        'timestamp': {'type': 'string'},
+        'author': {
+            'type': 'object',
+            'required': ['name', 'email'],
+            'properties': {'name': {'type': 'string'},
+                           'email': {'type': 'string'}},
+        },
+        'added': {'type': 'array', 'items': {'type': 'string'}},
+        'removed': {'type': 'array', 'items': {'type': 'string'}},
+        'modified': {'type': 'array', 'items': {'type': 'string'}},
+    },
+}
+
+SCHEMA = {
+    'type': 'object',
+    'required': ['ref', 'before', 'after', 'repository', 'commits'],
+    'properties': {
+        'ref': {'type': 'string', 'pattern': '^refs/'},
+        'before': {'type': 'string'},
+        'after': {'type': 'string'},
+        'forced': {'type': 'boolean'},
+        'repository': {
+            'type': 'object',
+            'required': ['id', 'full_name'],
+            'properties': {'id': {'type': 'integer'},
+                           'full_name': {'type': 'string'}},
+        },
+        'sender': {
+            'type': 'object',
+            'properties': {'login': {'type': 'string'}},
+        },
+        'commits': {'type': 'array', 'items': COMMIT},
+        'head_commit': {'anyOf': [{'type': 'null'}, COMMIT]},
+    },
+}
+
+
+def payload(commits):
+    commit = {
+        'id': 'a' * 40,
+        'message': 'Fix the thing',
+        'timestamp': '2016-04-11T12:00:00-07:00',
+        'author': {'name': 'Nick', 'email': 'nick@example.com'},
+        'added': ['a.py'],
+        'removed': [],
+        'modified': ['b.py', 'c.py'],
+    }
+    return {
+        'ref': 'refs/heads/master',
+        'before': '0' * 40,
+        'after': 'a' * 40,
+        'forced': False,
+        'repository': {'id': 1, 'full_name': 'a/b'},
+        'sender': {'login': 'nick'},
+        'commits': [commit] * commits,
+        'head_commit': commit,
+    }
+
+
+def per_call(fn, number):
+    """Return the best time of a call in microseconds."""
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def client_for(schema):
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    hooks = Hooks(app)
+    hooks.register_hook('push', lambda data, guid: 'ok', schema=schema)
+    return app.test_client()
+
+
+def main():
+    headers = {'X-GitHub-Event': 'push', 'X-GitHub-Delivery': 'abc'}
+    compile_time = per_call(lambda: compile_schema(SCHEMA), 1000)
+    print('compile_schema: %.1f us, once per handler' % compile_time)
+    validate = compile_schema(SCHEMA)
+    for commits in (1, 20):
+        data = payload(commits)
+        body = json.dumps(data)
+        validate_time = per_call(lambda: validate(data), 2000)
+        clients = [client_for(None), client_for(SCHEMA)]
+        times = [float('inf'), float('inf')]
+        # Alternate between the two, so that drift affects both alike
+        for _ in range(10):
+            for i, client in enumerate(clients):
+                times[i] = min(times[i], per_call(lambda: client.post(
+                    '/hooks', data=body, content_type='application/json',
+                    headers=headers), 100))
+        print('%2d commits (%5d bytes): validate %6.1f us, delivery %6.1f us '
+              'without schema, %6.1f us with (+%.1f%%)' %
+              (commits, len(body), validate_time, times[0], times[1],
+               (times[1] - times[0]) / times[0] * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Compare delivery throughput under ``app.run``, ``serve`` and Gunicorn.
+
+Each server is started in its own process with the same app, then a
+number of client threads post signed deliveries over fresh connections,
+like GitHub does, for a fixed time. If Gunicorn is installed, ``serve``
+is run again with ``--server gunicorn``. Run it from the repository root::
+
+    python benchmarks/serve.py --clients 32 --duration 10 --sleep 0.05
+
+``--sleep`` is how long the handler waits, standing in for the network
+calls a real handler makes.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+APP = '''
+import time
+from flask import Flask
+from flask_hookserver import Hooks
+
+app = Flask(__name__)
+app.config['VALIDATE_IP'] = False
+app.config['GITHUB_WEBHOOKS_KEY'] = b'benchmark key'
+hooks = Hooks(app)
+
+@hooks.hook('push')
+def push(data, guid):
+    time.sleep(%(sleep)r)
+    return 'ok'
+
+if __name__ == '__main__':
+    app.run(port=%(port)d)
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start(command, env):
+    proc = subprocess.Popen(command, env=env, stderr=open(os.devnull, 'w'))
+    time.sleep(2)
+    return proc
+
+
+def load(url, clients, duration):
+    body = json.dumps({'ref': 'refs/heads/master'}).encode()
+    signature = 'sha1=' + hmac.new(b'benchmark key', body,
+                                   hashlib.sha1).hexdigest()
+    headers = {
+        'Content-Type': 'application/json',
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'benchmark',
+        'X-Hub-Signature': signature,
+        'Connection': 'close',
+    }
+    counts = [0] * clients
+    errors = [0] * clients
+    deadline = time.time() + duration
+
+    def client(i):
+        while time.time() < deadline:
+            try:
+                rv = requests.post(url, data=body, headers=headers,
+                                   timeout=30)
+                if rv.status_code == 200:
+                    counts[i] += 1
+                else:
+                    errors[i] += 1
+            except requests.RequestException:
+                errors[i] += 1
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / float(duration), sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--sleep', type=float, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, 'benchmark_app.py'), 'w') as f:
+        f.write(APP % {'sleep': args.sleep, 'port': args.port})
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, directory])
+    url = 'http://127.0.0.1:%d/hooks' % args.port
+
+    serve = [sys.executable, '-m', 'flask_hookserver', 'serve',
+             'benchmark_app', '--bind', '127.0.0.1:%d' % args.port,
+             '--threads', str(args.threads)]
+    if args.workers:
+        serve += ['--workers', str(args.workers)]
+    runs = [
+        ('app.run', [sys.executable,
+                     os.path.join(directory, 'benchmark_app.py')]),
+        ('serve', serve),
+    ]
+    try:
+        import gunicorn  # noqa: F401
+        runs.append(('gunicorn', serve + ['--server', 'gunicorn']))
+    except ImportError:
+        pass
+    for name, command in runs:
+        proc = start(command, env)
+        try:
+            rate, errors = load(url, args.clients, args.duration)
+        finally:
+            proc.terminate()
+            proc.wait()
+        print('%-8s %8.1f deliveries/s  %d errors' % (name, rate, errors))
+
+
+if __name__ == '__main__':
+    main()
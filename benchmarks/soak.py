@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""Soak test: look for memory that grows with the number of deliveries.
+
+Sends signed synthetic deliveries through a :class:`Hooks` app with IP
+and signature validation on. GitHub's ``/meta`` is served by a local
+stub, and its cached networks expire every second, so the lookup and the
+allowlist are rebuilt throughout the run. Payloads range from a few
+hundred bytes to ``--max-size``, across many repositories.
+
+After ``--warmup`` deliveries, a :mod:`tracemalloc` snapshot and the RSS
+are taken as a baseline, and again every ``--interval`` deliveries. At
+the end, the traced growth since the baseline is divided by the number
+of deliveries. The RSS only ever rises to the allocator's high-water
+mark, which the first big payloads push up, so its growth is taken over
+the second half of the run instead. The script exits with status 1 if
+either figure is over its budget, and prints the lines that allocated
+the most, to show where any growth comes from. ``--leak`` makes the push
+handler keep that many bytes per delivery, to check that a leak is
+caught. Run it from the repository root::
+
+    python benchmarks/soak.py --deliveries 300000
+
+Needs Python 3.4 or later, for :mod:`tracemalloc`.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import flask  # noqa: E402
+import flask_hookserver  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+KEY = b'soak test key'
+
+#: Where ``--leak`` keeps its bytes
+leaked = []
+
+
+def rss():
+    """Return the resident set size in bytes, or ``None``."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        return None
+
+
+def start_meta_stub():
+    """Serve a stand-in for GitHub's ``/meta`` on a free local port."""
+    meta = flask.Flask('meta')
+
+    @meta.route('/meta')
+    def hooks_meta():
+        return flask.jsonify(hooks=['192.30.252.0/22', '127.0.0.0/8',
+                                    '::1/128'])
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, meta, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.port
+
+
+def make_app(meta_url, options, directory):
+    """Build the app under test, with the features chosen on the CLI."""
+    def load_hooks():
+        return flask_hookserver._load_github_hooks(meta_url)
+    flask_hookserver.load_github_hooks = flask_hookserver._timed_memoize(
+        options.meta_ttl)(load_hooks)
+
+    app = flask.Flask('soak')
+    app.config['GITHUB_WEBHOOKS_KEY'] = KEY
+    if options.log:
+        app.config['HOOKS_LOG_PATH'] = os.path.join(directory, 'hooks.log')
+    if options.analytics:
+        app.config['HOOKS_ANALYTICS'] = True
+    hooks = flask_hookserver.Hooks(app)
+
+    @hooks.hook('push', schema={'required': ['ref', 'commits']})
+    def push(data, guid):
+        if options.leak:
+            leaked.append(b'x' * options.leak)
+        return '%s %d' % (data['ref'], len(data['commits']))
+
+    @hooks.hook('ping')
+    def ping(data, guid):
+        return 'pong'
+    return app
+
+
+def deliveries(rng, max_size):
+    """Generate ``(headers, body)`` for signed deliveries, forever."""
+    commit = {'id': 'a' * 40, 'message': 'x' * 200,
+              'author': {'name': 'Soak', 'email': 'soak@example.com'}}
+    while True:
+        if rng.random() < 0.05:
+            event, payload = 'ping', {'zen': 'Keep it logically awesome.'}
+        else:
+            # Mostly small payloads, with a long tail of big ones
+            size = min(max_size, int(rng.paretovariate(1.2) * 500))
+            payload = {
+                'ref': 'refs/heads/master',
+                'repository': {'full_name': 'org/repo%d' %
+                               rng.randint(1, 5000)},
+                'sender': {'login': 'user%d' % rng.randint(1, 500)},
+                'commits': [commit] * max(1, size // 300),
+            }
+            event = 'push'
+        body = json.dumps(payload).encode()
+        headers = {
+            'X-GitHub-Event': event,
+            'X-GitHub-Delivery': str(uuid.uuid4()),
+            'X-Hub-Signature': 'sha1=' + hmac.new(KEY, body,
+                                                  hashlib.sha1).hexdigest(),
+        }
+        yield headers, body
+
+
+def measure(app):
+    """Flush the log and collect garbage, then return the traced memory
+    and RSS."""
+    log = app.extensions['hookserver'].get('log')
+    if log is not None:
+        log.flush()
+    gc.collect()
+    return tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()[0], \
+        rss()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--deliveries', type=int, default=300000)
+    parser.add_argument('--warmup', type=int, default=None,
+                        help='deliveries before the baseline '
+                             '(default: 5%% of them)')
+    parser.add_argument('--interval', type=int, default=None,
+                        help='deliveries between reports '
+                             '(default: 10%% of them)')
+    parser.add_argument('--budget', type=float, default=1.0,
+                        help='traced bytes each delivery may add '
+                             '(default: %(default)s)')
+    parser.add_argument('--rss-budget', type=float, default=16.0,
+                        help='RSS bytes each delivery may add '
+                             '(default: %(default)s)')
+    parser.add_argument('--max-size', type=int, default=256 * 1024,
+                        help='largest payload in bytes')
+    parser.add_argument('--meta-ttl', type=float, default=1.0,
+                        help='seconds to cache /meta for')
+    parser.add_argument('--log', action='store_true',
+                        help='write the delivery log')
+    parser.add_argument('--analytics', action='store_true',
+                        help='count heavy hitters')
+    parser.add_argument('--leak', type=int, default=0,
+                        help='bytes the push handler keeps each delivery')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(argv)
+    warmup = options.warmup or max(1, options.deliveries // 20)
+    interval = options.interval or max(1, options.deliveries // 10)
+
+    directory = tempfile.mkdtemp()
+    server, meta_url = start_meta_stub()
+    app = make_app(meta_url, options, directory)
+    try:
+        client = app.test_client()
+        environ = {'REMOTE_ADDR': '127.0.0.1'}
+        generate = deliveries(random.Random(options.seed), options.max_size)
+
+        tracemalloc.start()
+        start = time.time()
+        baseline = None
+        checkpoints = []
+        for n in range(1, warmup + options.deliveries + 1):
+            headers, body = next(generate)
+            rv = client.post('/hooks', data=body, headers=headers,
+                             content_type='application/json',
+                             environ_base=environ)
+            if rv.status_code != 200:
+                print('Delivery %d failed: %d %s' %
+                      (n, rv.status_code, rv.data[:200]))
+                return 2
+            if n == warmup:
+                baseline = measure(app)
+                start = time.time()
+                print('%9s %10s %12s %12s %12s' % (
+                    'delivered', 'per second', 'traced', 'rss',
+                    'bytes each'))
+            elif n > warmup and ((n - warmup) % interval == 0 or
+                                 n == warmup + options.deliveries):
+                _, traced, resident = measure(app)
+                done = n - warmup
+                checkpoints.append((done, resident))
+                print('%9d %10.0f %12d %12s %12.2f' % (
+                    done, done / (time.time() - start), traced,
+                    resident, (traced - baseline[1]) / float(done)))
+        snapshot, traced, resident = measure(app)
+    finally:
+        server.shutdown()
+        state = app.extensions['hookserver']
+        for name in ('log', 'analytics'):
+            if name in state:
+                state[name].close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print('\nLargest growth since the baseline:')
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = snapshot.filter_traces(ignore).compare_to(
+        baseline[0].filter_traces(ignore), 'lineno')
+    for stat in stats[:10]:
+        print('  %s' % stat)
+
+    failed = False
+    traced_each = (traced - baseline[1]) / float(options.deliveries)
+    print('\nTraced: %.2f bytes per delivery (budget %.2f)' %
+          (traced_each, options.budget))
+    if traced_each > options.budget:
+        failed = True
+    # The growth from the checkpoint nearest halfway, or the baseline
+    middle = [c for c in checkpoints if c[0] <= options.deliveries // 2]
+    done, halfway = middle[-1] if middle else (0, baseline[2])
+    if resident is not None and halfway is not None:
+        rss_each = (resident - halfway) / float(options.deliveries - done)
+        print('RSS: %.2f bytes per delivery (budget %.2f)' %
+              (rss_each, options.rss_budget))
+        if rss_each > options.rss_budget:
+            failed = True
+    print('FAILED' if failed else 'OK')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
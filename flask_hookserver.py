@@ -6,102 +6,3079 @@ Flask-Hookserver: GitHub webhooks using Flask.
 :license: MIT, see LICENSE for more details.
 """
 
+from array import array
+from collections import deque
 from flask import request
 from functools import wraps
-from werkzeug.exceptions import BadRequest, Forbidden, ServiceUnavailable
-import hashlib
-import hmac
-import ipaddress
-import requests
+from werkzeug.exceptions import (BadRequest, Forbidden, GatewayTimeout,
+                                 HTTPException, ServiceUnavailable)
+import bisect
+import flask
+import heapq
+import json
+import math
+import os
+import random
+import struct
+import threading
 import time
-import werkzeug.security
+import zlib
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
 
 __author__ = 'Nick Frost'
 __version__ = '1.1.0'
 __license__ = 'MIT'
 
 
-class Hooks(object):
+class Hooks(object):
+
+    """The Hooks object registers handlers to GitHub webhooks events.
+
+    :param app: the optional :class:`~flask.Flask` instance to register
+                the extension
+    :param url: the url that events will be posted to
+    """
+
+    def __init__(self, app=None, url='/hooks'):
+        """Initialize the extension."""
+        # Replaced, never changed in place, so requests can read it
+        # without a lock
+        self._hooks = {}
+        self._relays = []
+        self._lock = threading.RLock()
+        self._staging = None
+        # The priority classes handlers may use, once there's a scheduler
+        self._weights = None
+        if app is not None:
+            self.init_app(app, url=url)
+
+    def init_app(self, app, url='/hooks'):
+        """Register the URL route to the application.
+
+        :param app: the optional :class:`~flask.Flask` instance to
+                register the extension
+        :param url: the url that events will be posted to
+        """
+        app.config.setdefault('VALIDATE_IP', True)
+        app.config.setdefault('VALIDATE_SIGNATURE', True)
+        app.config.setdefault('HOOKS_ARCHIVE_PATH', None)
+        app.config.setdefault('HOOKS_ARCHIVE_SEGMENT_SIZE', 64 * 1024 * 1024)
+        app.config.setdefault('HOOKS_ARCHIVE_MAX_BYTES', None)
+        app.config.setdefault('HOOKS_ARCHIVE_MAX_AGE', None)
+        app.config.setdefault('HOOKS_WORKERS', None)
+        app.config.setdefault('HOOKS_PRIORITY_WEIGHTS',
+                              PriorityScheduler.default_weights)
+        app.config.setdefault('HOOKS_PRIORITY_QUEUE_SIZE', 1000)
+        app.config.setdefault('HOOKS_LANES', None)
+        app.config.setdefault('HOOKS_LANE_KEY', 'repository.id')
+        app.config.setdefault('HOOKS_LANE_QUEUE_SIZE', 100)
+        app.config.setdefault('HOOKS_LOG_PATH', None)
+        app.config.setdefault('HOOKS_LOG_ADDRESS', None)
+        app.config.setdefault('HOOKS_LOG_CAPACITY', 10000)
+        app.config.setdefault('HOOKS_CONCURRENCY_LIMIT', None)
+        app.config.setdefault('HOOKS_LATENCY_TARGET', 5.0)
+        app.config.setdefault('HOOKS_PROVIDERS', ['github'])
+        app.config.setdefault('HOOKS_PROCESSES', None)
+        app.config.setdefault('HOOKS_PROCESS_BUFFER_SIZE', 1024 * 1024)
+        app.config.setdefault('HOOKS_PROCESS_BUFFERS', None)
+        app.config.setdefault('HOOKS_PROCESS_TIMEOUT', 60)
+        app.config.setdefault('HOOKS_STREAM', False)
+        app.config.setdefault('HOOKS_STREAM_BUFFER', 100)
+        app.config.setdefault('HOOKS_STREAM_TOKEN', None)
+        app.config.setdefault('HOOKS_RETRIES', None)
+        app.config.setdefault('HOOKS_RETRY_DELAY', 1.0)
+        app.config.setdefault('HOOKS_RETRY_MAX_DELAY', 600.0)
+        app.config.setdefault('HOOKS_RELOAD_CONFIG', None)
+        app.config.setdefault('HOOKS_RELOAD_MODULES', [])
+        app.config.setdefault('HOOKS_RELOAD_SIGNAL', None)
+        app.config.setdefault('HOOKS_RELOAD_INTERVAL', None)
+        app.config.setdefault('HOOKS_ANALYTICS', False)
+        app.config.setdefault('HOOKS_ANALYTICS_WINDOW', 3600)
+        app.config.setdefault('HOOKS_ANALYTICS_TOP', 50)
+        app.config.setdefault('HOOKS_ANALYTICS_PATH', None)
+        app.config.setdefault('HOOKS_ANALYTICS_TOKEN', None)
+
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        state = app.extensions.setdefault('hookserver', {})
+        state['hooks'] = self
+        state['providers'] = _resolve_providers(app.config['HOOKS_PROVIDERS'])
+        if _worker_arena is not None:
+            # A ProcessPool worker imports the app's module to find a
+            # handler, and only runs handlers, so it needs none of this
+            return
+
+        if app.config['HOOKS_PROCESSES']:
+            state['process_pool'] = ProcessPool(
+                app.config['HOOKS_PROCESSES'],
+                buffer_size=app.config['HOOKS_PROCESS_BUFFER_SIZE'],
+                buffers=app.config['HOOKS_PROCESS_BUFFERS'],
+                call_timeout=app.config['HOOKS_PROCESS_TIMEOUT'])
+
+        if app.config['HOOKS_ARCHIVE_PATH']:
+            state['archive'] = DeliveryArchive(
+                app.config['HOOKS_ARCHIVE_PATH'],
+                segment_size=app.config['HOOKS_ARCHIVE_SEGMENT_SIZE'],
+                max_bytes=app.config['HOOKS_ARCHIVE_MAX_BYTES'],
+                max_age=app.config['HOOKS_ARCHIVE_MAX_AGE'])
+
+        if app.config['HOOKS_WORKERS'] and app.config['HOOKS_LANES']:
+            raise ValueError('HOOKS_WORKERS and HOOKS_LANES can\'t both be '
+                             'set')
+        if app.config['HOOKS_WORKERS']:
+            self._weights = app.config['HOOKS_PRIORITY_WEIGHTS']
+            for key, handler in self._hooks.items():
+                _check_priority(key, handler.priority, self._weights)
+            state['scheduler'] = PriorityScheduler(
+                app.config['HOOKS_WORKERS'],
+                weights=app.config['HOOKS_PRIORITY_WEIGHTS'],
+                queue_size=app.config['HOOKS_PRIORITY_QUEUE_SIZE'])
+        if app.config['HOOKS_LANES']:
+            state['lanes'] = ShardedExecutor(
+                app.config['HOOKS_LANES'],
+                queue_size=app.config['HOOKS_LANE_QUEUE_SIZE'])
+
+        if app.config['HOOKS_LOG_PATH'] or app.config['HOOKS_LOG_ADDRESS']:
+            state['log'] = DeliveryLog(
+                path=app.config['HOOKS_LOG_PATH'],
+                address=app.config['HOOKS_LOG_ADDRESS'],
+                capacity=app.config['HOOKS_LOG_CAPACITY'])
+
+        if app.config['HOOKS_CONCURRENCY_LIMIT']:
+            state['limiter'] = ConcurrencyLimiter(
+                app.config['HOOKS_CONCURRENCY_LIMIT'],
+                latency_target=app.config['HOOKS_LATENCY_TARGET'])
+
+        if app.config['HOOKS_RETRIES']:
+            state['retries'] = RetryScheduler(
+                app.config['HOOKS_RETRIES'],
+                base_delay=app.config['HOOKS_RETRY_DELAY'],
+                max_delay=app.config['HOOKS_RETRY_MAX_DELAY'])
+
+        if (app.config['HOOKS_RELOAD_SIGNAL'] or
+                app.config['HOOKS_RELOAD_INTERVAL']):
+            state['reloader'] = Reloader(
+                self, app,
+                interval=app.config['HOOKS_RELOAD_INTERVAL'],
+                signum=app.config['HOOKS_RELOAD_SIGNAL'])
+
+        if app.config['HOOKS_ANALYTICS']:
+            state['analytics'] = HeavyHitters(
+                window=app.config['HOOKS_ANALYTICS_WINDOW'],
+                k=app.config['HOOKS_ANALYTICS_TOP'],
+                path=app.config['HOOKS_ANALYTICS_PATH'])
+
+        # Like the stream, the report names private repositories
+        if (app.config['HOOKS_ANALYTICS'] and
+                app.config['HOOKS_ANALYTICS_TOKEN']):
+            check_analytics_token = _token_check(app, 'HOOKS_ANALYTICS_TOKEN')
+
+            @app.route(url.rstrip('/') + '/analytics')
+            def hook_analytics():
+                check_analytics_token()
+                analytics = state['analytics'].combined()
+                report = analytics.report(n=request.args.get('n', 10,
+                                                             type=int))
+                report['estimates'] = dict(
+                    (dimension, analytics.estimate(dimension,
+                                                   request.args[dimension]))
+                    for dimension in analytics.dimensions
+                    if dimension in request.args)
+                return flask.jsonify(report)
+
+        if app.config['HOOKS_STREAM']:
+            state['stream'] = EventStream()
+
+        # The stream has private payloads in it, so it's only served to
+        # subscribers with the token
+        if app.config['HOOKS_STREAM'] and app.config['HOOKS_STREAM_TOKEN']:
+            check_stream_token = _token_check(app, 'HOOKS_STREAM_TOKEN')
+
+            @app.route(url.rstrip('/') + '/stream')
+            def hook_stream():
+                check_stream_token()
+                return state['stream'].response(
+                    events=request.args.getlist('event') or None,
+                    repositories=request.args.getlist('repo') or None,
+                    buffer=app.config['HOOKS_STREAM_BUFFER'])
+
+        @app.route(url, methods=['POST'])
+        def hook():
+            record = {
+                'time': time.time(),
+                'remote_addr': request.remote_addr,
+                'guid': None,
+                'provider': None,
+                'event': None,
+                'repository': None,
+                'validation': None,
+                'handler': None,
+                'status': 200,
+                'timings': {},
+            }
+            start = time.time()
+            limiter = state.get('limiter')
+            try:
+                if limiter is not None:
+                    limiter.acquire()
+                    try:
+                        return self._handle(app, state, record)
+                    finally:
+                        limiter.release(time.time() - start)
+                return self._handle(app, state, record)
+            except HTTPException as e:
+                record['status'] = e.code
+                if record['validation'] is None:
+                    record['validation'] = e.description
+                raise
+            except Exception:
+                record['status'] = 500
+                raise
+            finally:
+                record['timings']['total'] = _ms_since(start)
+                log = state.get('log')
+                if log is not None:
+                    log.write(record)
+
+    def _handle(self, app, state, record):
+        """Validate the current request, then pass it on to its handler.
+
+        The outcome and timings of each stage are filled in on
+        ``record``.
+        """
+        timings = record['timings']
+        provider = _detect_provider(state['providers'], request.headers)
+        record['provider'] = provider.name
+
+        if app.config['VALIDATE_IP']:
+            start = time.time()
+            allowlist = provider.allowlist()
+            if (allowlist is not None and
+                    request.remote_addr not in allowlist):
+                raise Forbidden('Requests must originate from %s' %
+                                provider.title)
+            timings['validate_ip'] = _ms_since(start)
+
+        payload = _request_payload()
+
+        if app.config['VALIDATE_SIGNATURE']:
+            start = time.time()
+            key = app.config.get(provider.key_config, app.secret_key)
+            provider.verifier(key)(request.headers, payload)
+            timings['validate_signature'] = _ms_since(start)
+
+        event = request.headers.get(provider.event_header)
+        guid = request.headers.get(provider.delivery_header)
+        record['event'] = event
+        record['guid'] = guid
+        if not event:
+            raise BadRequest('Missing header: ' + provider.event_header)
+        elif not guid:
+            raise BadRequest('Missing header: ' + provider.delivery_header)
+
+        start = time.time()
+        if hasattr(request, 'get_json'):
+            # Flask >= 0.10
+            data = request.get_json()
+        else:
+            data = request.json
+        timings['parse'] = _ms_since(start)
+        record['repository'] = provider.repository(data)
+        record['validation'] = 'ok'
+
+        # Every delivery is archived, even if its payload is rejected
+        archive = state.get('archive')
+        if archive is not None:
+            archive.append(guid, event, record['repository'],
+                           _archived_headers(provider, request.headers),
+                           payload)
+
+        # Check the schema before the payload is passed on anywhere
+        handler = self._hooks.get(_hook_key(provider.name, event))
+        if handler is not None and handler.validate is not None:
+            start = time.time()
+            try:
+                handler.validate(data)
+            except BadRequest as e:
+                record['validation'] = e.description
+                raise
+            timings['validate_schema'] = _ms_since(start)
+
+        if data is not None:
+            for target in self._relays:
+                target.send(event, guid, payload, provider)
+            stream = state.get('stream')
+            if stream is not None:
+                stream.publish(event, guid, record['repository'], payload)
+
+        analytics = state.get('analytics')
+        if analytics is not None:
+            analytics.add(record['repository'], provider.sender(data), event,
+                          len(payload))
+
+        if handler is None:
+            record['handler'] = 'unhandled'
+            return 'Hook not used\n'
+
+        start = time.time()
+        scheduler = state.get('scheduler')
+        if scheduler is not None:
+            # The request thread is let go straight away, so that the
+            # queues see every delivery, not just the ones that have a
+            # request thread to wait on
+            job = _with_app_context(app, self._run_queued)
+            try:
+                scheduler.submit(handler.priority, job, app, state, handler,
+                                 data, guid, payload, event)
+            finally:
+                timings['handler'] = _ms_since(start)
+            record['handler'] = 'queued'
+            return 'Queued\n', 202
+
+        try:
+            rv = self._run_handler(app, state, handler, data, guid, payload)
+        except Exception as e:
+            record['handler'] = 'error'
+            if not self._retry(app, state, handler, data, guid, payload,
+                               event, e):
+                raise
+            record['handler'] = 'retrying'
+            return 'Handler failed, will retry\n', 202
+        finally:
+            timings['handler'] = _ms_since(start)
+        record['handler'] = 'ok'
+        return rv
+
+    def _run_queued(self, app, state, handler, data, guid, body, event):
+        """Call a handler that was queued on the scheduler.
+
+        There's no one left to answer, so errors are retried or logged.
+        """
+        try:
+            handler(data, guid, body)
+        except Exception as e:
+            if not self._retry(app, state, handler, data, guid, body, event,
+                               e):
+                app.logger.exception('The %s handler failed on delivery %s',
+                                     event, guid)
+
+    def _retry(self, app, state, handler, data, guid, body, event, error):
+        """Schedule a failed handler to be called again later.
+
+        Return ``False`` if it won't be, because there are no retries,
+        the error was the sender's, or it's in the dead letters now.
+        """
+        retries = state.get('retries')
+        if (retries is None or
+                (isinstance(error, HTTPException) and error.code < 500)):
+            return False
+
+        def retry(data, guid):
+            return self._run_handler(app, state, handler, data, guid, body)
+        return retries.schedule(_with_app_context(app, retry), data, guid,
+                                event=event, error=error)
+
+    def _run_handler(self, app, state, handler, data, guid, body):
+        """Call a handler in the current thread, or on an executor.
+
+        This is used for retries too, outside of the request.
+        """
+        scheduler = state.get('scheduler')
+        lanes = state.get('lanes')
+        if lanes is not None:
+            key = _lookup(data, app.config['HOOKS_LANE_KEY'])
+            future = lanes.submit(guid if key is None else key,
+                                  _with_request_context(handler),
+                                  data, guid, body)
+        elif scheduler is not None:
+            future = scheduler.submit(handler.priority,
+                                      _with_request_context(handler),
+                                      data, guid, body)
+        else:
+            return handler(data, guid, body)
+        return future.result()
+
+    def register_hook(self, hook_name, fn, provider='github',
+                      priority='normal', process=False, timeout=None,
+                      max_concurrency=None, failure_threshold=None,
+                      reset_timeout=30, schema=None):
+        """Register a function to be called on a GitHub event.
+
+        :param hook_name: the event to handle
+        :param fn: the function, called with the payload and the GUID
+        :param provider: the name of the :class:`Provider` sending the
+                         event
+        :param priority: the scheduling class, one of the keys of
+                         ``HOOKS_PRIORITY_WEIGHTS``, see
+                         :class:`PriorityScheduler`
+        :param process: run the function in a worker process, see
+                        :class:`ProcessPool`
+        :param timeout: seconds to wait for the function before giving
+                        up with a 504
+        :param max_concurrency: number of calls that may run at once,
+                                further deliveries get a 503
+        :param failure_threshold: consecutive failures or timeouts after
+                                  which deliveries get a 503 straight
+                                  away
+        :param reset_timeout: seconds to keep failing fast before
+                              letting a trial delivery through
+        :param schema: a JSON Schema that payloads must match, or they
+                       get a 400 before the function is called, see
+                       :func:`compile_schema`
+        """
+        key = _hook_key(provider, hook_name)
+        if self._weights is not None:
+            _check_priority(key, priority, self._weights)
+        validate = None
+        if schema is not None:
+            validate = compile_schema(schema)
+        with self._lock:
+            hooks = self._staging
+            if hooks is None:
+                hooks = dict(self._hooks)
+            if key in hooks:
+                raise Exception('%s hook already registered' % key)
+            breaker = None
+            if failure_threshold is not None:
+                breaker = CircuitBreaker(failure_threshold, reset_timeout)
+            hooks[key] = _Handler(fn, priority=priority, process=process,
+                                  timeout=timeout,
+                                  max_concurrency=max_concurrency,
+                                  breaker=breaker, validate=validate)
+            if self._staging is None:
+                self._hooks = hooks
+
+    def hook(self, hook_name, **options):
+        """A decorator that's used to register a new hook handler.
+
+        :param hook_name: the event to handle
+        :param options: passed on to :meth:`register_hook`
+        """
+        def wrapper(fn):
+            self.register_hook(hook_name, fn, **options)
+            return fn
+        return wrapper
+
+    def relay(self, url, **options):
+        """Forward every validated JSON delivery to another URL.
+
+        :param url: the downstream URL to post deliveries to
+        :param options: passed on to :class:`RelayTarget`
+        :return: the new :class:`RelayTarget`
+        """
+        target = RelayTarget(url, **options)
+        self._relays.append(target)
+        return target
+
+    def reload(self, app=None):
+        """Reload handlers and secrets without restarting.
+
+        The modules in ``HOOKS_RELOAD_MODULES`` are imported again, and
+        the handlers they register replace the ones they registered
+        before. The file in ``HOOKS_RELOAD_CONFIG`` is read again, and
+        verifiers are built for any new keys. It's all done off to the
+        side and swapped in at the end, so deliveries already being
+        handled finish with the old handlers, and nothing changes if a
+        module or the config fails to load.
+
+        :param app: the :class:`~flask.Flask` instance to reload the
+                    config of, by default the current app
+        """
+        if app is None:
+            app = flask.current_app._get_current_object()
+        state = app.extensions['hookserver']
+        with self._lock:
+            config = app.config
+            if app.config['HOOKS_RELOAD_CONFIG']:
+                config = flask.Config(app.config.root_path, app.config)
+                config.from_pyfile(app.config['HOOKS_RELOAD_CONFIG'])
+            enabled = _resolve_providers(config['HOOKS_PROVIDERS'])
+            _warm_verifiers(config, enabled)
+
+            names = config['HOOKS_RELOAD_MODULES']
+            self._staging = dict(
+                (key, handler) for key, handler in self._hooks.items()
+                if handler.module not in names)
+            try:
+                for name in names:
+                    _import_fresh(name)
+                hooks = self._staging
+            finally:
+                self._staging = None
+
+            if config is not app.config:
+                app.config.update(config)
+            state['providers'] = enabled
+            self._hooks = hooks
+
+    def handler_stats(self):
+        """Return the call counters and breaker state of every handler.
+
+        GitHub handlers are listed by event name, and handlers for other
+        providers as ``provider:event``.
+        """
+        return dict((name, handler.stats())
+                    for name, handler in self._hooks.items())
+
+
+def _check_priority(key, priority, weights):
+    """Raise :exc:`ValueError` if a handler's priority has no weight."""
+    if priority not in weights:
+        raise ValueError('%s hook has priority %r, which isn\'t in '
+                         'HOOKS_PRIORITY_WEIGHTS (%s)' %
+                         (key, priority, ', '.join(sorted(weights))))
+
+
+class CircuitBreaker(object):
+
+    """Fail fast once a handler keeps failing.
+
+    After ``failure_threshold`` consecutive failures the breaker opens
+    and :meth:`allow` returns ``False``. Once ``reset_timeout`` seconds
+    have passed it is half-open: a single trial call is let through,
+    and its outcome closes or re-opens the breaker.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        """Start out closed."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._state = self.CLOSED
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """One of ``'closed'``, ``'open'`` or ``'half-open'``."""
+        if (self._state == self.OPEN and
+                time.time() - self.opened_at >= self.reset_timeout):
+            return self.HALF_OPEN
+        return self._state
+
+    def allow(self):
+        """Return whether a call may go ahead."""
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial:
+                self._state = self.HALF_OPEN
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        """Close the breaker."""
+        with self._lock:
+            self.failures = 0
+            self._state = self.CLOSED
+            self._trial = False
+
+    def record_failure(self):
+        """Count a failure, opening the breaker if there are too many."""
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self.opened_at = time.time()
+                self._trial = False
+
+
+class _Handler(object):
+
+    """A registered hook function, along with its execution limits."""
+
+    def __init__(self, fn, priority='normal', process=False, timeout=None,
+                 max_concurrency=None, breaker=None, validate=None):
+        self.fn = fn
+        self.validate = validate
+        self.module = getattr(fn, '__module__', None)
+        self.priority = priority
+        self.process = process
+        self.timeout = timeout
+        self.breaker = breaker
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.active = 0
+        self._lock = threading.Lock()
+        self._semaphore = None
+        if max_concurrency is not None:
+            self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def __call__(self, data, guid, body=None):
+        """Call the function, within the limits.
+
+        :param body: the raw body, for handlers run in a process. By
+                     default the payload is encoded again.
+        """
+        if self._semaphore is not None and not self._semaphore.acquire(False):
+            self._count('rejected')
+            raise ServiceUnavailable('Too many concurrent deliveries')
+        if self.breaker is not None and not self.breaker.allow():
+            if self._semaphore is not None:
+                self._semaphore.release()
+            self._count('rejected')
+            raise ServiceUnavailable('Handler is failing, try again later')
+
+        self._count('calls')
+        try:
+            if self.timeout is None:
+                rv = self._invoke(data, guid, body)
+            else:
+                rv = self._invoke_with_timeout(data, guid, body)
+        except Exception as e:
+            if not isinstance(e, HTTPException) or e.code >= 500:
+                self._count('failures')
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+            elif self.breaker is not None:
+                self.breaker.record_success()
+            raise
+        if self.breaker is not None:
+            self.breaker.record_success()
+        return rv
+
+    def _invoke(self, data, guid, body):
+        with self._lock:
+            self.active += 1
+        try:
+            if self.process:
+                state = flask.current_app.extensions['hookserver']
+                if 'process_pool' not in state:
+                    raise RuntimeError('HOOKS_PROCESSES must be set to run '
+                                       'handlers in processes')
+                if body is None:
+                    body = json.dumps(data).encode('utf-8')
+                return state['process_pool'].call(self.fn, body, guid,
+                                                  timeout=self.timeout)
+            return self.fn(data, guid)
+        finally:
+            with self._lock:
+                self.active -= 1
+            # A timed out call holds on to its slot until it's done
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def _invoke_with_timeout(self, data, guid, body):
+        call = _Future()
+        thread = threading.Thread(target=_with_request_context(call.run),
+                                  args=(self._invoke, data, guid, body))
+        thread.daemon = True
+        thread.start()
+        thread.join(self.timeout)
+
+        if not call.done():
+            self._count('timeouts')
+            raise _TimedOut(call)
+        return call.result()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        """Return the counters and breaker state as a dict."""
+        with self._lock:
+            stats = {
+                'calls': self.calls,
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+                'rejected': self.rejected,
+                'active': self.active,
+            }
+        if self.breaker is not None:
+            stats['breaker'] = self.breaker.state
+        return stats
+
+
+class _TimedOut(GatewayTimeout):
+
+    """A 504 for a handler call that's still running."""
+
+    description = 'Handler timed out'
+
+    def __init__(self, call):
+        GatewayTimeout.__init__(self)
+        #: The :class:`_Future` of the call
+        self.call = call
+
+
+class ConcurrencyLimiter(object):
+
+    """Limit the deliveries in flight, adapting the limit to latency.
+
+    The limit follows additive-increase, multiplicative-decrease: each
+    delivery that finishes within ``latency_target`` seconds raises the
+    limit by ``1 / limit``, so by about one for every ``limit``
+    deliveries, and each one that takes longer multiplies it by
+    ``backoff``. Deliveries over the limit are turned away straight away
+    with a 503, so the ones that were let in can still finish in time.
+
+    :param initial: the starting limit
+    :param latency_target: seconds a delivery should take at most
+    :param min_limit: the limit never goes below this
+    :param max_limit: the limit never goes above this
+    :param backoff: factor to shrink the limit by after a slow delivery
+    :param retry_after: seconds to ask rejected senders to wait, sent as
+                        ``Retry-After``
+    """
+
+    def __init__(self, initial, latency_target=5.0, min_limit=1,
+                 max_limit=1000, backoff=0.9, retry_after=1):
+        """Start at the initial limit."""
+        self.limit = float(initial)
+        self.latency_target = latency_target
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.accepted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Count a delivery as in flight, or raise a 503 if over the limit."""
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.rejected += 1
+                raise _Overloaded(self.retry_after)
+            self.in_flight += 1
+            self.accepted += 1
+
+    def release(self, latency):
+        """Count a delivery as done, and adjust the limit by its latency."""
+        with self._lock:
+            self.in_flight -= 1
+            if latency > self.latency_target:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def stats(self):
+        """Return the current limit and counters."""
+        with self._lock:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+            }
+
+
+class _Overloaded(ServiceUnavailable):
+
+    """A 503 with a ``Retry-After`` header."""
+
+    description = 'Too many deliveries in flight, try again later'
+
+    def __init__(self, retry_after):
+        ServiceUnavailable.__init__(self)
+        self.retry_after = retry_after
+
+    def get_headers(self, *args, **kwargs):
+        headers = ServiceUnavailable.get_headers(self, *args, **kwargs)
+        headers.append(('Retry-After', str(self.retry_after)))
+        return headers
+
+
+class PriorityScheduler(object):
+
+    """Run handlers on a pool of worker threads, by priority class.
+
+    Each class has its own queue. Workers share their time between the
+    queues in proportion to the class weights (stride scheduling), so a
+    flood of deliveries in one class delays the others by at most its
+    share, and no class is starved.
+
+    :param workers: number of worker threads
+    :param weights: a dict of class name to weight, defaults to
+                    :attr:`default_weights`
+    :param queue_size: calls waiting in a class before new ones get a
+                       503, or ``None`` for no limit
+    """
+
+    #: ``critical`` gets ten times the share of ``bulk``.
+    default_weights = {'critical': 10, 'normal': 4, 'bulk': 1}
+
+    def __init__(self, workers, weights=None, queue_size=None):
+        """Start the worker threads."""
+        self.weights = dict(weights or self.default_weights)
+        self.queue_size = queue_size
+        self._queues = dict((name, deque()) for name in self.weights)
+        self._pass = dict((name, 0.0) for name in self.weights)
+        self._vtime = 0.0
+        self._stats = dict((name, {'completed': 0, 'queue_time': 0.0,
+                                   'max_queue_time': 0.0})
+                           for name in self.weights)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, priority, fn, *args):
+        """Queue ``fn(*args)`` in a class, returning a future."""
+        if priority not in self.weights:
+            raise ValueError('Unknown priority class %s' % priority)
+        future = _Future()
+        with self._cond:
+            q = self._queues[priority]
+            if self.queue_size is not None and len(q) >= self.queue_size:
+                raise ServiceUnavailable('Too many queued deliveries')
+            if not q:
+                # An idle class doesn't get to bank its unused share
+                self._pass[priority] = max(self._pass[priority],
+                                           self._vtime)
+            q.append((time.time(), future, fn, args))
+            self._cond.notify()
+        return future
+
+    def shutdown(self):
+        """Stop the workers once the queues are empty."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """Return the queue length and queue times of every class."""
+        with self._cond:
+            stats = {}
+            for name, s in self._stats.items():
+                completed = s['completed']
+                stats[name] = {
+                    'queued': len(self._queues[name]),
+                    'completed': completed,
+                    'avg_queue_time': (s['queue_time'] / completed
+                                       if completed else 0.0),
+                    'max_queue_time': s['max_queue_time'],
+                }
+            return stats
+
+    def _next(self):
+        """Pop the next job. Called with the lock held."""
+        ready = [(self._pass[name], -self.weights[name], name)
+                 for name, q in self._queues.items() if q]
+        if not ready:
+            return None
+        best = min(ready)[2]
+        self._vtime = self._pass[best]
+        self._pass[best] += 1.0 / self.weights[best]
+        queued_at, future, fn, args = self._queues[best].popleft()
+
+        waited = time.time() - queued_at
+        s = self._stats[best]
+        s['completed'] += 1
+        s['queue_time'] += waited
+        s['max_queue_time'] = max(s['max_queue_time'], waited)
+        return future, fn, args
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = self._next()
+                while job is None:
+                    if self._stopped:
+                        return
+                    self._cond.wait()
+                    job = self._next()
+            future, fn, args = job
+            future.run(fn, *args)
+
+
+class ShardedExecutor(object):
+
+    """Run handlers on single-threaded lanes, picked by a key.
+
+    Calls with the same key always go to the same lane, so they run one
+    at a time in the order they were submitted, while calls with other
+    keys run in parallel on the other lanes.
+
+    :param lanes: number of lanes, each with its own thread
+    :param queue_size: calls waiting in a lane before new ones get a 503
+    """
+
+    def __init__(self, lanes, queue_size=100):
+        """Start a thread for every lane."""
+        self._queues = []
+        self._threads = []
+        self._completed = [0] * lanes
+        for i in range(lanes):
+            q = queue.Queue(queue_size)
+            thread = threading.Thread(target=self._run, args=(i, q))
+            thread.daemon = True
+            thread.start()
+            self._queues.append(q)
+            self._threads.append(thread)
+
+    def lane(self, key):
+        """Return the index of the lane for a key."""
+        if not isinstance(key, bytes):
+            key = type(u'')(key).encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) % len(self._queues)
+
+    def submit(self, key, fn, *args):
+        """Queue ``fn(*args)`` on the key's lane, returning a future."""
+        future = _Future()
+        try:
+            self._queues[self.lane(key)].put_nowait((future, fn, args))
+        except queue.Full:
+            raise ServiceUnavailable('Too many queued deliveries')
+        return future
+
+    def shutdown(self):
+        """Stop the lanes once they're empty."""
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """Return the depth and number of completed calls of each lane."""
+        return [{'queued': q.qsize(), 'completed': completed}
+                for q, completed in zip(self._queues, self._completed)]
+
+    def _run(self, i, q):
+        while True:
+            job = q.get()
+            if job is None:
+                return
+            future, fn, args = job
+            future.run(fn, *args)
+            self._completed[i] += 1
+
+
+class ProcessPool(object):
+
+    """Run handlers in worker processes, passing the raw body in memory.
+
+    A shared memory area is set up before the workers are forked, and
+    split into ``buffers`` buffers of ``buffer_size`` bytes each. To
+    call a handler, the raw body is copied into a free buffer and only
+    the buffer's number is sent to a worker, which decodes the JSON
+    itself. Nothing is pickled but the function, the GUID and the
+    handler's return value, and the memory used never grows.
+
+    When every buffer is in use, calls wait up to ``timeout`` seconds
+    for one to be free, then give up with a 503. Bodies bigger than a
+    buffer are pickled and sent the usual way. A call that gets no
+    answer within ``call_timeout`` seconds, because the handler is stuck
+    or its worker died, gives up with a 504.
+
+    The workers are started on the first call, or by :meth:`start`, so
+    that handlers defined after the pool was created are there in the
+    workers too. By then the extension's own threads are running, and a
+    child forked from this process could inherit a lock one of them
+    holds, so the workers are started with the ``spawn`` method instead,
+    and the shared memory is a file under ``/dev/shm`` they map
+    themselves. Handlers must be importable functions, so that the
+    workers can import them. This isn't available on Windows.
+
+    :param processes: number of worker processes
+    :param buffer_size: size in bytes of each buffer
+    :param buffers: number of buffers, twice the processes by default
+    :param timeout: seconds to wait for a free buffer
+    :param call_timeout: seconds to wait for a worker to answer
+    """
+
+    def __init__(self, processes, buffer_size=1024 * 1024, buffers=None,
+                 timeout=10, call_timeout=60):
+        """Set up the pool, without starting anything yet."""
+        self.processes = processes
+        self.buffer_size = buffer_size
+        self.buffers = buffers or 2 * processes
+        self.timeout = timeout
+        self.call_timeout = call_timeout
+        self.calls = 0
+        self.oversize = 0
+        self.lost = 0
+
+        # Each buffer starts with a stamp, so that a call that only starts
+        # after it was given up on can tell its buffer has been reused
+        self._slot_size = 8 + self.buffer_size
+        self._path = None
+        self._arena = None
+        self._stamp = 0
+        self._free = queue.Queue()
+        for i in range(self.buffers):
+            self._free.put(i)
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def start(self):
+        """Start the workers, if they haven't been already."""
+        import mmap
+        import multiprocessing
+        import tempfile
+
+        with self._lock:
+            if self._pool is None:
+                size = self._slot_size * self.buffers
+                fd, self._path = tempfile.mkstemp(
+                    prefix='hookserver-', dir='/dev/shm' if os.path.isdir(
+                        '/dev/shm') else None)
+                try:
+                    os.ftruncate(fd, size)
+                    self._arena = mmap.mmap(fd, size)
+                finally:
+                    os.close(fd)
+                if hasattr(multiprocessing, 'get_context'):
+                    # Python >= 3.4; Python 2 can only fork
+                    multiprocessing = multiprocessing.get_context('spawn')
+                self._pool = multiprocessing.Pool(
+                    self.processes, initializer=_init_worker_process,
+                    initargs=(self._path, size, self._slot_size))
+            return self._pool
+
+    def call(self, fn, body, guid, timeout=None):
+        """Call ``fn(data, guid)`` in a worker, and return its result.
+
+        :param fn: an importable function
+        :param body: the raw JSON body
+        :param guid: the delivery's GUID
+        :param timeout: seconds to wait for the answer, by default
+                        ``call_timeout``
+        """
+        pool = self.start()
+        with self._lock:
+            self.calls += 1
+        if len(body) > self.buffer_size:
+            with self._lock:
+                self.oversize += 1
+            return self._wait(pool.apply_async(
+                _process_call, (None, None, body, fn, guid)), timeout)
+
+        try:
+            i = self._free.get(timeout=self.timeout)
+        except queue.Empty:
+            raise ServiceUnavailable('No buffers free for the handler')
+        try:
+            with self._lock:
+                self._stamp += 1
+                stamp = self._stamp
+            offset = i * self._slot_size
+            self._arena[offset:offset + 8] = struct.pack('>Q', stamp)
+            self._arena[offset + 8:offset + 8 + len(body)] = body
+            return self._wait(pool.apply_async(
+                _process_call, (i, stamp, len(body), fn, guid)), timeout)
+        finally:
+            self._free.put(i)
+
+    def close(self):
+        """Stop the workers and release the buffers."""
+        if self._pool is not None:
+            if self.lost:
+                # The pool would wait for the lost calls for good
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+            # Let its semaphores go, even if the process ends with
+            # os._exit()
+            self._pool = None
+        if self._arena is not None:
+            self._arena.close()
+            self._arena = None
+            os.remove(self._path)
+
+    def stats(self):
+        """Return the number of calls, and of buffers in use."""
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'oversize': self.oversize,
+                'lost': self.lost,
+                'buffers': self.buffers,
+                'buffers_in_use': self.buffers - self._free.qsize(),
+            }
+
+    def _wait(self, result, timeout):
+        import multiprocessing
+
+        try:
+            return result.get(self.call_timeout if timeout is None
+                              else timeout)
+        except multiprocessing.TimeoutError:
+            with self._lock:
+                self.lost += 1
+            raise GatewayTimeout('Handler process didn\'t answer')
+
+
+# The shared memory area, in a ProcessPool worker
+_worker_arena = None
+_worker_slot_size = None
+
+
+def _init_worker_process(path, size, slot_size):
+    global _worker_arena, _worker_slot_size
+    import mmap
+
+    # Calls still running when the server is stopped are finished
+    # before the pool is closed, so a signal sent to the server's whole
+    # process group isn't for the workers
+    os.setpgrp()
+    with open(path, 'r+b') as f:
+        _worker_arena = mmap.mmap(f.fileno(), size)
+    _worker_slot_size = slot_size
+
+
+def _process_call(i, stamp, body, fn, guid):
+    """Decode a body and call a handler with it, in a worker process.
+
+    If ``i`` is a buffer number, ``body`` is the length of the body in
+    that buffer, and ``stamp`` what the buffer should be stamped with.
+    """
+    if i is not None:
+        offset = i * _worker_slot_size
+        body = _worker_arena[offset + 8:offset + 8 + body]
+        # The stamp is written before the body, so if it's unchanged
+        # after the copy, so is the body
+        if struct.unpack('>Q', _worker_arena[offset:offset + 8])[0] != stamp:
+            raise RuntimeError('The call was given up on before it started')
+    return fn(json.loads(body.decode('utf-8')), guid)
+
+
+class TimingWheel(object):
+
+    """A hierarchical timing wheel.
+
+    Timers are dropped into slots by how many ticks away they are, so
+    adding one is O(1), and each tick only looks at one slot. Timers too
+    far away for the first wheel go into a coarser one, and are moved
+    down a level each time the wheel below comes round.
+
+    The wheel doesn't keep time itself: call :meth:`advance` once every
+    ``tick`` seconds.
+
+    :param tick: seconds per tick
+    :param wheel_size: slots in each wheel
+    :param levels: number of wheels; with the defaults, timers can be up
+                   to ``0.1 * 64 ** 4`` seconds (19 days) away
+    """
+
+    def __init__(self, tick=0.1, wheel_size=64, levels=4):
+        """Start at tick 0 with no timers."""
+        self.tick = tick
+        self.wheel_size = wheel_size
+        self.levels = levels
+        self.now = 0
+        self._wheels = [[[] for i in range(wheel_size)]
+                        for level in range(levels)]
+        self._count = 0
+
+    def __len__(self):
+        """Return the number of pending timers."""
+        return self._count
+
+    def schedule(self, delay, item):
+        """Have ``item`` returned by :meth:`advance` in ``delay`` seconds.
+
+        Delays are rounded up to a whole tick, and down to the longest
+        the wheels can hold.
+        """
+        ticks = max(1, int(math.ceil(delay / float(self.tick))))
+        ticks = min(ticks, self.wheel_size ** self.levels - 1)
+        self._add(self.now + ticks, item)
+        self._count += 1
+
+    def advance(self):
+        """Move forward a tick, and return the items that are now due."""
+        self.now += 1
+        # Move timers down from the wheels that just came round
+        for level in range(1, self.levels):
+            span = self.wheel_size ** level
+            if self.now % span:
+                break
+            slot = self._wheels[level][(self.now // span) % self.wheel_size]
+            timers = list(slot)
+            del slot[:]
+            for due, item in timers:
+                self._add(due, item)
+
+        slot = self._wheels[0][self.now % self.wheel_size]
+        due = [item for _, item in slot]
+        del slot[:]
+        self._count -= len(due)
+        return due
+
+    def _add(self, due, item):
+        delta = due - self.now
+        level = 0
+        while delta >= self.wheel_size ** (level + 1):
+            level += 1
+        span = self.wheel_size ** level
+        self._wheels[level][(due // span) % self.wheel_size].append(
+            (due, item))
+
+
+class RetryScheduler(object):
+
+    """Retry failed handler calls later.
+
+    Each retry waits twice as long as the one before, starting at
+    ``base_delay`` and up to ``max_delay`` seconds, less a random amount
+    of up to ``jitter`` of the delay, so that a burst of failures isn't
+    retried all at once. Pending retries are kept in a
+    :class:`TimingWheel`, and run on a few worker threads when due.
+
+    A call that has failed ``max_attempts`` times, counting the first,
+    is put in :attr:`dead_letters` instead.
+
+    :param max_attempts: most times to call the handler
+    :param base_delay: seconds before the first retry
+    :param max_delay: most seconds between retries
+    :param jitter: fraction of each delay to randomly take off
+    :param tick: seconds between checks for due retries
+    :param workers: number of threads to run retries on
+    :param dead_letters: number of dead letters to keep
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=600.0,
+                 jitter=0.5, tick=0.1, workers=2, dead_letters=1000):
+        """Start the timer and worker threads."""
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.tick = tick
+        #: The calls that failed every attempt, newest last. Each is a
+        #: dict with the ``guid``, ``event``, ``attempts`` and last
+        #: ``error``.
+        self.dead_letters = deque(maxlen=dead_letters)
+        self.scheduled = 0
+        self.succeeded = 0
+        self.failed = 0
+
+        # Calls that timed out, and are still running
+        self._running = 0
+        self._wheel = TimingWheel(tick)
+        self._lock = threading.Lock()
+        self._due = queue.Queue()
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._run_timer)]
+        for i in range(workers):
+            self._threads.append(threading.Thread(target=self._run_worker))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def delay(self, attempt):
+        """Return the seconds to wait after the ``attempt``-th failure."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def schedule(self, fn, data, guid, event=None, attempt=1, error=None):
+        """Retry ``fn(data, guid)``, which has failed ``attempt`` times.
+
+        If the call timed out, and is still running, nothing is done
+        until it finishes, so that it's never running twice at once. If
+        it then succeeds, it isn't retried.
+
+        Return ``False`` if it's been put in the dead letters instead.
+        """
+        if isinstance(error, _TimedOut) and attempt < self.max_attempts:
+            with self._lock:
+                self._running += 1
+
+            def finished(call):
+                # Only retries are counted, not the first call
+                retried = 1 if attempt > 1 else 0
+                try:
+                    call.result()
+                except Exception as e:
+                    with self._lock:
+                        self._running -= 1
+                        self.failed += retried
+                    self.schedule(fn, data, guid, event, attempt, e)
+                else:
+                    with self._lock:
+                        self._running -= 1
+                        self.succeeded += retried
+            error.call.add_done_callback(finished)
+            return True
+        if attempt >= self.max_attempts:
+            with self._lock:
+                self.dead_letters.append({
+                    'guid': guid,
+                    'event': event,
+                    'attempts': attempt,
+                    'error': repr(error),
+                    'time': time.time(),
+                })
+            return False
+        with self._lock:
+            self.scheduled += 1
+            self._wheel.schedule(self.delay(attempt),
+                                 (fn, data, guid, event, attempt + 1))
+        return True
+
+    def shutdown(self):
+        """Stop the threads. Pending retries are dropped."""
+        self._stopped = True
+        for thread in self._threads[1:]:
+            self._due.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """Return the numbers of pending, finished and dead retries."""
+        with self._lock:
+            return {
+                'pending': (len(self._wheel) + self._due.qsize() +
+                            self._running),
+                'scheduled': self.scheduled,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'dead': len(self.dead_letters),
+            }
+
+    def _run_timer(self):
+        next_tick = time.time()
+        while not self._stopped:
+            next_tick += self.tick
+            time.sleep(max(0, next_tick - time.time()))
+            with self._lock:
+                due = self._wheel.advance()
+            for item in due:
+                self._due.put(item)
+
+    def _run_worker(self):
+        while True:
+            item = self._due.get()
+            if item is None:
+                return
+            fn, data, guid, event, attempt = item
+            try:
+                fn(data, guid)
+            except _TimedOut as e:
+                # Counted once the call has finished
+                self.schedule(fn, data, guid, event, attempt, e)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                self.schedule(fn, data, guid, event, attempt, e)
+            else:
+                with self._lock:
+                    self.succeeded += 1
+
+
+class _Future(object):
+
+    """The result of a call that runs on another thread."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def run(self, fn, *args):
+        """Call the function and keep its result or exception."""
+        try:
+            self._value = fn(*args)
+        except Exception as e:
+            self._error = e
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, None
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, fn):
+        """Call ``fn(future)`` once the call has finished.
+
+        If it already has, ``fn`` is called straight away.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def done(self):
+        """Return whether the call has finished."""
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish, then return or raise its result."""
+        if not self._done.wait(timeout):
+            raise GatewayTimeout('Handler timed out')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+def _with_app_context(app, fn):
+    """Let a function that runs outside of a request see the app."""
+    def inner(*args, **kwargs):
+        with app.app_context():
+            return fn(*args, **kwargs)
+    return inner
+
+
+def _with_request_context(fn):
+    """Let a function that runs on another thread see the request, or
+    just the app outside of a request."""
+    if (hasattr(flask, 'copy_current_request_context') and
+            flask.has_request_context()):
+        # Flask >= 0.10
+        return flask.copy_current_request_context(fn)
+    if flask.has_app_context():
+        return _with_app_context(flask.current_app._get_current_object(), fn)
+    return fn
+
+
+def _import_fresh(name):
+    """Import a module, running its code again if it's been imported."""
+    import importlib
+    import sys
+
+    module = sys.modules.get(name)
+    if module is None:
+        return importlib.import_module(name)
+    try:
+        return importlib.reload(module)
+    except AttributeError:  # pragma: no cover
+        # Python 2
+        return reload(module)  # noqa: F821
+
+
+class Reloader(object):
+
+    """Call :meth:`Hooks.reload` on a signal, or when files change.
+
+    Reloads happen on a background thread rather than in the signal
+    handler, so one can't start while the interrupted code holds a lock.
+    A reload that fails is logged, and the old handlers and secrets stay
+    in use.
+
+    :param hooks: the :class:`Hooks` to reload
+    :param app: the :class:`~flask.Flask` instance it's registered on
+    :param interval: seconds between checking whether the reload config
+                     or modules have changed on disk
+    :param signum: the signal, or its name, that triggers a reload
+    """
+
+    def __init__(self, hooks, app, interval=None, signum=None):
+        """Install the signal handler and start watching."""
+        self.hooks = hooks
+        self.app = app
+        self.interval = interval
+        self.reloads = 0
+        self.failures = 0
+        self._event = threading.Event()
+        self._closed = False
+        self._mtimes = self._stat()
+        if signum is not None:
+            import signal
+            if not isinstance(signum, int):
+                signum = getattr(signal, signum)
+            signal.signal(signum, lambda signum, frame: self.trigger())
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def trigger(self):
+        """Reload as soon as possible."""
+        self._event.set()
+
+    def close(self):
+        """Stop watching for changes."""
+        self._closed = True
+        self._event.set()
+        self._thread.join()
+
+    def stats(self):
+        """Return the number of reloads that worked and that failed."""
+        return {'reloads': self.reloads, 'failures': self.failures}
+
+    def _paths(self):
+        import sys
+
+        config = self.app.config
+        paths = []
+        if config['HOOKS_RELOAD_CONFIG']:
+            paths.append(os.path.join(config.root_path,
+                                      config['HOOKS_RELOAD_CONFIG']))
+        for name in config['HOOKS_RELOAD_MODULES']:
+            path = getattr(sys.modules.get(name), '__file__', None)
+            if path is not None:
+                if path.endswith(('.pyc', '.pyo')):
+                    path = path[:-1]
+                paths.append(path)
+        return paths
+
+    def _stat(self):
+        mtimes = {}
+        for path in self._paths():
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def _run(self):
+        while True:
+            triggered = self._event.wait(self.interval)
+            self._event.clear()
+            if self._closed:
+                return
+            mtimes = self._stat()
+            if not triggered and mtimes == self._mtimes:
+                continue
+            try:
+                self.hooks.reload(self.app)
+            except Exception:
+                self.failures += 1
+                self.app.logger.exception('Reloading hooks failed')
+            else:
+                self.reloads += 1
+            # Don't retry a broken file until it changes again
+            self._mtimes = self._stat()
+
+
+class DeliveryArchive(object):
+
+    """Append raw deliveries to compressed, rotating segment files.
+
+    Every delivery is compressed on its own, so a lookup only has to
+    decompress the records it returns. A text index of every segment's
+    deliveries is appended to next to it. Once a segment is finished, a
+    key file is written too, sorted by hashes of the GUID, event and
+    repository, then by timestamp, so lookups in it are a binary search
+    on disk. Only the segments still being written are scanned, and
+    nothing but a list of the segments is kept in memory.
+
+    Writes are queued and done by a background thread. If the queue is
+    full the delivery is dropped and counted in :attr:`dropped`, and if
+    it can't be written, for instance because the disk is full, it's
+    counted in :attr:`lost`, and the next one starts a new segment.
+
+    Several processes can share a directory. Each instance only appends
+    to segments named after itself, and lookups first pick up what the
+    others have written, or deleted, since the last one.
+
+    :param path: directory to keep the segments in
+    :param segment_size: start a new segment after this many bytes
+    :param segment_age: start a new segment after this many seconds
+    :param max_bytes: delete the oldest segments above this total size
+    :param max_age: delete segments whose newest delivery is older than
+                    this many seconds
+    :param queue_size: number of deliveries waiting to be written
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, segment_age=None,
+                 max_bytes=None, max_age=None, queue_size=1000):
+        """List the existing segments and start the writer thread."""
+        self.path = path
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.dropped = 0
+        self.lost = 0
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(queue_size)
+        self._writer = '%d-%08x' % (os.getpid(), random.getrandbits(32))
+        # Each segment is [name, size, created, newest], oldest first
+        self._segments = []
+        # Segments written by this instance, and the one being written
+        self._own = set()
+        self._current = None
+        self._seg_file = None
+        self._idx_file = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with self._lock:
+            self._load()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, guid, event, repository, headers, body, timestamp=None):
+        """Queue a delivery to be written. Never blocks."""
+        if timestamp is None:
+            timestamp = time.time()
+        item = (timestamp, guid, event, repository or '', headers, body)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Block until every queued delivery has been written."""
+        self._queue.join()
+
+    def close(self):
+        """Write out the queue, then stop the writer thread."""
+        # Waits for room in the queue, which the writer always makes
+        self._queue.put(None)
+        self._thread.join()
+        self._close_segment()
+
+    def get(self, guid):
+        """Return the most recent delivery with a GUID, or ``None``."""
+        for entry in sorted(self._lookup('guid', guid), reverse=True):
+            record = self._read(*entry[1:])
+            # Other GUIDs may have the same hash
+            if record is not None and record['guid'] == guid:
+                return record
+        return None
+
+    def find(self, event=None, repository=None, since=None, until=None):
+        """Return deliveries matching every given filter, oldest first.
+
+        :param event: the GitHub event name
+        :param repository: the repository's full name, ``owner/repo``
+        :param since: earliest timestamp, inclusive
+        :param until: latest timestamp, inclusive
+        """
+        if repository is not None:
+            entries = self._lookup('repository', repository, since, until)
+        elif event is not None:
+            entries = self._lookup('event', event, since, until)
+        else:
+            entries = self._lookup(None, None, since, until)
+        records = []
+        for entry in sorted(entries):
+            record = self._read(*entry[1:])
+            if (record is not None and
+                    event in (None, record['event']) and
+                    repository in (None, record['repository'])):
+                records.append(record)
+        return records
+
+    def _lookup(self, field, value, since=None, until=None):
+        """Return a set of ``(timestamp, segment, offset, length)`` for
+        every delivery that may have a value in a field, or every
+        delivery if ``field`` is ``None``."""
+        with self._lock:
+            self._load()
+            names = [segment[0] for segment in self._segments]
+        key = _archive_key(field, value)
+        low = (key, float('-inf') if since is None else since)
+        high = (key, float('inf') if until is None else until)
+        entries = []
+        for name in names:
+            try:
+                f = open(self._segment_path(name, 'key'), 'rb')
+            except (IOError, OSError):
+                # Still being written, or its writer died
+                entries.extend(self._scan(name, field, value, since, until))
+                continue
+            with f:
+                entries.extend((ts, name, offset, length) for
+                               _, ts, offset, length in _key_range(f, low,
+                                                                   high))
+        # A delivery is listed twice if two of its keys have the same hash
+        return set(entries)
+
+    def _scan(self, name, field, value, since, until):
+        """Look through a segment's text index, like :meth:`_lookup`."""
+        try:
+            with open(self._segment_path(name, 'idx'), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return []
+        needle = None if field is None else value.encode('utf-8')
+        entries = []
+        for line in _index_lines(data, needle):
+            ts = line[3]
+            if ((field is None or line[_INDEX_FIELDS.index(field)] == value)
+                    and (since is None or ts >= since) and
+                    (until is None or ts <= until)):
+                entries.append((ts, name, line[4], line[5]))
+        return entries
+
+    def _read(self, name, offset, length):
+        try:
+            with open(self._segment_path(name, 'seg'), 'rb') as f:
+                f.seek(offset)
+                blob = zlib.decompress(f.read(length))
+        except (IOError, OSError):
+            # Deleted by another process since the lookup
+            return None
+        meta_len = struct.unpack('>I', blob[:4])[0]
+        record = json.loads(blob[4:4 + meta_len].decode('utf-8'))
+        record['body'] = blob[4 + meta_len:]
+        return record
+
+    def _segment_path(self, name, ext):
+        return os.path.join(self.path, '%s.%s' % (name, ext))
+
+    def _load(self):
+        """List what other writers have added to the directory, and
+        forget segments they've deleted. Called with the lock held."""
+        names = set(n[:-4] for n in os.listdir(self.path)
+                    if n.endswith('.idx'))
+        known = dict((segment[0], segment) for segment in self._segments)
+        self._forget(set(known) - names - set([self._current]))
+
+        for name in names - self._own:
+            seg_path = self._segment_path(name, 'seg')
+            try:
+                size = os.path.getsize(seg_path)
+                newest = os.path.getmtime(seg_path)
+            except (IOError, OSError):
+                continue
+            segment = known.get(name)
+            if segment is None:
+                self._segments.append([name, size, newest, newest])
+            else:
+                segment[1] = size
+                segment[3] = newest
+        self._segments.sort(key=_segment_order)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(item)
+            except Exception:
+                # The thread has to keep going, or flush and close would
+                # wait for good
+                self.lost += 1
+                try:
+                    self._close_segment()
+                except (IOError, OSError):
+                    pass
+            finally:
+                self._queue.task_done()
+
+    def _write(self, item):
+        ts, guid, event, repository, headers, body = item
+        now = time.time()
+        current = self._current_segment()
+        if (current is None or current[1] >= self.segment_size or
+                (self.segment_age is not None and
+                 now - current[2] >= self.segment_age) or
+                # Deleted by another process's retention
+                os.fstat(self._seg_file.fileno()).st_nlink == 0):
+            self._open_segment(now)
+            current = self._current_segment()
+
+        meta = json.dumps({
+            'guid': guid,
+            'event': event,
+            'repository': repository or None,
+            'timestamp': ts,
+            'headers': headers,
+        }).encode('utf-8')
+        blob = zlib.compress(struct.pack('>I', len(meta)) + meta + body)
+        offset = current[1]
+        self._seg_file.write(blob)
+        self._seg_file.flush()
+        line = '\t'.join([guid, event, repository, repr(ts), str(offset),
+                          str(len(blob))]) + '\n'
+        self._idx_file.write(line.encode('utf-8'))
+        self._idx_file.flush()
+
+        with self._lock:
+            current[1] += len(blob)
+            current[3] = ts
+            self._expire(now)
+
+    def _current_segment(self):
+        for segment in reversed(self._segments):
+            if segment[0] == self._current:
+                return segment
+        return None
+
+    def _open_segment(self, now):
+        self._close_segment()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with self._lock:
+            # Number it after every segment so far, from any writer
+            self._load()
+            seq = (_segment_order(self._segments[-1])[0] + 1
+                   if self._segments else 0)
+            name = '%08d-%s' % (seq, self._writer)
+            self._seg_file = open(self._segment_path(name, 'seg'), 'ab')
+            self._idx_file = open(self._segment_path(name, 'idx'), 'ab')
+            self._own.add(name)
+            self._current = name
+            self._segments.append([name, 0, now, now])
+
+    def _close_segment(self):
+        name = self._current
+        files = [f for f in (self._seg_file, self._idx_file) if f is not None]
+        self._seg_file = self._idx_file = None
+        self._current = None
+        for f in files:
+            f.close()
+        if name is not None:
+            self._write_keys(name)
+
+    def _write_keys(self, name):
+        """Write the sorted key file of a finished segment.
+
+        Without one, the segment is still found by scanning its index.
+        """
+        try:
+            with open(self._segment_path(name, 'idx'), 'rb') as f:
+                data = f.read()
+            keys = []
+            for line in _index_lines(data):
+                ts, offset, length = line[3:]
+                keys.append((_archive_key(None, None), ts, offset, length))
+                for field, value in zip(_INDEX_FIELDS, line[:3]):
+                    if value:
+                        keys.append((_archive_key(field, value), ts,
+                                     offset, length))
+            keys.sort()
+            path = self._segment_path(name, 'key')
+            with open(path + '.tmp', 'wb') as f:
+                f.write(b''.join(_KEY_ENTRY.pack(*key) for key in keys))
+            # Readers only ever see a whole key file
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            pass
+
+    def _expire(self, now):
+        """Delete old segments. Called with the lock held."""
+        total = sum(segment[1] for segment in self._segments)
+        expired = set()
+        for name, size, created, newest in self._segments:
+            # The segment being written to is never deleted
+            if name == self._current:
+                continue
+            if ((self.max_bytes is not None and total > self.max_bytes) or
+                    (self.max_age is not None and
+                     now - newest > self.max_age)):
+                total -= size
+                expired.add(name)
+                for ext in ('seg', 'idx', 'key'):
+                    try:
+                        os.remove(self._segment_path(name, ext))
+                    except OSError:
+                        pass
+        self._forget(expired)
+
+    def _forget(self, expired):
+        """Drop segments from the list. Called with the lock held."""
+        if not expired:
+            return
+        self._segments = [segment for segment in self._segments
+                          if segment[0] not in expired]
+        self._own -= expired
+
+
+def _segment_order(segment):
+    """Sort archive segments by number, then by writer."""
+    seq, _, writer = segment[0].partition('-')
+    return int(seq), writer
+
+
+#: The fields of an archive index line that can be looked up
+_INDEX_FIELDS = ('guid', 'event', 'repository')
+
+#: An entry in an archive key file: the key's hash, the timestamp, and
+#: the offset and length of the delivery in the segment
+_KEY_ENTRY = struct.Struct('>QdQI')
+
+
+def _archive_key(field, value):
+    """Hash a field's value to 64 bits, for an archive key file.
+
+    The hash of ``None, None`` is a key that every delivery has.
+    """
+    data = ('%s\0%s' % (field, value)).encode('utf-8')
+    return ((zlib.crc32(data) & 0xffffffff) << 32 |
+            zlib.adler32(data) & 0xffffffff)
+
+
+def _index_lines(data, needle=None):
+    """Parse the whole lines of an archive index.
+
+    Yields ``(guid, event, repository, timestamp, offset, length)``.
+
+    :param needle: only parse lines with these bytes in them
+    """
+    for line in data[:data.rfind(b'\n') + 1].splitlines():
+        if needle is not None and needle not in line:
+            continue
+        fields = line.decode('utf-8').split('\t')
+        if len(fields) != 6:
+            # A partial line left by a crash
+            continue
+        yield (fields[0], fields[1], fields[2], float(fields[3]),
+               int(fields[4]), int(fields[5]))
+
+
+def _key_range(f, low, high):
+    """Return the entries of a key file from ``low`` to ``high``.
+
+    Both are ``(hash, timestamp)``, and inclusive. The entries are
+    found by a binary search, reading only the entries it looks at.
+    """
+    size = _KEY_ENTRY.size
+    f.seek(0, 2)
+    count = f.tell() // size
+
+    def bisect(target, right):
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(mid * size)
+            entry = _KEY_ENTRY.unpack(f.read(size))[:2]
+            if entry < target or (right and entry == target):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    start = bisect(low, False)
+    end = bisect(high, True)
+    f.seek(start * size)
+    data = f.read((end - start) * size)
+    return [_KEY_ENTRY.unpack_from(data, i * size)
+            for i in range(end - start)]
+
+
+class RelayTarget(object):
+
+    """Forward deliveries to a downstream URL.
+
+    Deliveries are queued, and posted by background threads over a
+    keep-alive connection pool, so a slow downstream doesn't hold up
+    the request or the other targets. The threads are started by the
+    first delivery.
+
+    A single delivery is posted with its provider's event and delivery
+    headers, such as ``X-GitHub-Event`` and ``X-GitHub-Delivery``, and
+    the provider's name in ``X-Hookserver-Provider``. With
+    ``batch_size`` above 1, a JSON list of ``{"provider": ...,
+    "event": ..., "guid": ..., "payload": ...}`` objects is posted
+    instead, with an ``X-Hookserver-Batch`` header holding its length.
+    If ``secret`` is given, the body is signed with it in
+    ``X-Hub-Signature``, the same way GitHub does.
+
+    A post counts as sent once it gets a 2xx or 3xx response. One that
+    fails to connect, or gets a 429 or 5xx, is retried. Any other 4xx,
+    which means the downstream is set up wrong, counts as failed
+    straight away.
+
+    :param url: the URL to post deliveries to
+    :param secret: the key to sign forwarded deliveries with
+    :param events: the events to forward, all of them by default
+    :param batch_size: most deliveries to post at once
+    :param batch_interval: seconds to wait for a batch to fill up
+    :param concurrency: number of posts to have in flight at once
+    :param retries: times to retry a post that failed, or got a 429 or
+                    5xx
+    :param backoff: seconds to wait before the first retry, doubled for
+                    each retry after that
+    :param timeout: seconds to wait for the downstream to respond
+    :param queue_size: deliveries waiting to be posted before new ones
+                       are dropped
+    """
+
+    def __init__(self, url, secret=None, events=None, batch_size=1,
+                 batch_interval=1.0, concurrency=2, retries=3, backoff=0.5,
+                 timeout=10, queue_size=1000):
+        """Set up the target. Nothing is started until the first send."""
+        self.url = url
+        self.secret = secret
+        self.events = set(events) if events is not None else None
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(queue_size)
+        self._session = None
+        self._threads = []
+
+    def send(self, event, guid, body, provider=None):
+        """Queue a delivery to be forwarded. Never blocks.
+
+        :param provider: the :class:`Provider` the delivery came from,
+                         GitHub by default
+        """
+        if self.events is not None and event not in self.events:
+            return
+        if not self._threads:
+            self._start()
+        try:
+            self._queue.put_nowait((provider or providers['github'], event,
+                                    guid, body))
+        except queue.Full:
+            self._count('dropped')
+
+    def flush(self):
+        """Block until every queued delivery has been posted or failed."""
+        self._queue.join()
+
+    def close(self):
+        """Post the queue, then stop the threads."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        """Return the number of deliveries sent, failed and dropped."""
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'dropped': self.dropped,
+            }
+
+    def _start(self):
+        import requests
+
+        with self._lock:
+            if self._threads:
+                return
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+            for i in range(self.concurrency):
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.batch_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            deliveries = [item for item in batch if item is not None]
+            try:
+                if deliveries:
+                    self._post(deliveries)
+            finally:
+                for item in batch:
+                    self._queue.task_done()
+            if len(deliveries) < len(batch):
+                return
+
+    def _post(self, deliveries):
+        import requests
+
+        headers = {'Content-Type': 'application/json'}
+        if self.batch_size > 1:
+            body = b'[' + b','.join(
+                b'{"provider": ' + json.dumps(provider.name).encode() +
+                b', "event": ' + json.dumps(event).encode() +
+                b', "guid": ' + json.dumps(guid).encode() +
+                b', "payload": ' + payload + b'}'
+                for provider, event, guid, payload in deliveries) + b']'
+            headers['X-Hookserver-Batch'] = str(len(deliveries))
+        else:
+            provider, event, guid, body = deliveries[0]
+            headers[provider.event_header] = event
+            headers[provider.delivery_header] = guid
+            headers['X-Hookserver-Provider'] = provider.name
+        if self.secret is not None:
+            headers['X-Hub-Signature'] = _signature(self.secret, body)
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count('retried')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                resp = self._session.post(self.url, data=body,
+                                          headers=headers,
+                                          timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                continue
+            if resp.status_code < 400:
+                self._count('sent', len(deliveries))
+                return
+            if resp.status_code < 500 and resp.status_code != 429:
+                # Retrying won't help
+                break
+        self._count('failed', len(deliveries))
+
+    def _count(self, name, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+
+class EventStream(object):
+
+    """Broadcast deliveries to subscribers, as Server-Sent Events.
+
+    Each delivery is turned into an event once, and the same bytes are
+    handed to every subscriber whose filters match. Subscribers each
+    have a bounded buffer; when a slow one falls behind, its oldest
+    events are dropped, so :meth:`publish` never waits on anyone.
+    """
+
+    def __init__(self):
+        """Start with no subscribers."""
+        # Replaced rather than changed, so publish doesn't need the lock
+        self._subscribers = ()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def subscribe(self, events=None, repositories=None, buffer=100):
+        """Return a new :class:`Subscription`.
+
+        :param events: only receive these events, all of them by default
+        :param repositories: only receive events from these repositories
+        :param buffer: events to hold before dropping the oldest
+        """
+        subscription = Subscription(events, repositories, buffer)
+        with self._lock:
+            self._subscribers = self._subscribers + (subscription,)
+        if self._closed:
+            subscription.close()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop sending events to a subscription."""
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers
+                                      if s is not subscription)
+
+    def publish(self, event, guid, repository, body):
+        """Send a delivery's raw JSON body to the matching subscribers."""
+        message = None
+        for subscription in self._subscribers:
+            if subscription.matches(event, repository):
+                if message is None:
+                    message = _sse_message(event, guid, body)
+                subscription.put(message)
+
+    def response(self, keepalive=15, **options):
+        """Return a streaming response for a new subscription.
+
+        :param keepalive: seconds between comments sent to keep the
+                          connection open
+        :param options: passed on to :meth:`subscribe`
+        """
+        def generate():
+            # Subscribe once the response starts, so that a response
+            # that's thrown away doesn't leave a subscriber behind
+            subscription = self.subscribe(**options)
+            try:
+                yield b': connected\n\n'
+                while not subscription.closed:
+                    message = subscription.get(keepalive)
+                    if message is not None:
+                        yield message
+                    elif not subscription.closed:
+                        yield b': \n\n'
+            finally:
+                self.unsubscribe(subscription)
+
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        return flask.Response(generate(), mimetype='text/event-stream',
+                              headers=headers)
+
+    def close(self):
+        """End every subscriber's stream, and any started from now on."""
+        self._closed = True
+        for subscription in self._subscribers:
+            subscription.close()
+
+    def stats(self):
+        """Return the buffered and dropped events of each subscriber."""
+        return [{'buffered': len(s._queue), 'dropped': s.dropped}
+                for s in self._subscribers]
+
+
+class Subscription(object):
+
+    """A subscriber's filters and buffer of events.
+
+    :param events: the events to receive, or ``None`` for all of them
+    :param repositories: the repositories to receive events from, or
+                         ``None`` for all of them
+    :param buffer: events to hold before dropping the oldest
+    """
+
+    def __init__(self, events=None, repositories=None, buffer=100):
+        """Start with an empty buffer."""
+        self.events = set(events) if events is not None else None
+        self.repositories = (set(repositories) if repositories is not None
+                             else None)
+        self.dropped = 0
+        self.closed = False
+        self._queue = deque(maxlen=buffer)
+        self._ready = threading.Event()
+
+    def matches(self, event, repository):
+        """Return whether the subscriber wants an event."""
+        return ((self.events is None or event in self.events) and
+                (self.repositories is None or
+                 repository in self.repositories))
+
+    def put(self, message):
+        """Buffer an event, dropping the oldest if the buffer is full."""
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(message)
+        self._ready.set()
+
+    def close(self):
+        """End the stream, waking up :meth:`get`."""
+        self.closed = True
+        self._ready.set()
+
+    def get(self, timeout=None):
+        """Return the next event, or ``None`` if none came in time."""
+        try:
+            return self._queue.popleft()
+        except IndexError:
+            pass
+        self._ready.clear()
+        # Check again, in case an event came in before the clear
+        if not self._queue and not self.closed:
+            self._ready.wait(timeout)
+        try:
+            return self._queue.popleft()
+        except IndexError:
+            return None
+
+
+def _sse_message(event, guid, body):
+    """Format a delivery as a Server-Sent Event."""
+    data = b'\n'.join(b'data: ' + line for line in body.splitlines())
+    return (b'id: ' + guid.encode('utf-8') + b'\nevent: ' +
+            event.encode('utf-8') + b'\n' + data + b'\n\n')
+
+
+class CountMinSketch(object):
+
+    """Estimate how many times each key was counted, in fixed memory.
+
+    Estimates are never too low, and with probability ``1 - e**-depth``
+    they're too high by at most ``e / width`` of the total. Keys are
+    hashed the same way in every process, so sketches of the same size
+    can be merged by adding them up.
+
+    :param width: counters in each row
+    :param depth: rows, each indexed by a different hash of the key
+    """
+
+    def __init__(self, width=1024, depth=4):
+        """Start with every counter at zero."""
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        # Doubles count exactly up to 2**53, on every platform
+        self.counts = array('d', [0]) * (width * depth)
+
+    def add(self, key, count=1):
+        """Count a key, ``count`` times."""
+        self._add(self._cells(key), count)
+
+    def estimate(self, key):
+        """Return the most times a key could have been counted."""
+        return int(min(self.counts[i] for i in self._cells(key)))
+
+    def merge(self, other):
+        """Add the counts from another sketch of the same size."""
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('Can\'t merge sketches of different sizes')
+        self.total += other.total
+        counts = self.counts
+        for i, count in enumerate(other.counts):
+            if count:
+                counts[i] += count
+
+    def _add(self, cells, count):
+        self.total += count
+        counts = self.counts
+        for i in cells:
+            counts[i] += count
+
+    def _cells(self, key):
+        if isinstance(key, type(u'')):
+            key = key.encode('utf-8')
+        # Double hashing: row i uses h1 + i * h2. Both hashes are the
+        # same in every process, unlike hash().
+        h1 = zlib.crc32(key) & 0xffffffff
+        h2 = zlib.adler32(key) & 0xffffffff | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width
+                for row in range(self.depth)]
+
+
+class SpaceSaving(object):
+
+    """Keep track of the ``k`` most counted keys, in fixed memory.
+
+    Once ``k`` keys are being tracked, a new key takes the place of the
+    least counted one, and starts from its count. So a count is never
+    too low, and is too high by at most the key's ``error``. Any key
+    counted more than ``1 / k`` of the total is always tracked.
+    Summaries can be merged, as in Agarwal et al., "Mergeable
+    Summaries".
+
+    :param k: the number of keys to track
+    """
+
+    def __init__(self, k=50):
+        """Start with no keys."""
+        self.k = k
+        self._reset({})
+
+    def add(self, key, count=1):
+        """Count a key, ``count`` times."""
+        counts = self.counts
+        entry = counts.get(key)
+        if entry is not None:
+            entry[0] += count
+            return
+        heap = self._heap
+        if len(counts) < self.k:
+            counts[key] = [count, 0]
+            heapq.heappush(heap, (count, key))
+            return
+        # The heap has a count for each key, which may be out of date
+        # but is never too high. Bring the smallest up to date until
+        # it's right, and then it's the least counted key.
+        while True:
+            floor, smallest = heap[0]
+            current = counts[smallest][0]
+            if current == floor:
+                break
+            heapq.heapreplace(heap, (current, smallest))
+        del counts[smallest]
+        counts[key] = [floor + count, floor]
+        heapq.heapreplace(heap, (floor + count, key))
+
+    def top(self, n=None):
+        """Return ``(key, count, error)`` for the most counted keys."""
+        entries = sorted(((key, count, error)
+                          for key, (count, error) in self.counts.items()),
+                         key=lambda entry: (-entry[1], entry[0]))
+        return entries[:n]
+
+    def merge(self, other):
+        """Add the counts from another summary."""
+        floor = self._floor()
+        other_floor = other._floor()
+        merged = {}
+        for key in set(self.counts) | set(other.counts):
+            count, error = self.counts.get(key, (floor, floor))
+            other_count, other_error = other.counts.get(
+                key, (other_floor, other_floor))
+            merged[key] = [count + other_count, error + other_error]
+        if len(merged) > self.k:
+            keep = sorted(merged, key=lambda key: -merged[key][0])
+            merged = dict((key, merged[key]) for key in keep[:self.k])
+        self._reset(merged)
+
+    def _reset(self, counts):
+        self.counts = counts
+        self._heap = [(count, key) for key, (count, error) in counts.items()]
+        heapq.heapify(self._heap)
+
+    def _floor(self):
+        """Return the most that an untracked key could have been counted."""
+        if len(self.counts) < self.k:
+            return 0
+        return min(count for count, error in self.counts.values())
+
+
+class HeavyHitters(object):
+
+    """Find the repositories, senders and events behind the most load.
+
+    Deliveries and bytes are counted by each of those, over a sliding
+    window split into ``buckets`` shorter ones. Each bucket has a
+    :class:`SpaceSaving` summary of the top keys, and a
+    :class:`CountMinSketch` to estimate any other key, so memory stays
+    the same however many repositories send deliveries.
+
+    With a ``path``, every ``interval`` seconds the summary is written to
+    a file in that directory, named after the process. :meth:`combined`
+    merges in the other processes' files, so any worker can report on
+    all of them.
+
+    :param window: seconds of deliveries to summarize
+    :param buckets: the number of steps the window slides in
+    :param k: keys to track by each dimension and metric
+    :param width: see :class:`CountMinSketch`
+    :param depth: see :class:`CountMinSketch`
+    :param path: directory to share summaries with other processes
+    :param interval: seconds between writing the summary to ``path``
+    """
+
+    dimensions = ('repository', 'sender', 'event')
+    metrics = ('deliveries', 'bytes')
+
+    def __init__(self, window=3600, buckets=6, k=50, width=1024, depth=4,
+                 path=None, interval=10):
+        """Set up the window, and start sharing if there's a path."""
+        self.window = window
+        self.buckets = buckets
+        self.span = float(window) / buckets
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self.path = path
+        self.interval = interval
+        # Bucket number -> {(dimension, metric): (sketch, summary)}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        if path is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def add(self, repository, sender, event, size, now=None):
+        """Count a delivery, and its size in bytes."""
+        keys = (repository, sender, event)
+        with self._lock:
+            bucket = self._bucket(time.time() if now is None else now)
+            for dimension, key in zip(self.dimensions, keys):
+                if key is None:
+                    continue
+                cells = None
+                for metric, count in (('deliveries', 1), ('bytes', size)):
+                    sketch, summary = bucket[dimension, metric]
+                    if cells is None:
+                        cells = sketch._cells(key)
+                    sketch._add(cells, count)
+                    summary.add(key, count)
+
+    def top(self, dimension, metric='deliveries', n=10, now=None):
+        """Return the keys with the highest counts in the window.
+
+        Each is a dict with the ``key``, its ``count``, and the ``error``
+        that the count might be over by.
+        """
+        merged = SpaceSaving(self.k)
+        with self._lock:
+            for bucket in self._live(now):
+                merged.merge(bucket[dimension, metric][1])
+        return [{'key': key, 'count': count, 'error': error}
+                for key, count, error in merged.top(n)]
+
+    def estimate(self, dimension, key, now=None):
+        """Return the most deliveries and bytes a key could have sent."""
+        with self._lock:
+            live = self._live(now)
+            return dict((metric,
+                         sum(bucket[dimension, metric][0].estimate(key)
+                             for bucket in live))
+                        for metric in self.metrics)
+
+    def report(self, n=10, now=None):
+        """Return the totals and the top keys of every dimension."""
+        with self._lock:
+            live = self._live(now)
+            totals = dict((metric, sum(int(bucket['event', metric][0].total)
+                                       for bucket in live))
+                          for metric in self.metrics)
+        return {
+            'window': self.window,
+            'totals': totals,
+            'top': dict((dimension, dict((metric, self.top(dimension,
+                                                           metric, n, now))
+                                         for metric in self.metrics))
+                        for dimension in self.dimensions),
+        }
+
+    def merge(self, other):
+        """Add the counts from another summary with the same settings."""
+        if ((other.window, other.buckets, other.k) !=
+                (self.window, self.buckets, self.k)):
+            raise ValueError('Can\'t merge summaries with different '
+                             'windows or sizes')
+        with other._lock:
+            with self._lock:
+                for number, other_bucket in other._buckets.items():
+                    bucket = self._buckets.get(number)
+                    if bucket is None:
+                        bucket = self._buckets[number] = self._new_bucket()
+                    for name, (sketch, summary) in other_bucket.items():
+                        bucket[name][0].merge(sketch)
+                        bucket[name][1].merge(summary)
+
+    def combined(self):
+        """Return this summary merged with the other processes' ones."""
+        result = HeavyHitters(self.window, self.buckets, self.k, self.width,
+                              self.depth)
+        result.merge(self)
+        if self.path is not None:
+            for name in self._shared_files(exclude_self=True):
+                try:
+                    with open(name, 'rb') as f:
+                        result.merge(HeavyHitters.loads(f.read()))
+                except (IOError, OSError, ValueError):
+                    # Being replaced, or left half written by a crash
+                    continue
+        return result
+
+    def dumps(self):
+        """Serialize the summary, to merge it in another process."""
+        import base64
+
+        with self._lock:
+            # Copy under the lock, encode outside it
+            buckets = [(number, [(dimension, metric, sketch.counts[:],
+                                  sketch.total,
+                                  sorted((key, list(entry)) for key, entry
+                                         in summary.counts.items()))
+                                 for (dimension, metric), (sketch, summary)
+                                 in sorted(bucket.items())])
+                       for number, bucket in self._buckets.items()]
+        buckets = [[number, [[dimension, metric,
+                              base64.b64encode(_array_bytes(counts)).decode(),
+                              total, top]
+                             for dimension, metric, counts, total, top
+                             in entries]]
+                   for number, entries in buckets]
+        data = {'window': self.window, 'buckets_per_window': self.buckets,
+                'k': self.k,
+                'width': self.width, 'depth': self.depth,
+                'buckets': buckets}
+        return zlib.compress(json.dumps(data).encode())
+
+    @classmethod
+    def loads(cls, data):
+        """Load a summary written by :meth:`dumps`."""
+        import base64
+
+        try:
+            data = json.loads(zlib.decompress(data).decode())
+        except zlib.error:
+            raise ValueError('Not a summary')
+        hh = cls(data['window'], data['buckets_per_window'], data['k'],
+                 data['width'], data['depth'])
+        for number, entries in data['buckets']:
+            bucket = hh._buckets[number] = hh._new_bucket()
+            for dimension, metric, counts, total, top in entries:
+                sketch, summary = bucket[dimension, metric]
+                _array_load(sketch.counts, base64.b64decode(counts))
+                sketch.total = total
+                summary._reset(dict((key, list(entry)) for key, entry in top))
+        return hh
+
+    def close(self):
+        """Write the summary out one last time, and stop sharing it."""
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _new_bucket(self):
+        return dict(((dimension, metric),
+                     (CountMinSketch(self.width, self.depth),
+                      SpaceSaving(self.k)))
+                    for dimension in self.dimensions
+                    for metric in self.metrics)
+
+    def _window_numbers(self, now):
+        last = int(now // self.span)
+        return range(last - self.buckets + 1, last + 1)
+
+    def _bucket(self, now):
+        number = int(now // self.span)
+        bucket = self._buckets.get(number)
+        if bucket is None:
+            oldest = self._window_numbers(now)[0]
+            for old in [n for n in self._buckets if n < oldest]:
+                del self._buckets[old]
+            bucket = self._buckets[number] = self._new_bucket()
+        return bucket
+
+    def _live(self, now):
+        # Call with the lock held
+        numbers = self._window_numbers(time.time() if now is None else now)
+        return [self._buckets[n] for n in numbers if n in self._buckets]
+
+    def _shared_files(self, exclude_self=False):
+        own = os.path.join(self.path, '%d.hh' % os.getpid())
+        names = [os.path.join(self.path, name)
+                 for name in os.listdir(self.path) if name.endswith('.hh')]
+        return [name for name in names if not (exclude_self and name == own)]
 
-    """The Hooks object registers handlers to GitHub webhooks events.
+    def _write(self):
+        now = time.time()
+        for name in self._shared_files(exclude_self=True):
+            try:
+                if os.stat(name).st_mtime < now - self.window:
+                    # Left by a worker that's gone, and out of the window
+                    os.remove(name)
+            except OSError:
+                pass
+        name = os.path.join(self.path, '%d.hh' % os.getpid())
+        with open(name + '.tmp', 'wb') as f:
+            f.write(self.dumps())
+        os.rename(name + '.tmp', name)
 
-    :param app: the optional :class:`~flask.Flask` instance to register
-                the extension
-    :param url: the url that events will be posted to
+    def _run(self):
+        while not self._stopped.is_set():
+            self._stopped.wait(self.interval)
+            self._write()
+
+
+def _array_bytes(a):
+    """Return the raw contents of an array."""
+    if hasattr(a, 'tobytes'):
+        return a.tobytes()
+    return a.tostring()  # pragma: no cover
+
+
+def _array_load(a, data):
+    """Replace the contents of an array with raw bytes of the same size."""
+    loaded = array(a.typecode)
+    if hasattr(loaded, 'frombytes'):
+        loaded.frombytes(data)
+    else:  # pragma: no cover
+        loaded.fromstring(data)
+    if len(loaded) != len(a):
+        raise ValueError('Sketch is the wrong size')
+    a[:] = loaded
+
+
+class DeliveryLog(object):
+
+    """Write a JSON line for every delivery, from a background thread.
+
+    Records are appended to an in-memory buffer, which is written out
+    in batches every ``interval`` seconds, or sooner once a batch has
+    filled up. :meth:`write` never waits on the file or socket: when the
+    buffer is full the record is dropped and counted in :attr:`dropped`.
+
+    :param path: the file to append records to
+    :param address: a ``(host, port)`` to send records to over TCP,
+                    instead of a file
+    :param capacity: records to buffer before dropping new ones
+    :param batch_size: most records to write at once
+    :param interval: seconds between writes
     """
 
-    def __init__(self, app=None, url='/hooks'):
-        """Initialize the extension."""
-        self._hooks = {}
-        if app is not None:
-            self.init_app(app, url=url)
+    def __init__(self, path=None, address=None, capacity=10000,
+                 batch_size=500, interval=1.0):
+        """Start the writer thread."""
+        if (path is None) == (address is None):
+            raise ValueError('Either path or address must be given')
+        self.path = path
+        self.address = address
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        self.written = 0
+        self.dropped = 0
+        self.lost = 0
 
-    def init_app(self, app, url='/hooks'):
-        """Register the URL route to the application.
+        self._buffer = deque()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._file = None
+        self._socket = None
 
-        :param app: the optional :class:`~flask.Flask` instance to
-                register the extension
-        :param url: the url that events will be posted to
-        """
-        app.config.setdefault('VALIDATE_IP', True)
-        app.config.setdefault('VALIDATE_SIGNATURE', True)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
 
-        @app.route(url, methods=['POST'])
-        def hook():
-            if app.config['VALIDATE_IP']:
-                if not is_github_ip(request.remote_addr):
-                    raise Forbidden('Requests must originate from GitHub')
+    def write(self, record):
+        """Buffer a record to be written. Never blocks."""
+        if len(self._buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        self._buffer.append(record)
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    def flush(self):
+        """Write out everything in the buffer now."""
+        self._drain()
+
+    def close(self):
+        """Write out the buffer, then stop the writer thread."""
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
+        self._drain()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+
+    def stats(self):
+        """Return the number of records buffered, written and dropped."""
+        return {
+            'buffered': len(self._buffer),
+            'written': self.written,
+            'dropped': self.dropped,
+            'lost': self.lost,
+        }
 
-            if app.config['VALIDATE_SIGNATURE']:
-                key = app.config.get('GITHUB_WEBHOOKS_KEY', app.secret_key)
-                signature = request.headers.get('X-Hub-Signature')
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._drain()
 
-                if hasattr(request, 'get_data'):
-                    # Werkzeug >= 0.9
-                    payload = request.get_data()
+    def _drain(self):
+        with self._lock:
+            while self._buffer:
+                batch = []
+                while self._buffer and len(batch) < self.batch_size:
+                    batch.append(self._buffer.popleft())
+                lines = ''.join(json.dumps(record, sort_keys=True) + '\n'
+                                for record in batch)
+                try:
+                    self._send(lines.encode('utf-8'))
+                except (IOError, OSError):
+                    self.lost += len(batch)
                 else:
-                    payload = request.data
+                    self.written += len(batch)
 
-                if not signature:
-                    raise BadRequest('Missing signature')
+    def _send(self, data):
+        if self.path is not None:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            self._file.write(data)
+            self._file.flush()
+            return
 
-                if not check_signature(signature, key, payload):
-                    raise BadRequest('Wrong signature')
+        import socket
 
-            event = request.headers.get('X-GitHub-Event')
-            guid = request.headers.get('X-GitHub-Delivery')
-            if not event:
-                raise BadRequest('Missing header: X-GitHub-Event')
-            elif not guid:
-                raise BadRequest('Missing header: X-GitHub-Delivery')
+        if self._socket is None:
+            self._socket = socket.create_connection(self.address, timeout=5)
+        try:
+            self._socket.sendall(data)
+        except (IOError, OSError):
+            # Reconnect for the next batch
+            self._socket.close()
+            self._socket = None
+            raise
 
-            if hasattr(request, 'get_json'):
-                # Flask >= 0.10
-                data = request.get_json()
-            else:
-                data = request.json
 
-            if event in self._hooks:
-                return self._hooks[event](data, guid)
-            else:
-                return 'Hook not used\n'
+def _request_payload():
+    """Return the raw body of the current request."""
+    if hasattr(request, 'get_data'):
+        # Werkzeug >= 0.9
+        return request.get_data()
+    return request.data
 
-    def register_hook(self, hook_name, fn):
-        """Register a function to be called on a GitHub event."""
-        if hook_name not in self._hooks:
-            self._hooks[hook_name] = fn
-        else:
-            raise Exception('%s hook already registered' % hook_name)
 
-    def hook(self, hook_name):
-        """A decorator that's used to register a new hook handler.
+def _ms_since(start):
+    """Return the milliseconds since a :func:`time.time` timestamp."""
+    return round((time.time() - start) * 1000, 3)
 
-        :param hook_name: the event to handle
-        """
-        def wrapper(fn):
-            self.register_hook(hook_name, fn)
-            return fn
-        return wrapper
+
+def _lookup(data, path):
+    """Get a value out of a payload by a dotted path, or ``None``."""
+    for name in path.split('.'):
+        try:
+            data = data[name]
+        except (KeyError, TypeError):
+            return None
+    return data
+
+
+def _repository_name(data):
+    """Get the ``owner/repo`` name out of a payload, if there is one."""
+    try:
+        return data['repository']['full_name']
+    except (KeyError, TypeError):
+        return None
+
+
+class _Invalid(Exception):
+
+    """A value that doesn't match its schema, and where it was found."""
+
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.message = message
+        self.path = []
+
+    def __str__(self):
+        location = ''.join('[%s]' % json.dumps(part)
+                           for part in reversed(self.path))
+        return 'payload%s %s' % (location, self.message)
+
+
+_text_types = (type(u''), str)
+_integer_types = (int, type(2 ** 64))
+_json_types = {
+    'object': (dict,),
+    'array': (list,),
+    'string': _text_types,
+    'integer': _integer_types,
+    'number': _integer_types + (float,),
+    'boolean': (bool,),
+    'null': (type(None),),
+}
+# Annotations, which don't affect validation
+_ignored_keywords = set(['$schema', '$id', 'id', 'title', 'description',
+                         'default', 'examples'])
+_schema_keywords = _ignored_keywords | set([
+    'type', 'enum', 'properties', 'required', 'additionalProperties',
+    'items', 'minItems', 'maxItems', 'minLength', 'maxLength', 'pattern',
+    'minimum', 'maximum', 'anyOf',
+])
+
+
+def compile_schema(schema):
+    """Turn a JSON Schema into a function that validates payloads.
+
+    The schema is checked and turned into nested closures once, so
+    validating a payload doesn't look at the schema at all. Only a
+    subset of JSON Schema is supported: ``type``, ``enum``,
+    ``properties``, ``required``, ``additionalProperties``, ``items``,
+    ``minItems``, ``maxItems``, ``minLength``, ``maxLength``,
+    ``pattern``, ``minimum``, ``maximum`` and ``anyOf``. Other keywords
+    raise a :exc:`ValueError`, rather than being silently ignored.
+
+    :param schema: the schema, as a dict
+    :return: a function that takes a payload and raises
+             :class:`~werkzeug.exceptions.BadRequest` if it doesn't
+             match
+    """
+    check = _compile_schema(schema)
+
+    def validate(data):
+        try:
+            check(data)
+        except _Invalid as e:
+            raise BadRequest('Invalid payload: %s' % e)
+    return validate
+
+
+def _compile_schema(schema):
+    """Return a function that raises :class:`_Invalid` on a bad value."""
+    if not isinstance(schema, dict):
+        raise ValueError('Schema must be a dict, not %r' % (schema,))
+    unknown = set(schema) - _schema_keywords
+    if unknown:
+        raise ValueError('Unsupported schema keywords: %s' %
+                         ', '.join(sorted(unknown)))
+
+    checks = []
+    # An object or array check can do the type check itself, which
+    # saves a call for each value
+    structure = set(['properties', 'required', 'additionalProperties',
+                     'items']) & set(schema)
+    strict = (schema.get('type') == 'object' and 'items' not in schema or
+              schema.get('type') == 'array' and structure == set(['items']))
+    if 'type' in schema and not (structure and strict):
+        checks.append(_type_check(schema['type']))
+    if 'enum' in schema:
+        checks.append(_enum_check(schema['enum']))
+    if set(['minimum', 'maximum']) & set(schema):
+        checks.append(_range_check(_integer_types + (float,), 'be',
+                                   schema.get('minimum'),
+                                   schema.get('maximum'), lambda v: v))
+    if set(['minLength', 'maxLength']) & set(schema):
+        checks.append(_range_check(_text_types, 'have a length',
+                                   schema.get('minLength'),
+                                   schema.get('maxLength'), len))
+    if set(['minItems', 'maxItems']) & set(schema):
+        checks.append(_range_check((list,), 'have a length',
+                                   schema.get('minItems'),
+                                   schema.get('maxItems'), len))
+    if 'pattern' in schema:
+        checks.append(_pattern_check(schema['pattern']))
+    if set(['properties', 'required', 'additionalProperties']) & set(schema):
+        checks.append(_object_check(schema.get('properties', {}),
+                                    schema.get('required', ()),
+                                    schema.get('additionalProperties',
+                                               True), strict))
+    if 'items' in schema:
+        checks.append(_items_check(_compile_schema(schema['items']),
+                                   strict))
+    if 'anyOf' in schema:
+        checks.append(_any_of_check([_compile_schema(s)
+                                     for s in schema['anyOf']]))
+
+    if not checks:
+        return lambda value: None
+    elif len(checks) == 1:
+        return checks[0]
+    elif len(checks) == 2:
+        first, second = checks
+
+        def check(value):
+            first(value)
+            second(value)
+        return check
+
+    def check(value):
+        for c in checks:
+            c(value)
+    return check
+
+
+def _type_check(names):
+    if isinstance(names, _text_types):
+        names = [names]
+    types = ()
+    for name in names:
+        if name not in _json_types:
+            raise ValueError('Unknown type %r' % name)
+        types += _json_types[name]
+    # bool is an int, but true isn't a JSON integer
+    exclude_bool = bool not in types
+    message = 'must be %s' % ' or '.join(
+        name if name == 'null' else
+        ('an ' if name[0] in 'aeiou' else 'a ') + name for name in names)
+
+    def check(value):
+        if (not isinstance(value, types) or
+                (exclude_bool and isinstance(value, bool))):
+            raise _Invalid(message)
+    return check
+
+
+def _enum_check(values):
+    values = list(values)
+    message = 'must be one of %s' % ', '.join(json.dumps(v) for v in values)
+
+    def check(value):
+        # 1 == True in Python, but not in JSON
+        for v in values:
+            if v == value and type(v) is type(value):
+                return
+        raise _Invalid(message)
+    return check
+
+
+def _range_check(types, description, low, high, measure):
+    def check(value):
+        if not isinstance(value, types) or isinstance(value, bool):
+            return
+        n = measure(value)
+        if low is not None and n < low:
+            raise _Invalid('must %s at least %s' % (description, low))
+        if high is not None and n > high:
+            raise _Invalid('must %s at most %s' % (description, high))
+    return check
+
+
+def _pattern_check(pattern):
+    import re
+
+    search = re.compile(pattern).search
+    message = 'must match %s' % json.dumps(pattern)
+
+    def check(value):
+        if isinstance(value, _text_types) and not search(value):
+            raise _Invalid(message)
+    return check
+
+
+def _object_check(properties, required, additional, strict=False):
+    properties = [(name, _compile_schema(schema))
+                  for name, schema in properties.items()]
+    required = list(required)
+    known = set(name for name, check in properties)
+    if isinstance(additional, dict):
+        additional = _compile_schema(additional)
+
+    def check(value):
+        if not isinstance(value, dict):
+            if strict:
+                raise _Invalid('must be an object')
+            return
+        for name in required:
+            if name not in value:
+                raise _Invalid('is missing %s' % json.dumps(name))
+        for name, check_property in properties:
+            if name in value:
+                try:
+                    check_property(value[name])
+                except _Invalid as e:
+                    e.path.append(name)
+                    raise
+        if additional is not True:
+            for name in value:
+                if name in known:
+                    continue
+                if additional is False:
+                    raise _Invalid('has unexpected property %s' %
+                                   json.dumps(name))
+                try:
+                    additional(value[name])
+                except _Invalid as e:
+                    e.path.append(name)
+                    raise
+    return check
+
+
+def _items_check(check_item, strict=False):
+    def check(value):
+        if not isinstance(value, list):
+            if strict:
+                raise _Invalid('must be an array')
+            return
+        for i, item in enumerate(value):
+            try:
+                check_item(item)
+            except _Invalid as e:
+                e.path.append(i)
+                raise
+    return check
+
+
+def _any_of_check(alternatives):
+    def check(value):
+        for alternative in alternatives:
+            try:
+                alternative(value)
+                return
+            except _Invalid:
+                pass
+        raise _Invalid('doesn\'t match any of the allowed schemas')
+    return check
 
 
 class _timed_memoize(object):
@@ -139,6 +3116,9 @@ def _load_github_hooks(github_url='https://api.github.com'):
 
     If something else goes wrong, raise a generic 503.
     """
+    # Requests is slow to import, and only needed with VALIDATE_IP
+    import requests
+
     try:
         resp = requests.get(github_url + '/meta')
         if resp.status_code == 200:
@@ -162,25 +3142,376 @@ load_github_hooks = _timed_memoize(60)(_load_github_hooks)
 
 def is_github_ip(ip_str):
     """Verify that an IP address is owned by GitHub."""
-    if isinstance(ip_str, bytes):
-        ip_str = ip_str.decode()
+    return ip_str in _allowlist(load_github_hooks())
 
-    ip = ipaddress.ip_address(ip_str)
-    if ip.version == 6 and ip.ipv4_mapped:
-        ip = ip.ipv4_mapped
 
-    for block in load_github_hooks():
-        if ip in ipaddress.ip_network(block):
-            return True
-    return False
+class IPAllowlist(object):
+
+    """A set of IP networks, compiled for quick lookups.
+
+    The networks are merged into sorted, non-overlapping ranges of
+    integers, so checking an address is a binary search rather than a
+    comparison against every network. IPv4 addresses mapped to IPv6 are
+    checked as IPv4.
+
+    :param blocks: the networks, in CIDR notation
+    """
+
+    def __init__(self, blocks):
+        """Compile the networks."""
+        import ipaddress
+
+        # Kept here so that checking an address doesn't import anything
+        self._ip_address = ipaddress.ip_address
+        ranges = {4: [], 6: []}
+        for block in blocks:
+            network = ipaddress.ip_network(type(u'')(block))
+            ranges[network.version].append((int(network.network_address),
+                                            int(network.broadcast_address)))
+        self._starts = {}
+        self._ends = {}
+        for version, pairs in ranges.items():
+            merged = []
+            for lo, hi in sorted(pairs):
+                if merged and lo <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], hi)
+                else:
+                    merged.append([lo, hi])
+            self._starts[version] = [lo for lo, hi in merged]
+            self._ends[version] = [hi for lo, hi in merged]
+
+    def __contains__(self, ip_str):
+        """Return whether an address is in one of the networks."""
+        if isinstance(ip_str, bytes):
+            ip_str = ip_str.decode()
+
+        ip = self._ip_address(ip_str)
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+
+        n = int(ip)
+        i = bisect.bisect_right(self._starts[ip.version], n) - 1
+        return i >= 0 and n <= self._ends[ip.version][i]
+
+
+_allowlists = {}
+
+
+def _allowlist(blocks):
+    """Return the compiled :class:`IPAllowlist` for a list of networks."""
+    key = tuple(blocks)
+    try:
+        return _allowlists[key]
+    except KeyError:
+        if len(_allowlists) > 16:
+            # The lists rarely change, but don't keep every old one
+            _allowlists.clear()
+        allowlist = _allowlists[key] = IPAllowlist(blocks)
+        return allowlist
+
+
+class Provider(object):
+
+    """A source of webhooks.
+
+    A provider knows which headers carry the event name and delivery
+    ID, how deliveries are signed, and optionally which networks they
+    come from. Subclasses set the class attributes and implement
+    :meth:`compile_verifier`.
+
+    :param ip_blocks: networks, in CIDR notation, that deliveries must
+                      come from
+    """
+
+    #: Short name used in ``HOOKS_PROVIDERS`` and :meth:`Hooks.hook`
+    name = None
+    #: Name used in error messages
+    title = None
+    #: Header holding the event name
+    event_header = None
+    #: Header holding the delivery ID
+    delivery_header = None
+    #: Config variable holding the secret
+    key_config = None
+
+    def __init__(self, ip_blocks=None):
+        """Set up an empty verifier cache."""
+        self.ip_blocks = ip_blocks
+        self._verifiers = {}
+
+    def detect(self, headers):
+        """Return whether a request looks like it's from this provider."""
+        return self.event_header in headers
+
+    def allowlist(self):
+        """Return an :class:`IPAllowlist`, or ``None`` to allow any IP."""
+        if self.ip_blocks is None:
+            return None
+        return _allowlist(self.ip_blocks)
+
+    def repository(self, data):
+        """Get the repository's name out of a payload, if there is one."""
+        return _repository_name(data)
+
+    def sender(self, data):
+        """Get the name of the user behind a payload, if there is one."""
+        return _lookup(data, 'sender.login')
+
+    def verifier(self, key):
+        """Return the function that checks deliveries signed with a key.
+
+        The function is compiled the first time a key is seen.
+        """
+        if isinstance(key, type(u'')):
+            key = key.encode()
+        try:
+            return self._verifiers[key]
+        except KeyError:
+            verify = self._verifiers[key] = self.compile_verifier(key)
+            return verify
+
+    def compile_verifier(self, key):
+        """Build a ``verify(headers, body)`` function for a key.
+
+        It should raise :class:`~werkzeug.exceptions.BadRequest` if the
+        delivery isn't properly signed.
+        """
+        raise NotImplementedError()
+
+
+class HMACProvider(Provider):
+
+    """A provider that signs the body with an HMAC in a header."""
+
+    #: Header holding the signature
+    signature_header = None
+    #: Name of the :mod:`hashlib` hash function
+    digest = None
+    #: Text in front of the hex digest
+    prefix = ''
+
+    def compile_verifier(self, key):
+        """Key an HMAC once, to be copied for every delivery."""
+        import hashlib
+        import hmac
+
+        keyed = hmac.new(key, digestmod=getattr(hashlib, self.digest))
+        prefix = self.prefix.encode()
+        header = self.signature_header
+        compare = _digest_comparer()
+
+        def verify(headers, body):
+            signature = headers.get(header)
+            if not signature:
+                raise BadRequest('Missing signature')
+            mac = keyed.copy()
+            mac.update(body)
+            expected = prefix + mac.hexdigest().encode()
+            if not compare(expected, signature.encode('utf-8')):
+                raise BadRequest('Wrong signature')
+        return verify
+
+
+class GitHubProvider(HMACProvider):
+
+    """GitHub, whose networks are looked up from ``/meta``."""
+
+    name = 'github'
+    title = 'GitHub'
+    event_header = 'X-GitHub-Event'
+    delivery_header = 'X-GitHub-Delivery'
+    key_config = 'GITHUB_WEBHOOKS_KEY'
+    signature_header = 'X-Hub-Signature'
+    digest = 'sha1'
+    prefix = 'sha1='
+
+    def allowlist(self):
+        """Return GitHub's hooks networks."""
+        if self.ip_blocks is not None:
+            return _allowlist(self.ip_blocks)
+        return _allowlist(load_github_hooks())
+
+
+class GiteaProvider(HMACProvider):
+
+    """Gitea, which signs with a bare SHA-256 hex digest."""
+
+    name = 'gitea'
+    title = 'Gitea'
+    event_header = 'X-Gitea-Event'
+    delivery_header = 'X-Gitea-Delivery'
+    key_config = 'GITEA_WEBHOOKS_KEY'
+    signature_header = 'X-Gitea-Signature'
+    digest = 'sha256'
+
+
+class BitbucketProvider(HMACProvider):
+
+    """Bitbucket, which signs with SHA-256 in ``X-Hub-Signature``."""
+
+    name = 'bitbucket'
+    title = 'Bitbucket'
+    event_header = 'X-Event-Key'
+    delivery_header = 'X-Request-UUID'
+    key_config = 'BITBUCKET_WEBHOOKS_KEY'
+    signature_header = 'X-Hub-Signature'
+    digest = 'sha256'
+    prefix = 'sha256='
+
+    def sender(self, data):
+        """Get the actor's nickname out of a payload."""
+        return _lookup(data, 'actor.nickname')
+
+
+class GitLabProvider(Provider):
+
+    """GitLab, which sends the secret token itself in a header."""
+
+    name = 'gitlab'
+    title = 'GitLab'
+    event_header = 'X-Gitlab-Event'
+    delivery_header = 'X-Gitlab-Event-UUID'
+    key_config = 'GITLAB_WEBHOOKS_TOKEN'
+
+    def repository(self, data):
+        """Get the project's path out of a payload."""
+        return _lookup(data, 'project.path_with_namespace')
+
+    def sender(self, data):
+        """Get the username out of a payload."""
+        return (_lookup(data, 'user_username') or
+                _lookup(data, 'user.username'))
+
+    def compile_verifier(self, key):
+        """Compare the ``X-Gitlab-Token`` header with the token."""
+        compare = _digest_comparer()
+
+        def verify(headers, body):
+            token = headers.get('X-Gitlab-Token')
+            if not token:
+                raise BadRequest('Missing token')
+            if not compare(key, token.encode('utf-8')):
+                raise BadRequest('Wrong token')
+        return verify
+
+
+#: The built-in providers, by name
+providers = {
+    'github': GitHubProvider(),
+    'gitea': GiteaProvider(),
+    'bitbucket': BitbucketProvider(),
+    'gitlab': GitLabProvider(),
+}
+
+
+def _resolve_providers(names):
+    """Turn ``HOOKS_PROVIDERS`` into a list of providers to try in order.
+
+    Gitea also sends GitHub's headers, so GitHub is tried last.
+    """
+    resolved = []
+    for p in names:
+        if not isinstance(p, Provider):
+            if p not in providers:
+                raise ValueError('Unknown provider %s' % p)
+            p = providers[p]
+        resolved.append(p)
+    return ([p for p in resolved if p.name != 'github'] +
+            [p for p in resolved if p.name == 'github'])
+
+
+def _detect_provider(enabled, headers):
+    """Pick the provider a request came from.
+
+    If none match, the first one is used, so that its checks fail with
+    the usual errors.
+    """
+    for provider in enabled:
+        if provider.detect(headers):
+            return provider
+    for provider in enabled:
+        if provider.name == 'github':
+            return provider
+    return enabled[0]
+
+
+def _warm_verifiers(config, enabled):
+    """Build the verifiers for the keys in a config ahead of time."""
+    for provider in enabled:
+        key = config.get(provider.key_config, config['SECRET_KEY'])
+        if key is not None:
+            provider.verifier(key)
+
+
+#: Headers that carry a secret, or a signature made with one
+_credential_headers = frozenset([
+    'authorization',
+    'x-gitea-signature',
+    'x-gitlab-token',
+    'x-gogs-signature',
+    'x-hub-signature',
+    'x-hub-signature-256',
+])
+
+
+def _archived_headers(provider, headers):
+    """Return the headers of a delivery, less its credentials."""
+    secret = _credential_headers
+    signature_header = getattr(provider, 'signature_header', None)
+    if signature_header is not None:
+        secret = secret | set([signature_header.lower()])
+    return dict((name, value) for name, value in headers.items()
+                if name.lower() not in secret)
+
+
+def _hook_key(provider, event):
+    """Return the key a handler is registered under."""
+    if provider == 'github':
+        return event
+    return '%s:%s' % (provider, event)
+
+
+def _token_check(app, name):
+    """Return a function that checks the request for a token.
+
+    The token is read from ``app.config[name]`` on every call, so that it
+    can be reloaded, and must be sent as ``Authorization: Bearer
+    <token>``. The function raises a 403 if it isn't.
+    """
+    compare = _digest_comparer()
+
+    def check():
+        token = app.config[name]
+        if isinstance(token, type(u'')):
+            token = token.encode('utf-8')
+        scheme, _, given = request.headers.get('Authorization',
+                                               '').partition(' ')
+        if (scheme.lower() != 'bearer' or
+                not compare(token, given.strip().encode('utf-8'))):
+            raise Forbidden('Missing or wrong token')
+    return check
+
+
+def _digest_comparer():
+    """Return a function that compares two byte strings in constant time.
+
+    Verifiers look it up once, rather than importing it per delivery.
+    """
+    import hmac
+
+    if hasattr(hmac, 'compare_digest'):
+        # Python >= 2.7.7
+        return hmac.compare_digest
+
+    import werkzeug.security
+    return werkzeug.security.safe_str_cmp
 
 
 def check_signature(signature, key, data):
     """Compute the HMAC signature and test against a given hash."""
-    if isinstance(key, type(u'')):
-        key = key.encode()
+    import werkzeug.security
 
-    digest = 'sha1=' + hmac.new(key, data, hashlib.sha1).hexdigest()
+    digest = _signature(key, data)
 
     # Covert everything to byte sequences
     if isinstance(digest, type(u'')):
@@ -189,3 +3520,452 @@ def check_signature(signature, key, data):
         signature = signature.encode()
 
     return werkzeug.security.safe_str_cmp(digest, signature)
+
+
+def _signature(key, data):
+    """Compute the ``X-Hub-Signature`` header for a body."""
+    import hashlib
+    import hmac
+
+    if isinstance(key, type(u'')):
+        key = key.encode()
+
+    return 'sha1=' + hmac.new(key, data, hashlib.sha1).hexdigest()
+
+
+# Exit status of a worker that couldn't import the app
+_LOAD_FAILED = 3
+
+
+class _ThreadPoolMixIn(object):
+
+    """Handle each request on a fixed pool of threads.
+
+    Like :class:`socketserver.ThreadingMixIn`, but with a bounded number
+    of threads. While they're all busy, new connections are left in the
+    listen backlog for other worker processes to accept.
+
+    A Server-Sent Events response stays open for good, so the thread
+    serving one leaves the pool once the response starts, and another
+    thread takes its place. Past ``max_streams`` open streams, new ones
+    get a 503.
+    """
+
+    multithread = True
+    threads = 8
+    max_streams = 32
+
+    def start_threads(self):
+        """Start the pool."""
+        self._requests = queue.Queue(self.threads)
+        self._threads = []
+        self._streams = []
+        self._streams_lock = threading.Lock()
+        self._local = threading.local()
+        self._app = self.app
+        self.app = self._serve_app
+        for i in range(self.threads):
+            self._start_thread()
+
+    def process_request(self, request, client_address):
+        """Hand a connection to the pool, waiting for a free slot."""
+        self._requests.put((request, client_address))
+
+    def drain(self, timeout):
+        """Finish the requests already accepted, then stop the pool.
+
+        Return whether every request finished in time.
+        """
+        deadline = time.time() + timeout
+        try:
+            for i in range(self.threads):
+                self._requests.put(None, timeout=max(0, deadline -
+                                                     time.time()))
+        except queue.Full:
+            return False
+        with self._streams_lock:
+            threads = self._threads + self._streams
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        return not any(thread.is_alive() for thread in threads)
+
+    def _start_thread(self):
+        thread = threading.Thread(target=self._work)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _work(self):
+        self._local.stream = False
+        while not self._local.stream:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+        with self._streams_lock:
+            self._streams.remove(threading.current_thread())
+
+    def _leave_pool(self):
+        """Swap the current thread out of the pool for a new one.
+
+        Return ``False`` if there are ``max_streams`` already.
+        """
+        with self._streams_lock:
+            if len(self._streams) >= self.max_streams:
+                return False
+            current = threading.current_thread()
+            self._threads.remove(current)
+            self._streams.append(current)
+            self._local.stream = True
+            self._start_thread()
+        return True
+
+    def _serve_app(self, environ, start_response):
+        """Call the app, taking streams out of the pool."""
+        rejected = []
+
+        def start(status, headers, exc_info=None):
+            content_type = dict((name.lower(), value)
+                                for name, value in headers).get(
+                                    'content-type', '')
+            if (content_type.startswith('text/event-stream') and
+                    not self._leave_pool()):
+                rejected.append(True)
+                return start_response('503 SERVICE UNAVAILABLE', [
+                    ('Content-Type', 'text/plain'), ('Retry-After', '60')])
+            return start_response(status, headers, exc_info)
+
+        rv = self._app(environ, start)
+        if rejected:
+            if hasattr(rv, 'close'):
+                rv.close()
+            return [b'Too many open streams\n']
+        return rv
+
+
+def _load_app(path):
+    """Import an app from ``module:name``, where the name defaults to app."""
+    import importlib
+    import sys
+
+    module, _, name = path.partition(':')
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module), name or 'app')
+
+
+def _warm_caches(app):
+    """Do the slow parts of validating a delivery ahead of the first one.
+
+    This imports requests and fetches GitHub's networks, compiles the IP
+    allowlists, keys the HMACs and forks the handler processes.
+    """
+    state = app.extensions.get('hookserver')
+    if state is None:
+        return
+    if app.config['VALIDATE_SIGNATURE']:
+        _warm_verifiers(app.config, state['providers'])
+    if 'process_pool' in state:
+        # The app is fully imported by now, along with its handlers
+        state['process_pool'].start()
+    if app.config['VALIDATE_IP']:
+        with app.app_context():
+            for provider in state['providers']:
+                try:
+                    provider.allowlist()
+                except HTTPException as e:
+                    app.logger.warning('Couldn\'t load the %s networks: %s',
+                                       provider.title, e.description)
+
+
+def _stop_hooks(app):
+    """Stop the extension's threads, writing out anything buffered."""
+    state = app.extensions.get('hookserver', {})
+    if 'hooks' in state:
+        for target in state['hooks']._relays:
+            target.close()
+    for name in ('retries', 'scheduler', 'lanes'):
+        if name in state:
+            state[name].shutdown()
+    for name in ('reloader', 'analytics', 'process_pool', 'log', 'archive'):
+        if name in state:
+            state[name].close()
+
+
+def _end_streams(app):
+    """End the app's open event streams, rather than wait for them."""
+    stream = app.extensions.get('hookserver', {}).get('stream')
+    if stream is not None:
+        stream.close()
+
+
+def _run_worker(sock, app_path, threads, graceful_timeout, max_streams=32):
+    """Serve requests from a listening socket until SIGTERM."""
+    import signal
+    from werkzeug.serving import BaseWSGIServer
+
+    parent = os.getppid()
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    if hasattr(signal, 'SIGHUP'):
+        # Only a reloader should act on the SIGHUP sent to every worker
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    try:
+        app = _load_app(app_path)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return _LOAD_FAILED
+    _warm_caches(app)
+
+    server_class = type('WorkerServer', (_ThreadPoolMixIn, BaseWSGIServer),
+                        {'threads': threads, 'max_streams': max_streams,
+                         'multiprocess': True})
+    host, port = sock.getsockname()[:2]
+    server = server_class(host, port, app, fd=sock.fileno())
+    sock.close()
+    server.start_threads()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    # Wake up now and then, so signals get handled on Python 2
+    while not stopping.wait(1):
+        if os.getppid() != parent:
+            break
+    server.shutdown()
+    thread.join()
+    # Streams would otherwise stay open until the timeout
+    _end_streams(app)
+    if not server.drain(graceful_timeout):
+        app.logger.warning('Gave up on requests still running after %ss',
+                           graceful_timeout)
+    _stop_hooks(app)
+    return 0
+
+
+def _serve_gunicorn(app, host, port, workers, threads, backlog,
+                    graceful_timeout):
+    """Serve an app under Gunicorn's arbiter and threaded workers."""
+    from gunicorn.app.base import BaseApplication
+    from gunicorn.workers.gthread import ThreadWorker
+
+    class Worker(ThreadWorker):
+
+        def handle_exit(self, sig, frame):
+            ThreadWorker.handle_exit(self, sig, frame)
+            # Streams would otherwise hold the worker until the timeout.
+            # This is a signal handler, so leave the locks to a thread.
+            if hasattr(self, 'wsgi'):
+                thread = threading.Thread(target=_end_streams,
+                                          args=(self.wsgi,))
+                thread.daemon = True
+                thread.start()
+
+    def worker_exit(arbiter, worker):
+        if hasattr(worker, 'wsgi'):
+            _stop_hooks(worker.wsgi)
+
+    options = {
+        'bind': ('[%s]:%d' if ':' in host else '%s:%d') % (host, port),
+        'workers': workers,
+        'threads': threads,
+        'worker_class': Worker,
+        'backlog': backlog,
+        'graceful_timeout': graceful_timeout,
+        'post_worker_init': lambda worker: _warm_caches(worker.wsgi),
+        'worker_exit': worker_exit,
+    }
+
+    class Application(BaseApplication):
+
+        def load_config(self):
+            for name, value in options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return _load_app(app)
+
+    try:
+        Application().run()
+    except SystemExit as e:
+        return e.code or 0
+    return 0
+
+
+def serve(app, host='127.0.0.1', port=8000, workers=None, threads=8,
+          backlog=128, graceful_timeout=30, max_streams=32,
+          server='werkzeug'):
+    """Serve an app on worker processes, each with a pool of threads.
+
+    The listening socket is opened first and shared by the workers. Each
+    worker imports the app itself, since the extension's threads don't
+    survive a fork, and warms its validation caches before accepting
+    connections. Workers that die are replaced.
+
+    On SIGTERM or SIGINT, the workers stop accepting connections and
+    finish the requests they already have, then the background threads
+    write out their buffers. Open event streams are ended. SIGHUP is
+    passed on to the workers, to be used with ``HOOKS_RELOAD_SIGNAL``.
+
+    The workers serve HTTP with Werkzeug's development server. With
+    ``server='gunicorn'``, Gunicorn's arbiter and threaded workers do
+    instead, and the workers still warm their caches, end their streams
+    on SIGTERM and write out their buffers on the way out. Gunicorn
+    stops straight away on SIGINT, and starts new workers on SIGHUP.
+
+    :param app: the app's import path, as ``module:name``
+    :param host: the address to listen on
+    :param port: the port to listen on
+    :param workers: the number of worker processes, by default one per
+                    CPU
+    :param threads: the number of requests each worker handles at once
+    :param backlog: the number of connections the kernel queues while
+                    every worker is busy
+    :param graceful_timeout: seconds to wait for requests to finish
+                             after SIGTERM, before killing the workers
+    :param max_streams: the number of event streams each worker serves
+                        at once, on threads of their own; under Gunicorn,
+                        each stream takes one of the threads instead
+    :param server: ``'werkzeug'``, or ``'gunicorn'`` to have Gunicorn
+                   serve the app
+    :return: the exit status
+    """
+    import multiprocessing
+    import signal
+    import socket
+    import sys
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if server == 'gunicorn':
+        return _serve_gunicorn(app, host, port, workers, threads, backlog,
+                               graceful_timeout)
+    if server != 'werkzeug':
+        raise ValueError('Unknown server %r' % server)
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+
+    children = {}
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = _run_worker(sock, app, threads, graceful_timeout,
+                                     max_streams)
+            finally:
+                os._exit(status)
+        children[pid] = time.time()
+
+    def signal_children(signum):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop(signum=None, frame=None):
+        if not stopping:
+            stopping.append(time.time())
+            signal_children(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: signal_children(signum))
+
+    for i in range(workers):
+        spawn()
+    sys.stderr.write('Listening on %s:%d with %d workers of %d threads\n' %
+                     (host, sock.getsockname()[1], workers, threads))
+
+    status = 0
+    while children:
+        try:
+            pid, code = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            break
+        if pid == 0:
+            if (stopping and
+                    time.time() > stopping[0] + graceful_timeout + 5):
+                signal_children(signal.SIGKILL)
+            time.sleep(0.1)
+            continue
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        if os.WIFEXITED(code) and os.WEXITSTATUS(code) == _LOAD_FAILED:
+            sys.stderr.write('Couldn\'t load %s, stopping\n' % app)
+            status = _LOAD_FAILED
+            stop()
+            continue
+        sys.stderr.write('Worker %d died, starting another\n' % pid)
+        if time.time() - started < 1:
+            # Don't fork as fast as possible if workers die straight away
+            time.sleep(1)
+        spawn()
+    sock.close()
+    return status
+
+
+def main(argv=None):
+    """Run the command line interface, ``python -m flask_hookserver``."""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m flask_hookserver')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser(
+        'serve', help='serve an app on worker processes and threads')
+    command.add_argument('app', help='the app to serve, as module:name')
+    command.add_argument('-b', '--bind', default='127.0.0.1:8000',
+                         help='host:port to listen on '
+                              '(default: %(default)s)')
+    command.add_argument('-w', '--workers', type=int, default=None,
+                         help='worker processes (default: one per CPU)')
+    command.add_argument('-t', '--threads', type=int, default=8,
+                         help='threads per worker (default: %(default)s)')
+    command.add_argument('--backlog', type=int, default=128,
+                         help='connections to queue while every worker is '
+                              'busy (default: %(default)s)')
+    command.add_argument('--graceful-timeout', type=float, default=30,
+                         help='seconds to let requests finish on SIGTERM '
+                              '(default: %(default)s)')
+    command.add_argument('--max-streams', type=int, default=32,
+                         help='event streams per worker, on threads of '
+                              'their own (default: %(default)s)')
+    command.add_argument('--server', choices=['werkzeug', 'gunicorn'],
+                         default='werkzeug',
+                         help='the HTTP server the workers run '
+                              '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error('no command given')
+
+    host, _, port = args.bind.rpartition(':')
+    return serve(args.app, host=host.strip('[]') or '127.0.0.1',
+                 port=int(port), workers=args.workers, threads=args.threads,
+                 backlog=args.backlog,
+                 graceful_timeout=args.graceful_timeout,
+                 max_streams=args.max_streams, server=args.server)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    # Use the importable copy of the module, which the app shares
+    import sys
+    from flask_hookserver import main
+    sys.exit(main())
@@ -4,6 +4,7 @@ from flask.ext.hookserver import Hooks
 
 app = Flask(__name__)
 app.config['GITHUB_WEBHOOKS_KEY'] = 'my_secret_key'
+app.config['HOOKS_LOG_PATH'] = 'deliveries.log'
 
 hooks = Hooks(app, url='/hooks')
 
@@ -11,11 +12,16 @@ hooks = Hooks(app, url='/hooks')
 def ping(data, guid):
     return 'pong'
 
-@hooks.hook('push')
+push_schema = {
+    'type': 'object',
+    'required': ['ref'],
+    'properties': {'ref': {'type': 'string'}},
+}
+
+@hooks.hook('push', timeout=600, max_concurrency=1, schema=push_schema)
 def new_code(data, delivery):
     res = os.system("sh ~/quokka-env/quokka/quokka-push.sh")
-    print res  
-    print('New push to %s' % data['ref'])
-    return 'Thanks'   
+    return 'Deploy of %s exited with %d' % (data['ref'], res)
 
-app.run(host='0.0.0.0',port='8000')
+if __name__ == '__main__':
+    app.run(host='0.0.0.0',port='8000')
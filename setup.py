@@ -37,6 +37,9 @@ setup(
     license='MIT',
     py_modules=['flask_hookserver'],
     install_requires=requirements,
+    extras_require={
+        'gunicorn': ['gunicorn>=19.7'],
+    },
     keywords=['github', 'webhooks', 'flask'],
     classifiers=[
         'Development Status :: 5 - Production/Stable',
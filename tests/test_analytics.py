@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Test heavy-hitter tracking of repositories, senders and events."""
+
+from collections import Counter
+from flask.ext.hookserver import (CountMinSketch, HeavyHitters, Hooks,
+                                  SpaceSaving)
+import flask
+import json
+import random
+
+
+def zipf_stream(n, keys=1000, seed=0):
+    """Return n keys, where key i turns up about 1 / i as often."""
+    rng = random.Random(seed)
+    weights = [1.0 / i for i in range(1, keys + 1)]
+    names = ['repo%d' % i for i in range(1, keys + 1)]
+    total = sum(weights)
+    cumulative = []
+    running = 0
+    for w in weights:
+        running += w / total
+        cumulative.append(running)
+    stream = []
+    for _ in range(n):
+        r = rng.random()
+        lo, hi = 0, keys - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cumulative[mid] < r:
+                lo = mid + 1
+            else:
+                hi = mid
+        stream.append(names[lo])
+    return stream
+
+
+def test_count_min_sketch():
+    stream = zipf_stream(20000)
+    exact = Counter(stream)
+    sketch = CountMinSketch(width=512, depth=4)
+    for key in stream:
+        sketch.add(key)
+
+    assert sketch.total == 20000
+    bound = 2.72 / 512 * 20000
+    for key, count in exact.items():
+        assert count <= sketch.estimate(key) <= count + bound
+    assert sketch.estimate('never seen') <= bound
+
+
+def test_sketch_merge():
+    a = CountMinSketch(width=64, depth=3)
+    b = CountMinSketch(width=64, depth=3)
+    a.add('a/b', 3)
+    b.add('a/b', 4)
+    b.add(u'ünïcode', 2)
+    a.merge(b)
+    assert a.estimate('a/b') == 7
+    assert a.estimate(u'ünïcode') == 2
+    assert a.total == 9
+
+
+def test_space_saving():
+    stream = zipf_stream(20000)
+    exact = Counter(stream)
+    summary = SpaceSaving(k=20)
+    for key in stream:
+        summary.add(key)
+
+    assert len(summary.counts) == 20
+    for key, count, error in summary.top():
+        assert count - error <= exact[key] <= count
+    # The top keys are the real top keys
+    assert ([key for key, _, _ in summary.top(3)] ==
+            [key for key, _ in exact.most_common(3)])
+
+
+def test_space_saving_merge():
+    a, b = SpaceSaving(k=10), SpaceSaving(k=10)
+    stream = zipf_stream(10000)
+    for i, key in enumerate(stream):
+        (a if i % 2 else b).add(key)
+    a.merge(b)
+
+    exact = Counter(stream)
+    assert len(a.counts) == 10
+    for key, count, error in a.top():
+        assert count - error <= exact[key] <= count
+    assert a.top(1)[0][0] == 'repo1'
+
+
+def test_window():
+    hh = HeavyHitters(window=60, buckets=6)
+    hh.add('a/b', 'alice', 'push', 100, now=0)
+    hh.add('a/b', 'bob', 'push', 50, now=30)
+    hh.add('c/d', 'alice', 'ping', 10, now=55)
+
+    top = hh.top('repository', now=59)
+    assert top[0] == {'key': 'a/b', 'count': 2, 'error': 0}
+    assert hh.top('sender', 'bytes', now=59)[0]['key'] == 'alice'
+    assert hh.estimate('repository', 'a/b', now=59) == {'deliveries': 2,
+                                                        'bytes': 150}
+    assert hh.report(now=59)['totals'] == {'deliveries': 3, 'bytes': 160}
+
+    # The first bucket has slid out of the window
+    assert hh.estimate('repository', 'a/b', now=61) == {'deliveries': 1,
+                                                        'bytes': 50}
+    assert hh.report(now=200)['totals'] == {'deliveries': 0, 'bytes': 0}
+
+
+def test_fixed_memory():
+    hh = HeavyHitters(window=60, buckets=3, k=10, width=64)
+    for i in range(5000):
+        hh.add('repo%d' % i, 'user%d' % i, 'push', 1, now=i / 10.0)
+    assert len(hh._buckets) <= 4
+    for bucket in hh._buckets.values():
+        for sketch, summary in bucket.values():
+            assert len(sketch.counts) == 64 * 4
+            assert len(summary.counts) <= 10
+
+
+def test_dumps_and_merge():
+    a = HeavyHitters(window=60, buckets=6)
+    b = HeavyHitters(window=60, buckets=6)
+    a.add('a/b', 'alice', 'push', 100, now=10)
+    b.add('a/b', 'bob', 'push', 200, now=20)
+    b.add('c/d', None, 'ping', 5, now=20)
+
+    a.merge(HeavyHitters.loads(b.dumps()))
+    assert a.estimate('repository', 'a/b', now=30) == {'deliveries': 2,
+                                                       'bytes': 300}
+    assert [e['key'] for e in a.top('event', now=30)] == ['push', 'ping']
+    assert a.top('sender', now=30)[0]['count'] == 1
+
+
+def test_shared_path(tmpdir):
+    path = str(tmpdir.join('analytics'))
+    other = HeavyHitters(window=60)
+    other.add('a/b', 'alice', 'push', 10)
+    hh = HeavyHitters(window=60, path=path, interval=60)
+    with open(str(tmpdir.join('analytics', '1.hh')), 'wb') as f:
+        f.write(other.dumps())
+    with open(str(tmpdir.join('analytics', '2.hh')), 'wb') as f:
+        f.write(b'half written')
+
+    hh.add('a/b', 'bob', 'push', 20)
+    combined = hh.combined()
+    assert combined.estimate('repository', 'a/b')['bytes'] == 30
+    assert hh.estimate('repository', 'a/b')['bytes'] == 20
+
+    hh.close()
+    assert len(tmpdir.join('analytics').listdir('*.hh')) == 3
+
+
+def test_hooks_analytics():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_ANALYTICS'] = True
+    app.config['HOOKS_ANALYTICS_TOKEN'] = 'analytics token'
+    Hooks(app)
+    client = app.test_client()
+
+    for i, repo in enumerate(['a/b', 'a/b', 'c/d']):
+        data = json.dumps({'repository': {'full_name': repo},
+                           'sender': {'login': 'alice'}})
+        headers = {'X-GitHub-Event': 'push', 'X-GitHub-Delivery': str(i)}
+        client.post('/hooks', content_type='application/json', data=data,
+                    headers=headers)
+
+    assert client.get('/hooks/analytics').status_code == 403
+    rv = client.get('/hooks/analytics?n=1&repository=c/d',
+                    headers={'Authorization': 'Bearer analytics token'})
+    report = json.loads(rv.data.decode())
+    assert report['totals']['deliveries'] == 3
+    assert report['top']['repository']['deliveries'] == [
+        {'key': 'a/b', 'count': 2, 'error': 0}]
+    assert report['top']['sender']['deliveries'][0]['count'] == 3
+    assert report['estimates'] == {'repository': {'deliveries': 1,
+                                                  'bytes': 66}}
+
+
+def test_hooks_analytics_no_token():
+    app = flask.Flask(__name__)
+    app.config['HOOKS_ANALYTICS'] = True
+    Hooks(app)
+    assert app.test_client().get('/hooks/analytics').status_code == 404
+    app.extensions['hookserver']['analytics'].close()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Test the delivery archive."""
+
+from flask.ext.hookserver import DeliveryArchive, Hooks
+import flask
+import json
+import os
+import pytest
+
+
+@pytest.fixture
+def archive(request, tmpdir):
+    archive = DeliveryArchive(str(tmpdir.join('archive')))
+    request.addfinalizer(archive.close)
+    return archive
+
+
+def test_get(archive):
+    archive.append('abc', 'push', 'a/b', {'X-GitHub-Event': 'push'}, b'{}')
+    archive.append('def', 'ping', None, {}, b'{"zen": "hi"}')
+    archive.flush()
+
+    record = archive.get('abc')
+    assert record['event'] == 'push'
+    assert record['repository'] == 'a/b'
+    assert record['headers'] == {'X-GitHub-Event': 'push'}
+    assert record['body'] == b'{}'
+
+    assert archive.get('def')['body'] == b'{"zen": "hi"}'
+    assert archive.get('ghi') is None
+
+
+def test_find(archive):
+    archive.append('1', 'push', 'a/b', {}, b'1', timestamp=100)
+    archive.append('2', 'push', 'c/d', {}, b'2', timestamp=200)
+    archive.append('3', 'ping', 'a/b', {}, b'3', timestamp=300)
+    archive.flush()
+
+    def guids(records):
+        return [r['guid'] for r in records]
+
+    assert guids(archive.find()) == ['1', '2', '3']
+    assert guids(archive.find(event='push')) == ['1', '2']
+    assert guids(archive.find(repository='a/b')) == ['1', '3']
+    assert guids(archive.find(event='push', repository='a/b')) == ['1']
+    assert guids(archive.find(since=150)) == ['2', '3']
+    assert guids(archive.find(since=100, until=200)) == ['1', '2']
+
+
+def test_reload(tmpdir):
+    path = str(tmpdir.join('archive'))
+    archive = DeliveryArchive(path)
+    archive.append('abc', 'push', 'a/b', {}, b'body')
+    archive.close()
+
+    archive = DeliveryArchive(path)
+    archive.append('def', 'push', 'a/b', {}, b'more')
+    archive.close()
+    assert archive.get('abc')['body'] == b'body'
+    assert [r['guid'] for r in archive.find(repository='a/b')] == ['abc',
+                                                                   'def']
+
+
+def test_key_files(tmpdir):
+    path = str(tmpdir.join('archive'))
+    archive = DeliveryArchive(path, segment_size=1)
+    for i in range(10):
+        archive.append(str(i), 'push' if i % 2 else 'ping', 'a/%d' % (i % 3),
+                       {}, b'', timestamp=i)
+    archive.close()
+
+    # Finished segments are looked up in their key files, not scanned
+    for name in os.listdir(path):
+        if name.endswith('.idx'):
+            assert os.path.exists(os.path.join(path, name[:-4] + '.key'))
+            open(os.path.join(path, name), 'w').close()
+    assert archive.get('7')['timestamp'] == 7
+    assert [r['guid'] for r in archive.find(event='push', since=2,
+                                            until=7)] == ['3', '5', '7']
+    assert [r['guid'] for r in archive.find(repository='a/1')] == [
+        '1', '4', '7']
+
+
+def test_hash_collisions(tmpdir, monkeypatch):
+    # Every key has the same hash
+    monkeypatch.setattr('flask_hookserver._archive_key',
+                        lambda field, value: 0)
+    path = str(tmpdir.join('archive'))
+    archive = DeliveryArchive(path, segment_size=1)
+    archive.append('abc', 'push', 'a/b', {}, b'1', timestamp=1)
+    archive.append('def', 'ping', 'c/d', {}, b'2', timestamp=2)
+    archive.close()
+
+    assert archive.get('abc')['body'] == b'1'
+    assert archive.get('ghi') is None
+    assert [r['guid'] for r in archive.find(event='ping')] == ['def']
+    assert [r['guid'] for r in archive.find(repository='a/b')] == ['abc']
+
+
+def test_shared_directory(tmpdir):
+    # As if two worker processes were archiving to the same place
+    path = str(tmpdir.join('archive'))
+    a = DeliveryArchive(path)
+    b = DeliveryArchive(path)
+    try:
+        a.append('a1', 'push', 'a/b', {}, b'{"from": "a"}', timestamp=100)
+        b.append('b1', 'push', 'a/b', {}, b'{"from": "b"}', timestamp=200)
+        a.append('a2', 'ping', None, {}, b'{"from": "a"}', timestamp=300)
+        a.flush()
+        b.flush()
+
+        for archive in (a, b):
+            assert archive.get('a1')['body'] == b'{"from": "a"}'
+            assert archive.get('b1')['body'] == b'{"from": "b"}'
+            assert [r['guid'] for r in archive.find(event='push')] == [
+                'a1', 'b1']
+        segments = [n for n in os.listdir(path) if n.endswith('.seg')]
+        assert len(segments) == 2
+    finally:
+        a.close()
+        b.close()
+
+
+def test_shared_retention(tmpdir):
+    path = str(tmpdir.join('archive'))
+    a = DeliveryArchive(path, segment_size=1, max_age=60)
+    b = DeliveryArchive(path)
+    try:
+        a.append('old', 'push', None, {}, b'', timestamp=0)
+        a.flush()
+        assert b.get('old') is not None
+        a.append('new', 'push', None, {}, b'')
+        a.flush()
+        # b notices that a has deleted the old segment
+        assert b.get('old') is None
+        assert b.get('new') is not None
+    finally:
+        a.close()
+        b.close()
+
+
+def test_rotation_and_retention(tmpdir):
+    path = str(tmpdir.join('archive'))
+    archive = DeliveryArchive(path, segment_size=1, max_bytes=600)
+    for i in range(20):
+        archive.append(str(i), 'push', None, {}, os.urandom(64))
+    archive.close()
+
+    segments = [n for n in os.listdir(path) if n.endswith('.seg')]
+    assert 1 < len(segments) < 20
+    assert archive.get('0') is None
+    assert archive.get('19') is not None
+
+
+def test_max_age(tmpdir):
+    path = str(tmpdir.join('archive'))
+    archive = DeliveryArchive(path, segment_size=1, max_age=60)
+    archive.append('old', 'push', None, {}, b'', timestamp=0)
+    archive.append('new', 'push', None, {}, b'')
+    archive.close()
+
+    assert archive.get('old') is None
+    assert archive.get('new') is not None
+
+
+def test_dropped(tmpdir):
+    archive = DeliveryArchive(str(tmpdir.join('archive')), queue_size=1)
+    # Hold the writer up on the lock so the queue fills
+    with archive._lock:
+        for i in range(10):
+            archive.append(str(i), 'push', None, {}, b'')
+    archive.close()
+    assert archive.dropped > 0
+
+
+def test_write_errors(tmpdir):
+    path = str(tmpdir.join('archive'))
+    archive = DeliveryArchive(path)
+
+    # As if the disk had gone away
+    os.rmdir(path)
+    tmpdir.join('archive').write('')
+    archive.append('a', 'push', None, {}, b'')
+    archive.append('b', 'push', None, {}, b'')
+    archive.flush()
+    assert archive.lost == 2
+
+    # The writer thread is still there once it comes back
+    os.remove(path)
+    os.mkdir(path)
+    archive.append('c', 'push', None, {}, b'')
+    archive.close()
+    assert archive.get('a') is None
+    assert archive.get('c') is not None
+
+
+def test_hooks_archive(tmpdir):
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_ARCHIVE_PATH'] = str(tmpdir.join('archive'))
+    Hooks(app)
+    archive = app.extensions['hookserver']['archive']
+
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+    }
+    data = json.dumps({'repository': {'full_name': 'a/b'}})
+    rv = app.test_client().post('/hooks', content_type='application/json',
+                                data=data, headers=headers)
+    assert rv.status_code == 200
+    archive.close()
+
+    record = archive.get('abc')
+    assert record['repository'] == 'a/b'
+    assert record['body'] == data.encode()
+    assert record['headers']['X-Github-Event'] == 'push'
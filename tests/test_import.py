@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Benchmark how long the extension takes to import."""
+
+import os
+import pytest
+import subprocess
+import sys
+
+#: Time in milliseconds that importing the extension may add on top of Flask
+IMPORT_BUDGET_MS = 25
+
+#: Modules that should only be imported once they're needed. hmac, hashlib
+#: and ipaddress are left out, since Flask imports them anyway.
+LAZY_MODULES = ['requests', 'werkzeug.security']
+
+
+def import_times():
+    """Import the extension in a new interpreter, return the timings.
+
+    Flask is imported first, so that only what the extension adds is
+    counted. Returns a dict of module name to cumulative microseconds.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    # Otherwise the time taken to compile the module would be counted
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    code = 'import flask; import flask_hookserver'
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=root, env=env, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    assert proc.returncode == 0, err
+
+    times = {}
+    seen_flask = False
+    for line in err.decode().splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if seen_flask:
+            times[name] = int(cumulative)
+        elif name == 'flask':
+            seen_flask = True
+    return times
+
+
+def imported_modules():
+    """Import the extension in a new interpreter.
+
+    Return the modules Flask imported, and the ones the extension added.
+    """
+    code = ('import sys; import flask; flask_modules = set(sys.modules); '
+            'import flask_hookserver; '
+            'print(" ".join(sorted(flask_modules))); '
+            'print(" ".join(sorted(set(sys.modules) - flask_modules)))')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    flask_modules, added = out.decode().splitlines()
+    return set(flask_modules.split()), set(added.split())
+
+
+def test_lazy_imports():
+    flask_modules, added = imported_modules()
+    assert 'flask_hookserver' in added
+    for name in LAZY_MODULES:
+        # Otherwise the check below could never fail
+        assert name not in flask_modules
+        assert name not in added
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='-X importtime needs Python 3.7')
+def test_import_budget():
+    import_times()
+    best = min(import_times()['flask_hookserver'] for i in range(5))
+    assert best / 1000.0 < IMPORT_BUDGET_MS
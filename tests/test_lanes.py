@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Test ordered execution per repository."""
+
+from flask.ext.hookserver import Hooks, ShardedExecutor
+from werkzeug.exceptions import ServiceUnavailable
+import flask
+import json
+import pytest
+import threading
+import time
+
+
+@pytest.fixture
+def lanes(request):
+    lanes = ShardedExecutor(4, queue_size=10)
+    request.addfinalizer(lanes.shutdown)
+    return lanes
+
+
+def test_same_key_in_order(lanes):
+    order = []
+
+    def work(i):
+        # Later calls are quicker, so they'd finish first if run in parallel
+        time.sleep(0.01 * (5 - i))
+        order.append(i)
+
+    futures = [lanes.submit(12345, work, i) for i in range(5)]
+    for future in futures:
+        future.result(1)
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_different_keys_in_parallel(lanes):
+    keys = [1, 2]
+    while lanes.lane(keys[0]) == lanes.lane(keys[1]):
+        keys[1] += 1
+
+    release = threading.Event()
+    blocked = lanes.submit(keys[0], release.wait)
+    assert lanes.submit(keys[1], lambda: 'done').result(1) == 'done'
+    assert not blocked.done()
+    release.set()
+    blocked.result(1)
+
+
+def test_bounded_queue(lanes):
+    release = threading.Event()
+    lanes.submit('a', release.wait)
+    # Give the lane time to pick up the first call
+    time.sleep(0.05)
+    for i in range(10):
+        lanes.submit('a', lambda: None)
+    with pytest.raises(ServiceUnavailable):
+        lanes.submit('a', lambda: None)
+
+    stats = lanes.stats()
+    assert stats[lanes.lane('a')]['queued'] == 10
+    release.set()
+
+
+def test_hooks_lanes():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_LANES'] = 2
+    hooks = Hooks(app)
+
+    @hooks.hook('push')
+    def push(data, guid):
+        return 'Pushed to %d' % data['repository']['id']
+
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+    }
+    data = json.dumps({'repository': {'id': 42}})
+    rv = app.test_client().post('/hooks', content_type='application/json',
+                                data=data, headers=headers)
+    assert rv.data == b'Pushed to 42'
+
+    lanes = app.extensions['hookserver']['lanes']
+    assert lanes.stats()[lanes.lane(42)]['completed'] == 1
+    lanes.shutdown()
+
+
+def test_lanes_and_workers():
+    app = flask.Flask(__name__)
+    app.config['HOOKS_LANES'] = 2
+    app.config['HOOKS_WORKERS'] = 2
+    with pytest.raises(ValueError):
+        Hooks(app)
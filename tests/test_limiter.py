@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Test adaptive concurrency limiting."""
+
+from flask.ext.hookserver import ConcurrencyLimiter, Hooks
+from werkzeug.exceptions import ServiceUnavailable
+import flask
+import pytest
+import threading
+
+
+def test_reject_over_limit():
+    limiter = ConcurrencyLimiter(2)
+    limiter.acquire()
+    limiter.acquire()
+    with pytest.raises(ServiceUnavailable):
+        limiter.acquire()
+    assert limiter.stats()['rejected'] == 1
+
+    limiter.release(0.1)
+    limiter.acquire()
+    assert limiter.stats()['in_flight'] == 2
+
+
+def test_additive_increase():
+    limiter = ConcurrencyLimiter(4, latency_target=1)
+    # About one more for every four quick deliveries
+    for i in range(5):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.stats()['limit'] == 5
+
+
+def test_multiplicative_decrease():
+    limiter = ConcurrencyLimiter(100, latency_target=1, min_limit=10)
+    limiter.acquire()
+    limiter.release(2)
+    assert limiter.stats()['limit'] == 90
+    for i in range(50):
+        limiter.acquire()
+        limiter.release(2)
+    assert limiter.stats()['limit'] == 10
+
+
+def test_retry_after():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_CONCURRENCY_LIMIT'] = 1
+    hooks = Hooks(app)
+    started = threading.Event()
+    release = threading.Event()
+
+    @hooks.hook('push')
+    def push(data, guid):
+        started.set()
+        release.wait()
+        return 'Pushed'
+
+    thread = threading.Thread(target=post, args=(app,))
+    thread.start()
+    started.wait()
+
+    rv = post(app)
+    assert rv.status_code == 503
+    assert rv.headers['Retry-After'] == '1'
+    release.set()
+    thread.join()
+    assert post(app).status_code == 200
+
+
+def post(app):
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+    }
+    return app.test_client().post('/hooks', content_type='application/json',
+                                  data='{}', headers=headers)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Test handler timeouts, concurrency caps and circuit breakers."""
+
+from flask.ext.hookserver import CircuitBreaker, Hooks
+from time import sleep
+import flask
+import json
+import pytest
+import threading
+
+
+@pytest.fixture
+def app():
+    server = flask.Flask(__name__)
+    server.config['VALIDATE_IP'] = False
+    server.config['VALIDATE_SIGNATURE'] = False
+    return server
+
+
+def post(client, hook, data=None, guid='abc'):
+    headers = {
+        'X-GitHub-Event': hook,
+        'X-GitHub-Delivery': guid,
+    }
+    return client.post('/hooks', content_type='application/json',
+                       data=json.dumps(data or {}), headers=headers)
+
+
+def test_timeout(app):
+    hooks = Hooks(app)
+    done = threading.Event()
+
+    @hooks.hook('push', timeout=0.1)
+    def slow(data, guid):
+        done.wait()
+        return 'done'
+
+    @hooks.hook('ping', timeout=1)
+    def fast(data, guid):
+        return 'pong'
+
+    client = app.test_client()
+    rv = post(client, 'push')
+    assert rv.status_code == 504
+    done.set()
+
+    rv = post(client, 'ping')
+    assert rv.data == b'pong'
+    assert hooks.handler_stats()['push']['timeouts'] == 1
+
+
+def test_timeout_error(app):
+    hooks = Hooks(app)
+
+    @hooks.hook('push', timeout=1)
+    def broken(data, guid):
+        raise ValueError('oops')
+
+    app.config['TESTING'] = True
+    with pytest.raises(ValueError):
+        post(app.test_client(), 'push')
+
+
+def test_max_concurrency(app):
+    hooks = Hooks(app)
+    started = threading.Event()
+    release = threading.Event()
+
+    @hooks.hook('push', max_concurrency=1)
+    def deploy(data, guid):
+        started.set()
+        release.wait()
+        return 'deployed'
+
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(post(app.test_client(), 'push')))
+    thread.start()
+    started.wait()
+
+    rv = post(app.test_client(), 'push')
+    assert rv.status_code == 503
+    assert hooks.handler_stats()['push']['active'] == 1
+
+    release.set()
+    thread.join()
+    assert results[0].status_code == 200
+    assert post(app.test_client(), 'push').status_code == 200
+
+
+def test_timed_out_call_keeps_slot(app):
+    hooks = Hooks(app)
+    release = threading.Event()
+
+    @hooks.hook('push', timeout=0.05, max_concurrency=1)
+    def deploy(data, guid):
+        release.wait()
+        return 'deployed'
+
+    client = app.test_client()
+    assert post(client, 'push').status_code == 504
+    assert post(client, 'push').status_code == 503
+    release.set()
+    sleep(0.05)
+    assert post(client, 'push').status_code == 200
+
+
+def test_circuit_breaker(app):
+    hooks = Hooks(app)
+    fail = [True]
+
+    @hooks.hook('push', failure_threshold=2, reset_timeout=0.1)
+    def deploy(data, guid):
+        if fail[0]:
+            raise ValueError('downstream is down')
+        return 'deployed'
+
+    client = app.test_client()
+    assert post(client, 'push').status_code == 500
+    assert hooks.handler_stats()['push']['breaker'] == 'closed'
+    assert post(client, 'push').status_code == 500
+    assert hooks.handler_stats()['push']['breaker'] == 'open'
+
+    rv = post(client, 'push')
+    assert rv.status_code == 503
+    assert hooks.handler_stats()['push']['calls'] == 2
+
+    sleep(0.1)
+    assert hooks.handler_stats()['push']['breaker'] == 'half-open'
+    fail[0] = False
+    assert post(client, 'push').status_code == 200
+    assert hooks.handler_stats()['push']['breaker'] == 'closed'
+
+
+def test_breaker_half_open():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    sleep(0.05)
+    assert breaker.allow()
+    # Only one trial call at a time
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    sleep(0.05)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_client_errors_dont_trip(app):
+    hooks = Hooks(app)
+
+    @hooks.hook('push', failure_threshold=1)
+    def deploy(data, guid):
+        flask.abort(400)
+
+    client = app.test_client()
+    assert post(client, 'push').status_code == 400
+    assert post(client, 'push').status_code == 400
+    assert hooks.handler_stats()['push']['breaker'] == 'closed'
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Test the structured delivery log."""
+
+from flask.ext.hookserver import DeliveryLog, Hooks
+import flask
+import json
+import pytest
+import socket
+import threading
+import time
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_file(tmpdir):
+    path = str(tmpdir.join('deliveries.log'))
+    log = DeliveryLog(path=path)
+    log.write({'guid': 'abc'})
+    log.write({'guid': 'def'})
+    log.close()
+
+    assert read_records(path) == [{'guid': 'abc'}, {'guid': 'def'}]
+    assert log.stats()['written'] == 2
+
+
+def test_batches(tmpdir):
+    path = str(tmpdir.join('deliveries.log'))
+    log = DeliveryLog(path=path, batch_size=2, interval=60)
+    log.write({'guid': 'abc'})
+    log.write({'guid': 'def'})
+    # The background thread is woken up by a full batch
+    for i in range(100):
+        if log.stats()['written'] == 2:
+            break
+        time.sleep(0.01)
+    assert read_records(path) == [{'guid': 'abc'}, {'guid': 'def'}]
+    log.close()
+
+
+def test_dropped(tmpdir):
+    path = str(tmpdir.join('deliveries.log'))
+    log = DeliveryLog(path=path, capacity=3, interval=60, batch_size=10)
+    for i in range(5):
+        log.write({'i': i})
+    assert log.stats()['dropped'] == 2
+    log.close()
+
+    assert read_records(path) == [{'i': 0}, {'i': 1}, {'i': 2}]
+
+
+def test_socket():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    received = []
+
+    def accept():
+        conn, _ = listener.accept()
+        while True:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            received.append(chunk)
+        conn.close()
+
+    thread = threading.Thread(target=accept)
+    thread.start()
+
+    log = DeliveryLog(address=listener.getsockname())
+    log.write({'guid': 'abc'})
+    log.close()
+    thread.join()
+    listener.close()
+
+    assert b''.join(received) == b'{"guid": "abc"}\n'
+
+
+def test_path_or_address():
+    with pytest.raises(ValueError):
+        DeliveryLog()
+    with pytest.raises(ValueError):
+        DeliveryLog(path='a', address=('127.0.0.1', 1))
+
+
+def test_hooks_log(tmpdir):
+    path = str(tmpdir.join('deliveries.log'))
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['GITHUB_WEBHOOKS_KEY'] = b'Some key'
+    app.config['HOOKS_LOG_PATH'] = path
+    hooks = Hooks(app)
+
+    @hooks.hook('ping')
+    def ping(data, guid):
+        return 'pong'
+
+    client = app.test_client()
+    headers = {
+        'X-GitHub-Event': 'ping',
+        'X-GitHub-Delivery': 'abc',
+        'X-Hub-Signature': 'sha1=e1590250fd7dd7882185062d1ade5bef8cb4319c',
+    }
+    rv = client.post('/hooks', content_type='application/json', data='{}',
+                     headers=headers)
+    assert rv.status_code == 200
+    headers['X-Hub-Signature'] = 'sha1=abc'
+    rv = client.post('/hooks', content_type='application/json', data='{}',
+                     headers=headers)
+    assert rv.status_code == 400
+    app.extensions['hookserver']['log'].close()
+
+    ok, bad = read_records(path)
+    assert ok['guid'] == 'abc'
+    assert ok['event'] == 'ping'
+    assert ok['validation'] == 'ok'
+    assert ok['handler'] == 'ok'
+    assert ok['status'] == 200
+    assert set(ok['timings']) == set(['validate_signature', 'parse',
+                                      'handler', 'total'])
+
+    assert bad['validation'] == 'Wrong signature'
+    assert bad['handler'] is None
+    assert bad['status'] == 400
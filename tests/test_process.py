@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Test running handlers in worker processes."""
+
+from flask.ext.hookserver import Hooks, ProcessPool
+from werkzeug.exceptions import GatewayTimeout, ServiceUnavailable
+import flask
+import json
+import os
+import pytest
+import sys
+import threading
+import time
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32',
+                                reason='needs os.setpgrp')
+
+
+def describe(data, guid):
+    return '%s %d %s' % (guid, os.getpid(), sorted(data))
+
+
+def fail(data, guid):
+    raise ValueError('oops')
+
+
+def slow(data, guid):
+    time.sleep(data['sleep'])
+    return guid
+
+
+held = threading.Lock()
+
+
+def take_lock(data, guid):
+    with held:
+        return guid
+
+
+@pytest.fixture
+def pool(request):
+    pool = ProcessPool(2, buffer_size=64, buffers=2, timeout=0.1)
+    request.addfinalizer(pool.close)
+    return pool
+
+
+def test_call(pool):
+    rv = pool.call(describe, b'{"a": 1, "b": 2}', 'abc')
+    guid, pid, keys = rv.split(' ', 2)
+    assert guid == 'abc'
+    assert int(pid) != os.getpid()
+    assert keys == "['a', 'b']"
+    assert pool.stats()['buffers_in_use'] == 0
+
+
+def test_oversize(pool):
+    body = json.dumps(dict(('key%d' % i, i) for i in range(20)))
+    assert len(body) > 64
+    assert pool.call(describe, body.encode(), 'abc').startswith('abc')
+    assert pool.stats()['oversize'] == 1
+
+
+def test_error(pool):
+    with pytest.raises(ValueError):
+        pool.call(fail, b'{}', 'abc')
+    assert pool.stats()['buffers_in_use'] == 0
+
+
+def test_buffers_reused(pool):
+    for i in range(10):
+        assert pool.call(slow, b'{"sleep": 0}', str(i)) == str(i)
+    assert pool.stats()['calls'] == 10
+
+
+def test_out_of_buffers(pool):
+    threads = [threading.Thread(target=pool.call,
+                                args=(slow, b'{"sleep": 0.5}', 'abc'))
+               for i in range(2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    assert pool.stats()['buffers_in_use'] == 2
+    with pytest.raises(ServiceUnavailable):
+        pool.call(slow, b'{"sleep": 0}', 'def')
+    for thread in threads:
+        thread.join()
+
+
+def test_lost_call(pool):
+    with pytest.raises(GatewayTimeout):
+        pool.call(slow, b'{"sleep": 1}', 'abc', timeout=0.1)
+    assert pool.stats()['lost'] == 1
+    # The buffer is free again, and the next call isn't confused by the
+    # one that was given up on
+    assert pool.call(describe, b'{}', 'def').startswith('def')
+
+
+def test_no_inherited_locks(pool):
+    # Held by another thread while the workers start, as the extension's
+    # threads might hold theirs
+    with held:
+        pool.start()
+    assert pool.call(take_lock, b'{}', 'abc', timeout=5) == 'abc'
+
+
+def test_close_removes_buffers():
+    pool = ProcessPool(1)
+    pool.start()
+    path = pool._path
+    assert os.path.getsize(path) == 2 * (8 + pool.buffer_size)
+    pool.close()
+    assert not os.path.exists(path)
+
+
+APP = '''
+import os
+from flask import Flask
+from flask_hookserver import Hooks
+
+app = Flask(__name__)
+app.config['VALIDATE_IP'] = False
+app.config['VALIDATE_SIGNATURE'] = False
+app.config['HOOKS_PROCESSES'] = 1
+app.config['HOOKS_PROCESS_TIMEOUT'] = 1
+hooks = Hooks(app)
+
+@hooks.hook('pull_request', process=True)
+def lint(data, guid):
+    return 'linted %s in %d' % (guid, os.getpid())
+
+@hooks.hook('push', process=True)
+def crash(data, guid):
+    os._exit(1)
+'''
+
+
+def test_hooks_process_defined_after_init(tmpdir, monkeypatch):
+    tmpdir.join('procapp.py').write(APP)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    from procapp import app
+
+    def post(event):
+        headers = {'X-GitHub-Event': event, 'X-GitHub-Delivery': 'abc'}
+        return app.test_client().post('/hooks', data='{}', headers=headers,
+                                      content_type='application/json')
+
+    try:
+        rv = post('pull_request')
+        assert rv.data.decode().startswith('linted abc in ')
+        assert int(rv.data.split()[-1]) != os.getpid()
+        # A worker that dies doesn't leave the delivery hanging
+        assert post('push').status_code == 504
+        assert post('pull_request').status_code == 200
+    finally:
+        app.extensions['hookserver']['process_pool'].close()
+
+
+def test_hooks_process():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_PROCESSES'] = 1
+    hooks = Hooks(app)
+    hooks.register_hook('push', describe, process=True)
+
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+    }
+    rv = app.test_client().post('/hooks', content_type='application/json',
+                                data='{"ref": "master"}', headers=headers)
+    guid, pid, keys = rv.data.decode().split(' ', 2)
+    assert int(pid) != os.getpid()
+    assert keys == "['ref']"
+    app.extensions['hookserver']['process_pool'].close()
+
+
+def test_hooks_process_not_configured():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['TESTING'] = True
+    hooks = Hooks(app)
+    hooks.register_hook('push', describe, process=True)
+
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+    }
+    with pytest.raises(RuntimeError):
+        app.test_client().post('/hooks', content_type='application/json',
+                               data='{}', headers=headers)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Test GitLab, Bitbucket and Gitea webhooks, and the IP allowlist."""
+
+from flask.ext.hookserver import (DeliveryArchive, GitHubProvider, Hooks,
+                                  IPAllowlist, providers)
+from werkzeug.contrib.fixers import ProxyFix
+import flask
+import hashlib
+import hmac
+import json
+import pytest
+
+BODY = json.dumps({'repository': {'full_name': 'a/b'},
+                   'project': {'path_with_namespace': 'c/d'}})
+
+
+@pytest.fixture
+def app():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['HOOKS_PROVIDERS'] = ['github', 'gitlab', 'bitbucket',
+                                     'gitea']
+    app.config['GITHUB_WEBHOOKS_KEY'] = b'github key'
+    app.config['GITLAB_WEBHOOKS_TOKEN'] = u'gitlab token'
+    app.config['BITBUCKET_WEBHOOKS_KEY'] = b'bitbucket key'
+    app.config['GITEA_WEBHOOKS_KEY'] = b'gitea key'
+    app.hooks = Hooks(app)
+
+    @app.hooks.hook('push')
+    def github(data, guid):
+        return 'github ' + guid
+
+    @app.hooks.hook('Push Hook', provider='gitlab')
+    def gitlab(data, guid):
+        return 'gitlab ' + guid
+
+    @app.hooks.hook('repo:push', provider='bitbucket')
+    def bitbucket(data, guid):
+        return 'bitbucket ' + guid
+
+    @app.hooks.hook('push', provider='gitea')
+    def gitea(data, guid):
+        return 'gitea ' + guid
+
+    return app
+
+
+def sign(key, digest):
+    return hmac.new(key, BODY.encode(), digest).hexdigest()
+
+
+def post(app, headers):
+    return app.test_client().post('/hooks', content_type='application/json',
+                                  data=BODY, headers=headers)
+
+
+def test_github(app):
+    rv = post(app, {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+        'X-Hub-Signature': 'sha1=' + sign(b'github key', hashlib.sha1),
+    })
+    assert rv.data == b'github abc'
+
+
+def test_gitlab(app):
+    headers = {
+        'X-Gitlab-Event': 'Push Hook',
+        'X-Gitlab-Event-UUID': 'abc',
+        'X-Gitlab-Token': 'gitlab token',
+    }
+    assert post(app, headers).data == b'gitlab abc'
+
+    headers['X-Gitlab-Token'] = 'github key'
+    rv = post(app, headers)
+    assert rv.status_code == 400
+    assert b'Wrong token' in rv.data
+
+    del headers['X-Gitlab-Token']
+    rv = post(app, headers)
+    assert rv.status_code == 400
+    assert b'Missing token' in rv.data
+
+
+def test_credentials_not_archived(app, tmpdir):
+    archive = DeliveryArchive(str(tmpdir.join('archive')))
+    app.extensions['hookserver']['archive'] = archive
+    post(app, {
+        'X-Gitlab-Event': 'Push Hook',
+        'X-Gitlab-Event-UUID': 'abc',
+        'X-Gitlab-Token': 'gitlab token',
+    })
+    post(app, {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'def',
+        'X-Hub-Signature': 'sha1=' + sign(b'github key', hashlib.sha1),
+    })
+    archive.close()
+
+    headers = archive.get('abc')['headers']
+    assert headers['X-Gitlab-Event'] == 'Push Hook'
+    assert 'X-Gitlab-Token' not in headers
+    headers = archive.get('def')['headers']
+    assert headers['X-Github-Event'] == 'push'
+    assert 'X-Hub-Signature' not in headers
+
+
+def test_bitbucket(app):
+    headers = {
+        'X-Event-Key': 'repo:push',
+        'X-Request-UUID': 'abc',
+        'X-Hub-Signature': 'sha256=' + sign(b'bitbucket key',
+                                            hashlib.sha256),
+    }
+    assert post(app, headers).data == b'bitbucket abc'
+
+    headers['X-Hub-Signature'] = 'sha1=' + sign(b'github key', hashlib.sha1)
+    assert b'Wrong signature' in post(app, headers).data
+
+
+def test_gitea(app):
+    headers = {
+        # Gitea sends GitHub's headers too
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+        'X-Gitea-Event': 'push',
+        'X-Gitea-Delivery': 'abc',
+        'X-Gitea-Signature': sign(b'gitea key', hashlib.sha256),
+    }
+    assert post(app, headers).data == b'gitea abc'
+
+
+def test_missing_headers(app):
+    rv = post(app, {'X-Gitlab-Event': 'Push Hook',
+                    'X-Gitlab-Token': 'gitlab token'})
+    assert b'Missing header: X-Gitlab-Event-UUID' in rv.data
+
+    # Unrecognized requests fail GitHub's checks
+    rv = post(app, {})
+    assert b'Missing signature' in rv.data
+
+
+def test_handler_keys(app):
+    assert set(app.hooks.handler_stats()) == set([
+        'push', 'gitlab:Push Hook', 'bitbucket:repo:push', 'gitea:push'])
+    with pytest.raises(Exception) as e:
+        app.hooks.register_hook('push', lambda data, guid: '',
+                                provider='gitea')
+    assert 'gitea:push hook already registered' in str(e)
+
+
+def test_unknown_provider():
+    app = flask.Flask(__name__)
+    app.config['HOOKS_PROVIDERS'] = ['sourceforge']
+    with pytest.raises(ValueError):
+        Hooks(app)
+
+
+def test_provider_ips():
+    app = flask.Flask(__name__)
+    app.wsgi_app = ProxyFix(app.wsgi_app)
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_PROVIDERS'] = [GitHubProvider(['10.0.0.0/8']),
+                                     'gitlab']
+    Hooks(app)
+
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+        'X-Forwarded-For': '11.0.0.1',
+    }
+    rv = post(app, headers)
+    assert b'Requests must originate from GitHub' in rv.data
+    headers['X-Forwarded-For'] = '10.0.0.1'
+    assert post(app, headers).status_code == 200
+
+    # GitLab has no IP list, so any IP is allowed
+    headers = {
+        'X-Gitlab-Event': 'Push Hook',
+        'X-Gitlab-Event-UUID': 'abc',
+        'X-Forwarded-For': '11.0.0.1',
+    }
+    assert post(app, headers).status_code == 200
+
+
+def test_verifier_cached():
+    provider = providers['gitea']
+    assert provider.verifier(b'key') is provider.verifier(u'key')
+
+
+def test_allowlist():
+    allowlist = IPAllowlist(['192.30.252.0/22', '192.30.254.0/23',
+                             '10.0.0.0/24', '10.0.1.0/24', '2620:112::/44'])
+    assert '192.30.252.0' in allowlist
+    assert '192.30.255.255' in allowlist
+    assert '192.30.251.255' not in allowlist
+    assert '192.31.0.0' not in allowlist
+    assert '10.0.1.255' in allowlist
+    assert '10.0.2.0' not in allowlist
+    assert b'10.0.0.1' in allowlist
+    assert '::ffff:c01e:fc01' in allowlist
+    assert '2620:112:3::1' in allowlist
+    assert '2620:113::1' not in allowlist
+    assert '0.0.0.1' not in allowlist
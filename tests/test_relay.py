@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Test forwarding deliveries to downstream services."""
+
+from flask import Flask
+from flask.ext.hookserver import Hooks, RelayTarget, check_signature
+from random import randint
+from werkzeug.serving import ThreadedWSGIServer
+import flask
+import json
+import pytest
+import threading
+
+
+@pytest.fixture()
+def downstream(request):
+    """Serve a Flask app that records what gets posted to it."""
+    host = '127.0.0.1'
+    port = randint(9000, 9999)
+    app = Flask(__name__)
+    app.received = []
+    app.status = [200]
+
+    @app.route('/', methods=['POST'])
+    def receive():
+        app.received.append((dict(flask.request.headers),
+                             flask.request.get_data()))
+        return '', app.status.pop(0) if len(app.status) > 1 else app.status[0]
+
+    app.url = 'http://{0}:{1}/'.format(host, port)
+    server = ThreadedWSGIServer(host, port, app)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    return app
+
+
+def test_forward(downstream):
+    target = RelayTarget(downstream.url, secret=b'downstream key')
+    target.send('push', 'abc', b'{"ref": "master"}')
+    target.flush()
+
+    headers, body = downstream.received[0]
+    assert body == b'{"ref": "master"}'
+    assert headers['X-Github-Event'] == 'push'
+    assert headers['X-Github-Delivery'] == 'abc'
+    assert headers['X-Hookserver-Provider'] == 'github'
+    assert check_signature(headers['X-Hub-Signature'], b'downstream key',
+                           body)
+    assert target.stats()['sent'] == 1
+    target.close()
+
+
+def test_events(downstream):
+    target = RelayTarget(downstream.url, events=['push'])
+    target.send('ping', 'abc', b'{}')
+    target.send('push', 'def', b'{}')
+    target.flush()
+
+    assert len(downstream.received) == 1
+    assert downstream.received[0][0]['X-Github-Delivery'] == 'def'
+    target.close()
+
+
+def test_batch(downstream):
+    target = RelayTarget(downstream.url, batch_size=3, batch_interval=1,
+                         concurrency=1)
+    for i in range(3):
+        target.send('push', str(i), b'{"i": %d}' % i)
+    target.flush()
+
+    headers, body = downstream.received[0]
+    assert headers['X-Hookserver-Batch'] == '3'
+    assert json.loads(body.decode()) == [
+        {'provider': 'github', 'event': 'push', 'guid': '0',
+         'payload': {'i': 0}},
+        {'provider': 'github', 'event': 'push', 'guid': '1',
+         'payload': {'i': 1}},
+        {'provider': 'github', 'event': 'push', 'guid': '2',
+         'payload': {'i': 2}},
+    ]
+    target.close()
+
+
+def test_retry(downstream):
+    downstream.status[:] = [500, 503, 200]
+    target = RelayTarget(downstream.url, retries=3, backoff=0.01)
+    target.send('push', 'abc', b'{}')
+    target.flush()
+
+    assert len(downstream.received) == 3
+    stats = target.stats()
+    assert stats['sent'] == 1
+    assert stats['retried'] == 2
+    target.close()
+
+
+def test_give_up(downstream):
+    downstream.status[:] = [500]
+    target = RelayTarget(downstream.url, retries=2, backoff=0.01)
+    target.send('push', 'abc', b'{}')
+    target.flush()
+
+    assert len(downstream.received) == 3
+    assert target.stats()['failed'] == 1
+    target.close()
+
+
+def test_client_error(downstream):
+    downstream.status[:] = [404]
+    target = RelayTarget(downstream.url, retries=2, backoff=0.01)
+    target.send('push', 'abc', b'{}')
+    target.flush()
+
+    # A misconfigured downstream isn't retried, or counted as sent
+    assert len(downstream.received) == 1
+    stats = target.stats()
+    assert stats['failed'] == 1
+    assert stats['sent'] == 0
+    assert stats['retried'] == 0
+    target.close()
+
+
+def test_hooks_relay(downstream):
+    app = Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    hooks = Hooks(app)
+    target = hooks.relay(downstream.url)
+
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+    }
+    rv = app.test_client().post('/hooks', content_type='application/json',
+                                data='{"ref": "master"}', headers=headers)
+    assert b'Hook not used' in rv.data
+    target.flush()
+
+    assert downstream.received[0][1] == b'{"ref": "master"}'
+    target.close()
+
+
+def test_hooks_relay_provider(downstream):
+    app = Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_PROVIDERS'] = ['github', 'gitlab']
+    hooks = Hooks(app)
+    target = hooks.relay(downstream.url)
+
+    headers = {
+        'X-Gitlab-Event': 'Push Hook',
+        'X-Gitlab-Event-UUID': 'abc',
+    }
+    app.test_client().post('/hooks', content_type='application/json',
+                           data='{}', headers=headers)
+    target.flush()
+
+    headers = downstream.received[0][0]
+    assert headers['X-Gitlab-Event'] == 'Push Hook'
+    assert headers['X-Gitlab-Event-Uuid'] == 'abc'
+    assert headers['X-Hookserver-Provider'] == 'gitlab'
+    assert 'X-Github-Event' not in headers
+    target.close()
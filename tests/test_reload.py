@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Test reloading handlers and secrets while running."""
+
+from flask.ext.hookserver import Hooks
+from time import sleep
+import flask
+import hashlib
+import hmac
+import pytest
+import signal
+import sys
+import threading
+import types
+
+HANDLERS = '''
+from reload_app import hooks
+
+@hooks.hook('push')
+def push(data, guid):
+    return %r
+'''
+
+BLOCKING = '''
+from reload_app import hooks, started, release
+
+@hooks.hook('push')
+def push(data, guid):
+    started.set()
+    release.wait()
+    return 'old'
+'''
+
+
+@pytest.fixture
+def app(request, tmpdir, monkeypatch):
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_RELOAD_MODULES'] = ['reload_handlers']
+    app.handlers = tmpdir.join('reload_handlers.py')
+    app.handlers.write(HANDLERS % 'v1')
+    app.hooks = Hooks()
+
+    module = types.ModuleType('reload_app')
+    module.hooks = app.hooks
+    module.started = threading.Event()
+    module.release = threading.Event()
+    monkeypatch.setitem(sys.modules, 'reload_app', module)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    request.addfinalizer(lambda: sys.modules.pop('reload_handlers', None))
+    return app
+
+
+def post(app, data=b'{}', headers=None):
+    headers = dict(headers or {})
+    headers.setdefault('X-GitHub-Event', 'push')
+    headers.setdefault('X-GitHub-Delivery', 'abc')
+    return app.test_client().post('/hooks', content_type='application/json',
+                                  data=data, headers=headers)
+
+
+def test_reload_handlers(app):
+    app.hooks.init_app(app)
+    import reload_handlers  # noqa: F401
+
+    @app.hooks.hook('ping')
+    def ping(data, guid):
+        return 'pong'
+
+    assert post(app).data == b'v1'
+    app.handlers.write(HANDLERS % 'version 2')
+    app.hooks.reload(app)
+    assert post(app).data == b'version 2'
+    assert post(app, headers={'X-GitHub-Event': 'ping'}).data == b'pong'
+
+
+def test_broken_module(app):
+    app.hooks.init_app(app)
+    import reload_handlers  # noqa: F401
+
+    app.handlers.write('def push(:\n')
+    with pytest.raises(SyntaxError):
+        app.hooks.reload(app)
+    assert post(app).data == b'v1'
+
+    # A new handler can still be registered afterwards
+    @app.hooks.hook('ping')
+    def ping(data, guid):
+        return 'pong'
+    assert post(app, headers={'X-GitHub-Event': 'ping'}).data == b'pong'
+
+
+def test_in_flight(app):
+    app.handlers.write(BLOCKING)
+    app.hooks.init_app(app)
+    import reload_handlers  # noqa: F401
+    reload_app = sys.modules['reload_app']
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(post(app)))
+    thread.start()
+    reload_app.started.wait()
+
+    app.handlers.write(HANDLERS % 'new')
+    app.hooks.reload(app)
+    reload_app.release.set()
+    thread.join()
+    assert results[0].data == b'old'
+    assert post(app).data == b'new'
+
+
+def test_rotate_key(app, tmpdir):
+    config = tmpdir.join('hooks.cfg')
+    config.write("GITHUB_WEBHOOKS_KEY = b'old key'\n")
+    app.config['VALIDATE_SIGNATURE'] = True
+    app.config['HOOKS_RELOAD_MODULES'] = []
+    app.config['HOOKS_RELOAD_CONFIG'] = str(config)
+    app.config.from_pyfile(str(config))
+    app.hooks.init_app(app)
+
+    def signed(key):
+        mac = hmac.new(key, b'{}', hashlib.sha1)
+        return {'X-Hub-Signature': 'sha1=' + mac.hexdigest(),
+                'X-GitHub-Event': 'ping'}
+
+    assert post(app, headers=signed(b'old key')).status_code == 200
+    config.write("GITHUB_WEBHOOKS_KEY = b'new key'\n")
+    assert post(app, headers=signed(b'new key')).status_code == 400
+    app.hooks.reload(app)
+    assert post(app, headers=signed(b'new key')).status_code == 200
+    assert post(app, headers=signed(b'old key')).status_code == 400
+
+
+def wait_for(reloader, reloads):
+    for _ in range(100):
+        if reloader.stats()['reloads'] >= reloads:
+            return
+        sleep(0.02)
+    raise AssertionError('no reload')
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'),
+                    reason='needs SIGUSR1')
+def test_signal(app):
+    import os
+
+    previous = signal.getsignal(signal.SIGUSR1)
+    app.config['HOOKS_RELOAD_SIGNAL'] = 'SIGUSR1'
+    try:
+        app.hooks.init_app(app)
+        import reload_handlers  # noqa: F401
+        reloader = app.extensions['hookserver']['reloader']
+
+        app.handlers.write(HANDLERS % 'signalled')
+        os.kill(os.getpid(), signal.SIGUSR1)
+        wait_for(reloader, 1)
+        assert post(app).data == b'signalled'
+        reloader.close()
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+
+def test_watch(app):
+    app.config['HOOKS_RELOAD_INTERVAL'] = 0.02
+    import reload_handlers  # noqa: F401
+    app.hooks.init_app(app)
+    reloader = app.extensions['hookserver']['reloader']
+
+    sleep(0.05)
+    assert reloader.stats()['reloads'] == 0
+    app.handlers.write(HANDLERS % 'changed on disk')
+    app.handlers.setmtime(app.handlers.mtime() + 10)
+    wait_for(reloader, 1)
+    assert post(app).data == b'changed on disk'
+
+    app.handlers.write('def push(:\n')
+    app.handlers.setmtime(app.handlers.mtime() + 20)
+    for _ in range(100):
+        if reloader.stats()['failures']:
+            break
+        sleep(0.02)
+    assert reloader.stats() == {'reloads': 1, 'failures': 1}
+    assert post(app).data == b'changed on disk'
+    reloader.close()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Test retrying failed handlers."""
+
+from flask.ext.hookserver import Hooks, RetryScheduler, TimingWheel
+import flask
+import json
+import os
+import pytest
+import threading
+import time
+
+
+def fail_once(data, guid):
+    # Run in a worker process, so the marker is kept in a file
+    if not os.path.exists(data['marker']):
+        open(data['marker'], 'w').close()
+        raise ValueError('oops')
+    return 'Linted'
+
+
+def test_wheel_order():
+    wheel = TimingWheel(tick=1, wheel_size=4, levels=3)
+    delays = [1, 3, 4, 5, 15, 16, 17, 40, 63]
+    for delay in reversed(delays):
+        wheel.schedule(delay, delay)
+    assert len(wheel) == len(delays)
+
+    fired = {}
+    for tick in range(1, 64):
+        for item in wheel.advance():
+            fired[item] = tick
+    assert fired == dict((delay, delay) for delay in delays)
+    assert len(wheel) == 0
+
+
+def test_wheel_schedule_later():
+    wheel = TimingWheel(tick=1, wheel_size=4, levels=3)
+    for i in range(7):
+        wheel.advance()
+    wheel.schedule(10, 'a')
+    wheel.schedule(2.5, 'b')
+    fired = {}
+    for tick in range(1, 20):
+        for item in wheel.advance():
+            fired[item] = tick
+    assert fired == {'a': 10, 'b': 3}
+
+
+def test_wheel_too_far():
+    wheel = TimingWheel(tick=1, wheel_size=4, levels=2)
+    wheel.schedule(100, 'a')
+    fired = [tick for tick in range(1, 20) if wheel.advance()]
+    assert fired == [15]
+
+
+def test_delay():
+    retries = RetryScheduler(base_delay=1, max_delay=10, jitter=0)
+    assert [retries.delay(i) for i in range(1, 6)] == [1, 2, 4, 8, 10]
+
+    retries.jitter = 0.5
+    for i in range(100):
+        assert 1 <= retries.delay(2) <= 2
+    retries.shutdown()
+
+
+@pytest.fixture
+def retries(request):
+    retries = RetryScheduler(max_attempts=3, base_delay=0.02, tick=0.01)
+    request.addfinalizer(retries.shutdown)
+    return retries
+
+
+def wait_for(retries, **stats):
+    for i in range(200):
+        current = retries.stats()
+        if all(current[k] == v for k, v in stats.items()):
+            return current
+        time.sleep(0.01)
+    raise AssertionError(retries.stats())
+
+
+def test_retry_succeeds(retries):
+    calls = []
+
+    def flaky(data, guid):
+        calls.append(time.time())
+        if len(calls) < 2:
+            raise ValueError('oops')
+
+    assert retries.schedule(flaky, {}, 'abc', attempt=1)
+    wait_for(retries, succeeded=1, failed=1, pending=0)
+    assert len(calls) == 2
+
+
+def test_dead_letter(retries):
+    def broken(data, guid):
+        raise ValueError('oops')
+
+    retries.schedule(broken, {}, 'abc', event='push', attempt=1)
+    wait_for(retries, dead=1, pending=0)
+    letter = retries.dead_letters[0]
+    assert letter['guid'] == 'abc'
+    assert letter['event'] == 'push'
+    assert letter['attempts'] == 3
+    assert 'oops' in letter['error']
+
+
+def test_hooks_retry():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_RETRIES'] = 3
+    app.config['HOOKS_RETRY_DELAY'] = 0.02
+    hooks = Hooks(app)
+    calls = []
+
+    @hooks.hook('push')
+    def deploy(data, guid):
+        calls.append(flask.current_app.name)
+        if len(calls) < 2:
+            raise ValueError('oops')
+        return 'Deployed'
+
+    @hooks.hook('ping')
+    def ping(data, guid):
+        flask.abort(400)
+
+    client = app.test_client()
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+    }
+    rv = client.post('/hooks', content_type='application/json',
+                     data=json.dumps({}), headers=headers)
+    assert rv.status_code == 202
+
+    retries = app.extensions['hookserver']['retries']
+    wait_for(retries, succeeded=1)
+    assert calls == [app.name, app.name]
+
+    # Client errors aren't retried
+    headers['X-GitHub-Event'] = 'ping'
+    rv = client.post('/hooks', content_type='application/json',
+                     data=json.dumps({}), headers=headers)
+    assert rv.status_code == 400
+    assert retries.stats()['scheduled'] == 1
+    retries.shutdown()
+
+
+def test_hooks_retry_dead_letter():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_RETRIES'] = 1
+    hooks = Hooks(app)
+
+    @hooks.hook('push')
+    def deploy(data, guid):
+        raise ValueError('oops')
+
+    # There's nothing left to retry with, so the sender has to know
+    rv = post_push(app, {})
+    assert rv.status_code == 500
+    retries = app.extensions['hookserver']['retries']
+    assert retries.stats()['scheduled'] == 0
+    assert retries.stats()['dead'] == 1
+    retries.shutdown()
+
+
+def test_hooks_retry_timeout():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_RETRIES'] = 3
+    app.config['HOOKS_RETRY_DELAY'] = 0.02
+    hooks = Hooks(app)
+    lock = threading.Lock()
+    calls = []
+
+    @hooks.hook('push', timeout=0.05, max_concurrency=1)
+    def deploy(data, guid):
+        # Fails if a retry runs while the first call is still going
+        assert lock.acquire(False)
+        try:
+            calls.append(guid)
+            if len(calls) == 1:
+                time.sleep(0.3)
+                if data['fail']:
+                    raise ValueError('oops')
+        finally:
+            lock.release()
+        return 'Deployed'
+
+    retries = app.extensions['hookserver']['retries']
+    assert post_push(app, {'fail': True}).status_code == 202
+    assert retries.stats()['pending'] == 1
+    time.sleep(0.1)
+    assert retries.stats()['scheduled'] == 0
+    wait_for(retries, succeeded=1, pending=0)
+    assert retries.stats() == {'pending': 0, 'scheduled': 1, 'succeeded': 1,
+                               'failed': 0, 'dead': 0}
+    assert len(calls) == 2
+
+    # A call that times out, then succeeds, isn't retried at all
+    del calls[:]
+    assert post_push(app, {'fail': False}).status_code == 202
+    wait_for(retries, pending=0)
+    time.sleep(0.1)
+    assert len(calls) == 1
+    assert retries.stats()['scheduled'] == 1
+    retries.shutdown()
+
+
+def post_push(app, data):
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+    }
+    return app.test_client().post('/hooks', content_type='application/json',
+                                  data=json.dumps(data), headers=headers)
+
+
+def test_retry_process(tmpdir):
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_RETRIES'] = 3
+    app.config['HOOKS_RETRY_DELAY'] = 0.02
+    app.config['HOOKS_PROCESSES'] = 1
+    hooks = Hooks(app)
+    hooks.register_hook('push', fail_once, process=True)
+    state = app.extensions['hookserver']
+
+    try:
+        rv = post_push(app, {'marker': str(tmpdir.join('marker'))})
+        assert rv.status_code == 202
+        wait_for(state['retries'], succeeded=1, failed=0, dead=0)
+    finally:
+        state['retries'].shutdown()
+        state['process_pool'].close()
+
+
+def test_retry_on_lane():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_RETRIES'] = 3
+    app.config['HOOKS_RETRY_DELAY'] = 0.02
+    app.config['HOOKS_LANES'] = 1
+    hooks = Hooks(app)
+    threads = []
+
+    @hooks.hook('push')
+    def deploy(data, guid):
+        threads.append(threading.current_thread())
+        if len(threads) < 2:
+            raise ValueError('oops')
+        return 'Deployed'
+
+    state = app.extensions['hookserver']
+    try:
+        assert post_push(app, {'repository': {'id': 1}}).status_code == 202
+        wait_for(state['retries'], succeeded=1)
+        # The retry ran on the repository's lane, like the first attempt
+        assert threads[0] is threads[1]
+        assert threads[0] is not threading.current_thread()
+    finally:
+        state['retries'].shutdown()
+        state['lanes'].shutdown()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Test priority scheduling of handlers."""
+
+from flask.ext.hookserver import Hooks, PriorityScheduler
+from werkzeug.exceptions import ServiceUnavailable
+import flask
+import json
+import pytest
+import threading
+import time
+
+
+@pytest.fixture
+def scheduler(request):
+    scheduler = PriorityScheduler(1, weights={'critical': 4, 'bulk': 1})
+    request.addfinalizer(scheduler.shutdown)
+    return scheduler
+
+
+def test_submit(scheduler):
+    future = scheduler.submit('bulk', lambda a, b: a + b, 1, 2)
+    assert future.result(1) == 3
+
+    def fail():
+        raise ValueError('oops')
+
+    future = scheduler.submit('critical', fail)
+    with pytest.raises(ValueError):
+        future.result(1)
+
+
+def test_unknown_class(scheduler):
+    with pytest.raises(ValueError):
+        scheduler.submit('normal', lambda: None)
+
+
+def test_weighted_sharing(scheduler):
+    release = threading.Event()
+    order = []
+    blocker = scheduler.submit('bulk', release.wait)
+
+    futures = []
+    for i in range(8):
+        futures.append(scheduler.submit('bulk', order.append, 'bulk'))
+    for i in range(8):
+        futures.append(scheduler.submit('critical', order.append, 'critical'))
+    release.set()
+    blocker.result(1)
+    for future in futures:
+        future.result(1)
+
+    # critical gets four turns for every turn bulk gets
+    assert order[:4] == ['critical'] * 4
+    assert order[:10].count('critical') == 8
+    assert order[10:] == ['bulk'] * 6
+
+
+def test_stats(scheduler):
+    release = threading.Event()
+    blocker = scheduler.submit('bulk', release.wait)
+    future = scheduler.submit('critical', lambda: None)
+    assert scheduler.stats()['critical']['queued'] == 1
+
+    release.set()
+    future.result(1)
+    blocker.result(1)
+    stats = scheduler.stats()
+    assert stats['critical']['queued'] == 0
+    assert stats['critical']['completed'] == 1
+    assert stats['critical']['max_queue_time'] > 0
+    assert stats['bulk']['completed'] == 1
+
+
+def test_queue_size():
+    scheduler = PriorityScheduler(1, weights={'bulk': 1}, queue_size=2)
+    release = threading.Event()
+    blocker = scheduler.submit('bulk', release.wait)
+    # Wait for the worker to take it off the queue
+    while scheduler.stats()['bulk']['queued']:
+        time.sleep(0.01)
+    scheduler.submit('bulk', lambda: None)
+    scheduler.submit('bulk', lambda: None)
+    with pytest.raises(ServiceUnavailable):
+        scheduler.submit('bulk', lambda: None)
+    release.set()
+    blocker.result(1)
+    scheduler.shutdown()
+
+
+def wait_for(scheduler, priority, completed):
+    for i in range(200):
+        if scheduler.stats()[priority]['completed'] == completed:
+            return
+        time.sleep(0.01)
+    raise AssertionError(scheduler.stats())
+
+
+def test_hooks_priority():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_WORKERS'] = 2
+    hooks = Hooks(app)
+    calls = []
+
+    @hooks.hook('deployment', priority='critical')
+    def deploy(data, guid):
+        calls.append((flask.current_app.name, guid))
+        return 'Deploying'
+
+    @hooks.hook('push', priority='bulk')
+    def push(data, guid):
+        return 'Pushed'
+
+    headers = {
+        'X-GitHub-Event': 'deployment',
+        'X-GitHub-Delivery': 'abc',
+    }
+    # The request doesn't wait for the handler
+    rv = app.test_client().post('/hooks', content_type='application/json',
+                                data=json.dumps({}), headers=headers)
+    assert rv.status_code == 202
+
+    scheduler = app.extensions['hookserver']['scheduler']
+    wait_for(scheduler, 'critical', 1)
+    assert calls == [(app.name, 'abc')]
+    assert scheduler.stats()['bulk']['completed'] == 0
+    scheduler.shutdown()
+
+
+def test_hooks_priority_failure():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_WORKERS'] = 1
+    app.config['HOOKS_RETRIES'] = 2
+    app.config['HOOKS_RETRY_DELAY'] = 0.02
+    hooks = Hooks(app)
+    calls = []
+
+    @hooks.hook('push')
+    def push(data, guid):
+        calls.append(guid)
+        raise ValueError('oops')
+
+    headers = {
+        'X-GitHub-Event': 'push',
+        'X-GitHub-Delivery': 'abc',
+    }
+    rv = app.test_client().post('/hooks', content_type='application/json',
+                                data=json.dumps({}), headers=headers)
+    assert rv.status_code == 202
+
+    # Retried, then put in the dead letters
+    state = app.extensions['hookserver']
+    for i in range(200):
+        if state['retries'].stats()['dead']:
+            break
+        time.sleep(0.01)
+    assert calls == ['abc', 'abc']
+    assert state['retries'].dead_letters[0]['guid'] == 'abc'
+    state['retries'].shutdown()
+    state['scheduler'].shutdown()
+
+
+def test_hooks_unknown_priority():
+    app = flask.Flask(__name__)
+    app.config['HOOKS_WORKERS'] = 1
+    app.config['HOOKS_PRIORITY_WEIGHTS'] = {'critical': 10, 'bulk': 1}
+    hooks = Hooks(app)
+
+    def handler(data, guid):
+        return 'ok'
+
+    with pytest.raises(ValueError) as e:
+        hooks.register_hook('push', handler)
+    assert str(e.value) == ("push hook has priority 'normal', which isn't "
+                            "in HOOKS_PRIORITY_WEIGHTS (bulk, critical)")
+    with pytest.raises(ValueError):
+        hooks.register_hook('push', handler, priority='urgent')
+    hooks.register_hook('push', handler, priority='bulk')
+    app.extensions['hookserver']['scheduler'].shutdown()
+
+    # Handlers registered before the app is set up are checked too
+    hooks = Hooks()
+    hooks.register_hook('push', handler, priority='urgent')
+    app = flask.Flask(__name__)
+    app.config['HOOKS_WORKERS'] = 1
+    with pytest.raises(ValueError):
+        hooks.init_app(app)
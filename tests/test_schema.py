@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Test payload schemas."""
+
+from flask.ext.hookserver import Hooks, compile_schema
+from werkzeug.exceptions import BadRequest
+import flask
+import json
+import pytest
+
+PUSH = {
+    'type': 'object',
+    'required': ['ref', 'repository', 'commits'],
+    'properties': {
+        'ref': {'type': 'string', 'pattern': '^refs/'},
+        'repository': {
+            'type': 'object',
+            'required': ['full_name'],
+            'properties': {'full_name': {'type': 'string'}},
+        },
+        'commits': {
+            'type': 'array',
+            'maxItems': 20,
+            'items': {
+                'type': 'object',
+                'required': ['id'],
+                'properties': {
+                    'id': {'type': 'string', 'minLength': 40,
+                           'maxLength': 40},
+                    'distinct': {'type': 'boolean'},
+                },
+            },
+        },
+        'size': {'type': 'integer', 'minimum': 0},
+        'head_commit': {'anyOf': [{'type': 'null'},
+                                  {'type': 'object'}]},
+    },
+}
+
+
+def error(validate, data):
+    with pytest.raises(BadRequest) as e:
+        validate(data)
+    return e.value.description
+
+
+def test_valid():
+    validate = compile_schema(PUSH)
+    validate({'ref': 'refs/heads/master', 'repository': {'full_name': 'a/b'},
+              'commits': [{'id': 'a' * 40, 'distinct': True}], 'size': 1,
+              'head_commit': None, 'extra': 'ignored'})
+
+
+def test_invalid():
+    validate = compile_schema(PUSH)
+    valid = {'ref': 'refs/heads/master', 'repository': {'full_name': 'a/b'},
+             'commits': []}
+
+    assert error(validate, []) == 'Invalid payload: payload must be an object'
+    assert error(validate, {}) == \
+        'Invalid payload: payload is missing "ref"'
+    assert error(validate, dict(valid, ref=1)) == \
+        'Invalid payload: payload["ref"] must be a string'
+    assert error(validate, dict(valid, ref='master')) == \
+        'Invalid payload: payload["ref"] must match "^refs/"'
+    assert error(validate, dict(valid, repository={})) == \
+        'Invalid payload: payload["repository"] is missing "full_name"'
+    assert error(validate, dict(valid, commits=[{'id': 'abc'}])) == \
+        ('Invalid payload: payload["commits"][0]["id"] must have a length '
+         'at least 40')
+    assert error(validate, dict(valid, commits=[{}] * 21)) == \
+        'Invalid payload: payload["commits"] must have a length at most 20'
+    assert error(validate, dict(valid, size=-1)) == \
+        'Invalid payload: payload["size"] must be at least 0'
+    assert error(validate, dict(valid, size=True)) == \
+        'Invalid payload: payload["size"] must be an integer'
+    assert error(validate, dict(valid, head_commit=[])) == \
+        ('Invalid payload: payload["head_commit"] doesn\'t match any of the '
+         'allowed schemas')
+
+
+def test_enum_and_additional():
+    validate = compile_schema({
+        'properties': {'action': {'enum': ['opened', 'closed', 1]}},
+        'additionalProperties': {'type': 'number'},
+    })
+    validate({'action': 'opened', 'count': 1.5})
+    # Validation keywords only apply to values of their type
+    validate([])
+    assert error(validate, {'action': 'edited'}) == \
+        ('Invalid payload: payload["action"] must be one of "opened", '
+         '"closed", 1')
+    assert 'must be one of' in error(validate, {'action': True})
+    assert error(validate, {'count': 'one'}) == \
+        'Invalid payload: payload["count"] must be a number'
+
+    validate = compile_schema({'type': ['string', 'null'],
+                               'additionalProperties': False})
+    validate(None)
+    assert error(validate, 1) == \
+        'Invalid payload: payload must be a string or null'
+
+    validate = compile_schema({'additionalProperties': False,
+                               'properties': {'a': {}}})
+    validate({'a': 1})
+    assert error(validate, {'b': 1}) == \
+        'Invalid payload: payload has unexpected property "b"'
+
+
+def test_bad_schema():
+    with pytest.raises(ValueError) as e:
+        compile_schema({'type': 'string', '$ref': '#/definitions/x',
+                        'oneOf': []})
+    assert str(e.value) == 'Unsupported schema keywords: $ref, oneOf'
+    with pytest.raises(ValueError):
+        compile_schema({'type': 'text'})
+    with pytest.raises(ValueError):
+        compile_schema({'items': 'string'})
+    # Annotations are fine
+    compile_schema({'title': 'Push', 'description': 'A push'})
+
+
+def test_hooks_schema():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    hooks = Hooks(app)
+    calls = []
+
+    @hooks.hook('push', schema={'required': ['ref']})
+    def push(data, guid):
+        calls.append(guid)
+        return data['ref']
+
+    def post(data):
+        headers = {'X-GitHub-Event': 'push', 'X-GitHub-Delivery': 'abc'}
+        return app.test_client().post('/hooks', data=json.dumps(data),
+                                      content_type='application/json',
+                                      headers=headers)
+
+    rv = post({'ref': 'refs/heads/master'})
+    assert rv.data == b'refs/heads/master'
+    rv = post({'after': 'abc'})
+    assert rv.status_code == 400
+    assert b'payload is missing' in rv.data
+    assert calls == ['abc']
+
+    with pytest.raises(ValueError):
+        hooks.register_hook('ping', push, schema={'type': 'text'})
+
+
+def test_rejected_payload_not_passed_on():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_STREAM'] = True
+    app.config['HOOKS_ANALYTICS'] = True
+    hooks = Hooks(app)
+    hooks.register_hook('push', lambda data, guid: 'ok',
+                        schema={'required': ['ref']})
+    state = app.extensions['hookserver']
+    subscription = state['stream'].subscribe()
+
+    headers = {'X-GitHub-Event': 'push', 'X-GitHub-Delivery': 'abc'}
+    rv = app.test_client().post('/hooks', data='{}', headers=headers,
+                                content_type='application/json')
+    assert rv.status_code == 400
+    assert subscription.get(timeout=0) is None
+    assert state['analytics'].report()['totals']['deliveries'] == 0
+
+    rv = app.test_client().post('/hooks', data='{"ref": "refs/heads/a"}',
+                                headers=headers,
+                                content_type='application/json')
+    assert rv.status_code == 200
+    assert subscription.get(timeout=0) is not None
+    state['analytics'].close()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""Test the prefork server runner."""
+
+from random import randint
+import itertools
+import json
+import os
+import pytest
+import requests
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'),
+                                reason='needs fork')
+
+APP = '''
+import os
+import time
+from flask import Flask
+from flask_hookserver import Hooks
+
+app = Flask(__name__)
+app.config['VALIDATE_IP'] = False
+app.config['VALIDATE_SIGNATURE'] = False
+app.config['HOOKS_LOG_PATH'] = 'deliveries.log'
+app.config['HOOKS_STREAM'] = True
+app.config['HOOKS_STREAM_TOKEN'] = 'stream token'
+hooks = Hooks(app)
+
+@hooks.hook('push')
+def push(data, guid):
+    time.sleep(data.get('sleep', 0))
+    return 'pushed %s' % guid
+
+@hooks.hook('crash')
+def crash(data, guid):
+    os._exit(1)
+'''
+
+STREAM_HEADERS = {'Authorization': 'Bearer stream token'}
+
+PRIORITY_APP = '''
+import time
+from flask import Flask
+from flask_hookserver import Hooks
+
+app = Flask(__name__)
+app.config['VALIDATE_IP'] = False
+app.config['VALIDATE_SIGNATURE'] = False
+app.config['HOOKS_WORKERS'] = 1
+hooks = Hooks(app)
+
+def handled(guid):
+    with open('handled.log', 'a') as f:
+        f.write(guid + '\\n')
+
+@hooks.hook('status', priority='bulk')
+def status(data, guid):
+    time.sleep(0.05)
+    handled(guid)
+
+@hooks.hook('security_advisory', priority='critical')
+def advisory(data, guid):
+    handled(guid)
+'''
+
+
+def start(tmpdir, app='hooks_app', *args):
+    tmpdir.join('hooks_app.py').write(APP)
+    port = randint(9000, 9999)
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = root
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'flask_hookserver', 'serve', app,
+         '--bind', '127.0.0.1:%d' % port] + list(args),
+        cwd=str(tmpdir), env=env, stderr=subprocess.PIPE)
+    proc.url = 'http://127.0.0.1:%d/hooks' % port
+    return proc
+
+
+def wait_until_up(proc):
+    port = int(proc.url.split(':')[2].split('/')[0])
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    proc.kill()
+    raise AssertionError(proc.stderr.read())
+
+
+def post(proc, event='push', data=None, guid='abc'):
+    headers = {
+        'Content-Type': 'application/json',
+        'X-GitHub-Event': event,
+        'X-GitHub-Delivery': guid,
+    }
+    return requests.post(proc.url, data=json.dumps(data or {}),
+                         headers=headers, timeout=10)
+
+
+def test_serve_and_drain(tmpdir):
+    proc = start(tmpdir, 'hooks_app', '--workers', '2', '--threads', '2')
+    wait_until_up(proc)
+    assert post(proc, guid='fast').text == 'pushed fast'
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        post(proc, data={'sleep': 1}, guid='slow')))
+    thread.start()
+    time.sleep(0.3)
+    proc.send_signal(signal.SIGTERM)
+    thread.join()
+    assert results[0].text == 'pushed slow'
+    assert proc.wait() == 0
+
+    with pytest.raises(requests.ConnectionError):
+        post(proc)
+    guids = [json.loads(line)['guid']
+             for line in tmpdir.join('deliveries.log').readlines()]
+    assert sorted(guids) == ['fast', 'slow']
+
+
+def test_streams_out_of_pool(tmpdir):
+    proc = start(tmpdir, 'hooks_app', '--workers', '1', '--threads', '2',
+                 '--max-streams', '3')
+    wait_until_up(proc)
+    streams = []
+    for i in range(3):
+        rv = requests.get(proc.url + '/stream', headers=STREAM_HEADERS,
+                          stream=True, timeout=10)
+        assert rv.status_code == 200
+        lines = rv.iter_lines(chunk_size=1)
+        assert next(lines) == b': connected'
+        streams.append(lines)
+
+    # More streams than threads, and deliveries still get through
+    assert post(proc, guid='during').text == 'pushed during'
+    for lines in streams:
+        assert b'id: during' in list(itertools.islice(lines, 4))
+    rv = requests.get(proc.url + '/stream', headers=STREAM_HEADERS,
+                      timeout=10)
+    assert rv.status_code == 503
+
+    # Draining ends the streams rather than waiting for them
+    started = time.time()
+    proc.send_signal(signal.SIGTERM)
+    assert proc.wait() == 0
+    assert time.time() - started < 10
+    for lines in streams:
+        list(lines)
+
+
+def test_priority_through_thread_pool(tmpdir):
+    tmpdir.join('priority_app.py').write(PRIORITY_APP)
+    proc = start(tmpdir, 'priority_app', '--workers', '1', '--threads', '2')
+    wait_until_up(proc)
+    # Many more bulk deliveries than request threads
+    flood = [threading.Thread(target=post, args=(proc, 'status'),
+                              kwargs={'guid': 'status%d' % i})
+             for i in range(40)]
+    for thread in flood:
+        thread.start()
+    time.sleep(0.2)
+    assert post(proc, 'security_advisory', guid='advisory').status_code == 202
+    for thread in flood:
+        thread.join()
+    proc.send_signal(signal.SIGTERM)
+    assert proc.wait() == 0
+
+    handled = tmpdir.join('handled.log').read().split()
+    assert len(handled) == 41
+    # It went ahead of most of the flood, rather than waiting its turn
+    # for a request thread
+    assert handled.index('advisory') < 10
+
+
+def test_replace_dead_worker(tmpdir):
+    proc = start(tmpdir, 'hooks_app', '--workers', '1')
+    wait_until_up(proc)
+    with pytest.raises(requests.ConnectionError):
+        post(proc, 'crash')
+    for _ in range(50):
+        try:
+            assert post(proc).status_code == 200
+            break
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    else:
+        raise AssertionError('worker not replaced')
+    proc.send_signal(signal.SIGTERM)
+    assert proc.wait() == 0
+
+
+def test_gunicorn(tmpdir):
+    pytest.importorskip('gunicorn')
+    proc = start(tmpdir, 'hooks_app', '--workers', '1', '--threads', '4',
+                 '--server', 'gunicorn')
+    wait_until_up(proc)
+    assert post(proc, guid='fast').text == 'pushed fast'
+    rv = requests.get(proc.url + '/stream', headers=STREAM_HEADERS,
+                      stream=True, timeout=10)
+    lines = rv.iter_lines(chunk_size=1)
+    assert next(lines) == b': connected'
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        post(proc, data={'sleep': 1}, guid='slow')))
+    thread.start()
+    time.sleep(0.3)
+    started = time.time()
+    proc.send_signal(signal.SIGTERM)
+    thread.join()
+    assert results[0].text == 'pushed slow'
+    # The stream was ended rather than waited for
+    list(lines)
+    assert proc.wait() == 0
+    assert time.time() - started < 10
+
+    guids = [json.loads(line)['guid']
+             for line in tmpdir.join('deliveries.log').readlines()]
+    assert sorted(guids) == ['fast', 'slow']
+
+
+def test_gunicorn_load_failure(tmpdir):
+    pytest.importorskip('gunicorn')
+    proc = start(tmpdir, 'no_such_module', '--server', 'gunicorn')
+    assert proc.wait() == 3
+
+
+def test_load_failure(tmpdir):
+    proc = start(tmpdir, 'no_such_module', '--workers', '2')
+    assert proc.wait() == 3
+    assert b'No module named' in proc.stderr.read()
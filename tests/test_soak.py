@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Test that the soak test harness runs, and catches a leak."""
+
+import os
+import pytest
+import subprocess
+import sys
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 4),
+                                reason='needs tracemalloc')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def soak(*args):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'benchmarks', 'soak.py'),
+         '--deliveries', '400', '--max-size', '4096',
+         '--rss-budget', '1000000', '--log', '--analytics'] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0].decode()
+    return proc.returncode, output
+
+
+def test_soak():
+    status, output = soak('--budget', '1000')
+    assert status == 0, output
+    assert output.rstrip().endswith('OK')
+
+
+def test_soak_catches_leak():
+    status, output = soak('--budget', '1000', '--leak', '10000')
+    assert status == 1, output
+    assert 'FAILED' in output
+    # The leaking line is named in the report
+    assert 'soak.py' in output.split('Largest growth')[1].split('\n')[1]
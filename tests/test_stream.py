@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Test the live event stream."""
+
+from flask.ext.hookserver import EventStream, Hooks
+import flask
+import json
+import pytest
+
+
+@pytest.fixture
+def stream():
+    return EventStream()
+
+
+def test_publish(stream):
+    subscription = stream.subscribe()
+    stream.publish('push', 'abc', 'a/b', b'{"ref": "master"}')
+    assert subscription.get(0) == (b'id: abc\nevent: push\n'
+                                   b'data: {"ref": "master"}\n\n')
+    assert subscription.get(0) is None
+
+
+def test_multiline(stream):
+    subscription = stream.subscribe()
+    stream.publish('push', 'abc', 'a/b', b'{\n  "ref": "master"\n}')
+    assert subscription.get(0) == (b'id: abc\nevent: push\ndata: {\n'
+                                   b'data:   "ref": "master"\ndata: }\n\n')
+
+
+def test_serialized_once(stream):
+    first = stream.subscribe()
+    second = stream.subscribe()
+    stream.publish('push', 'abc', 'a/b', b'{}')
+    assert first.get(0) is second.get(0)
+
+
+def test_filters(stream):
+    pushes = stream.subscribe(events=['push'])
+    repo = stream.subscribe(repositories=['a/b'])
+    stream.publish('push', '1', 'c/d', b'{}')
+    stream.publish('ping', '2', 'a/b', b'{}')
+
+    assert pushes.get(0).startswith(b'id: 1\n')
+    assert pushes.get(0) is None
+    assert repo.get(0).startswith(b'id: 2\n')
+    assert repo.get(0) is None
+
+
+def test_drop_oldest(stream):
+    subscription = stream.subscribe(buffer=2)
+    for guid in ['1', '2', '3']:
+        stream.publish('push', guid, 'a/b', b'{}')
+    assert subscription.dropped == 1
+    assert subscription.get(0).startswith(b'id: 2\n')
+    assert subscription.get(0).startswith(b'id: 3\n')
+
+
+def test_unsubscribe(stream):
+    subscription = stream.subscribe()
+    stream.unsubscribe(subscription)
+    stream.publish('push', 'abc', 'a/b', b'{}')
+    assert subscription.get(0) is None
+    assert stream.stats() == []
+
+
+def test_hooks_stream():
+    app = flask.Flask(__name__)
+    app.config['VALIDATE_IP'] = False
+    app.config['VALIDATE_SIGNATURE'] = False
+    app.config['HOOKS_STREAM'] = True
+    app.config['HOOKS_STREAM_TOKEN'] = 'stream token'
+    Hooks(app)
+    client = app.test_client()
+
+    rv = client.get('/hooks/stream?event=push&repo=a/b', buffered=False,
+                    headers={'Authorization': 'Bearer stream token'})
+    assert rv.mimetype == 'text/event-stream'
+    chunks = iter(rv.response)
+    assert next(chunks) == b': connected\n\n'
+
+    for event, repo in [('ping', 'a/b'), ('push', 'c/d'), ('push', 'a/b')]:
+        headers = {
+            'X-GitHub-Event': event,
+            'X-GitHub-Delivery': event + repo,
+        }
+        data = json.dumps({'repository': {'full_name': repo}})
+        client.post('/hooks', content_type='application/json', data=data,
+                    headers=headers)
+    assert next(chunks).startswith(b'id: pusha/b\nevent: push\n')
+
+    stream = app.extensions['hookserver']['stream']
+    assert len(stream.stats()) == 1
+    rv.close()
+    assert stream.stats() == []
+
+
+def test_hooks_stream_token():
+    app = flask.Flask(__name__)
+    app.config['HOOKS_STREAM'] = True
+    app.config['HOOKS_STREAM_TOKEN'] = 'stream token'
+    Hooks(app)
+    client = app.test_client()
+
+    assert client.get('/hooks/stream').status_code == 403
+    for header in ['Bearer wrong token', 'stream token',
+                   'Basic stream token']:
+        rv = client.get('/hooks/stream', headers={'Authorization': header})
+        assert rv.status_code == 403
+    assert app.extensions['hookserver']['stream'].stats() == []
+
+
+def test_hooks_stream_no_token():
+    app = flask.Flask(__name__)
+    app.config['HOOKS_STREAM'] = True
+    Hooks(app)
+
+    # Without a token the route isn't there, but the stream is
+    assert app.test_client().get('/hooks/stream').status_code == 404
+    assert 'stream' in app.extensions['hookserver']